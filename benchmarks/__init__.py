@@ -0,0 +1,149 @@
+"""
+Benchmarks of the data deleters on synthetic data. Realistic trees are built under a work dir at a chosen scale, the
+Rest API is replaced by a local HTTP stand-in and the `lfs` commands and Lims calls by in-memory fakes, then each
+deleter is timed end to end and per phase with its own metrics.
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+from shutil import rmtree
+from unittest.mock import patch
+from egcg_core import rest_communication
+from egcg_core.config import cfg
+from egcg_core.app_logging import logging_default as log_cfg
+from data_deletion.hsm import HSMStates
+from data_deletion.fid2path import FidLookup
+from data_deletion.raw_data import RawDataDeleter
+from data_deletion.delivered_data import DeliveredDataDeleter
+from data_deletion.final_data import FinalDataDeleter
+from data_deletion.DMF_data import DMFDataDeleter
+from benchmarks.synthetic_data import SyntheticData, scales
+from benchmarks.fake_services import FakeRestAPI, FakeLustre
+
+# in the order they run: final deletion removes what delivered data deletion left on tape
+deleter_classes = (RawDataDeleter, DeliveredDataDeleter, FinalDataDeleter, DMFDataDeleter)
+
+
+class LimsSample:
+    def __init__(self, name):
+        self.name = name
+        self.udf = {}
+
+
+def _deleter_args(deleter_cls, data, delete_engine):
+    # deletion dirs are named after the time, so deleters started within a second of each other need their own
+    work_dir = os.path.join(data.dirs['work_dir'], deleter_cls.alias)
+    os.makedirs(work_dir, exist_ok=True)
+    argv = ['--work_dir', work_dir, '--delete_engine', delete_engine]
+    if deleter_cls in (DeliveredDataDeleter, FinalDataDeleter):
+        argv += ['--manual_delete'] + data.sample_ids
+    p = argparse.ArgumentParser()
+    deleter_cls.add_args(p)
+    return p.parse_args(argv)
+
+
+def run_benchmark(deleter_cls, data, api, lustre, delete_engine):
+    """
+    Run one deleter on the synthetic data.
+    :return: the time taken, the deleter's metrics, and the number of HTTP requests and `lfs` calls made
+    """
+    deleter = deleter_cls(_deleter_args(deleter_cls, data, delete_engine))
+    nb_requests = api.nb_requests
+    nb_lfs_calls = lustre.nb_calls
+    start = time.time()
+    with deleter.metrics.span('delete_data'):
+        deleter.delete_data()
+
+    return {
+        'deleter': deleter_cls.alias,
+        'seconds': round(time.time() - start, 3),
+        'http_requests': api.nb_requests - nb_requests,
+        'lfs_calls': lustre.nb_calls - nb_lfs_calls,
+        'metrics': deleter.metrics.to_dict(),
+        'summary': deleter.metrics.summary()
+    }
+
+
+def run_benchmarks(scale, work_dir, aliases, delete_engine='local-parallel'):
+    """
+    Build the synthetic data at the given scale under work_dir, then run the deleters listed in aliases on it.
+    :rtype: dict
+    """
+    data = SyntheticData(work_dir, scale)
+    start = time.time()
+    data.build()
+    results = {
+        'scale': dict(scale._asdict()), 'nb_files': data.nb_files, 'build_seconds': round(time.time() - start, 3),
+        'deleters': []
+    }
+
+    api = FakeRestAPI()
+    for endpoint, docs in data.documents.items():
+        api.add(endpoint, docs)
+    api.start()
+    lustre = FakeLustre(data.archived_files, data.orphan_fids)
+
+    # restored afterwards, so that later code in the same process does not talk to the fake Rest API
+    config, baseurl = cfg.content, rest_communication.default._baseurl
+    cfg.content = {'data_deletion': data.config(), 'rest_api': {'url': api.url}}
+    rest_communication.default._baseurl = api.url
+    patches = (
+        patch('data_deletion.delivered_index.clarity.get_list_of_samples',
+              new=lambda names: [LimsSample(n) for n in names]),
+        patch('data_deletion.clarity.get_sample_release_date', return_value='2000-01-01'),
+        patch.object(HSMStates, '_get_cmd_output', side_effect=lustre.hsm_command),
+        patch.object(FidLookup, '_get_cmd_output', side_effect=lustre.fid2path)
+    )
+    for p in patches:
+        p.start()
+    try:
+        for deleter_cls in deleter_classes:
+            if deleter_cls.alias in aliases:
+                results['deleters'].append(run_benchmark(deleter_cls, data, api, lustre, delete_engine))
+    finally:
+        for p in patches:
+            p.stop()
+        api.stop()
+        cfg.content = config
+        rest_communication.default._baseurl = baseurl
+
+    return results
+
+
+def main(argv=None):
+    a = argparse.ArgumentParser(description=__doc__)
+    a.add_argument('--scale', choices=sorted(scales, key=lambda s: scales[s].dmf_files), default='small')
+    a.add_argument('--work_dir', help='Where to build the synthetic data. Defaults to a new temporary dir.')
+    a.add_argument('--deleters', nargs='+', choices=[c.alias for c in deleter_classes],
+                   default=[c.alias for c in deleter_classes])
+    a.add_argument('--delete_engine', choices=('cluster', 'local-parallel'), default='local-parallel')
+    a.add_argument('--output', help='JSON file to write the results to')
+    a.add_argument('--keep', action='store_true', help='Do not remove the synthetic data afterwards')
+    a.add_argument('--debug', action='store_true')
+    args = a.parse_args(argv)
+
+    if 'final_deletion' in args.deleters and 'delivered_data' not in args.deleters:
+        a.error('final_deletion deletes what delivered_data leaves on tape, so needs to run after it')
+
+    if args.debug:
+        log_cfg.add_stdout_handler()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='data_deletion_benchmark_')
+    try:
+        results = run_benchmarks(scales[args.scale], work_dir, args.deleters, args.delete_engine)
+    finally:
+        if not args.keep:
+            rmtree(work_dir, ignore_errors=True)
+
+    print('Built %s files in %.1fs (scale: %s)' % (results['nb_files'], results['build_seconds'], args.scale))
+    for r in results['deleters']:
+        print('\n%s: %.1fs, %s HTTP requests, %s lfs calls' % (r['deleter'], r['seconds'], r['http_requests'],
+                                                             r['lfs_calls']))
+        print(r['summary'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
@@ -0,0 +1,195 @@
+import os
+import json
+import uuid
+import threading
+from copy import deepcopy
+from socketserver import ThreadingMixIn
+from collections import defaultdict
+from urllib.parse import urlparse, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+_missing = object()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _get(doc, dotted_key):
+    value = doc
+    for k in dotted_key.split('.'):
+        if not isinstance(value, dict) or k not in value:
+            return _missing
+        value = value[k]
+    return value
+
+
+def matches(doc, where):
+    """
+    Whether a document matches a Rest API query, supporting the subset of MongoDB syntax used by the deleters: dotted
+    keys, equality, $in, $nin, $ne and $or. As in MongoDB, a list field matches if any of its elements does.
+    """
+    for k, condition in where.items():
+        if k == '$or':
+            if not any(matches(doc, w) for w in condition):
+                return False
+            continue
+
+        value = _get(doc, k)
+        values = value if isinstance(value, list) else [value]
+        if not isinstance(condition, dict):
+            condition = {'$eq': condition}
+        for op, arg in condition.items():
+            if op == '$eq':
+                ok = arg in values
+            elif op == '$ne':
+                ok = arg not in values
+            elif op in ('$in', '$nin'):
+                arg = _as_set(arg)
+                ok = any(v in arg for v in values) == (op == '$in')
+            else:
+                raise ValueError('Unsupported query operator: ' + op)
+            if not ok:
+                return False
+    return True
+
+
+def _as_set(values):
+    try:
+        return set(values)
+    except TypeError:  # unhashable values
+        return values
+
+
+class FakeRestAPI:
+    """
+    In-memory stand-in for the Rest API, served over HTTP on localhost so that the deleters' own Communicators are
+    exercised, with their pagination, chunked queries and patches.
+    """
+    def __init__(self):
+        self.documents = defaultdict(list)
+        self.lock = threading.Lock()
+        self.nb_requests = 0
+        self.server = None
+
+    def add(self, endpoint, docs):
+        with self.lock:
+            for d in docs:
+                d = deepcopy(d)
+                d['_id'] = uuid.uuid4().hex
+                d['_etag'] = uuid.uuid4().hex
+                self.documents[endpoint].append(d)
+
+    def query(self, endpoint, where=None):
+        with self.lock:
+            return [d for d in self.documents[endpoint] if matches(d, where or {})]
+
+    def patch(self, endpoint, doc_id, payload):
+        with self.lock:
+            for d in self.documents[endpoint]:
+                if d['_id'] == doc_id:
+                    d.update(payload)
+                    d['_etag'] = uuid.uuid4().hex
+                    return d
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return 'http://%s:%s/api/0.1' % (host, port)
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, content):
+                body = json.dumps(content).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _endpoint(self):
+                return urlparse(self.path).path[len('/api/0.1/'):].strip('/')
+
+            def _count_request(self):
+                with api.lock:
+                    api.nb_requests += 1
+
+            def do_GET(self):
+                self._count_request()
+                endpoint = self._endpoint()
+                query = dict((k, v[0]) for k, v in parse_qs(urlparse(self.path).query).items())
+                docs = api.query(endpoint, json.loads(query.get('where', '{}')))
+                max_results = int(query.get('max_results', 25))
+                page = int(query.get('page', 1))
+                links = {}
+                if page * max_results < len(docs):
+                    links['next'] = {'href': '%s?max_results=%s&page=%s' % (endpoint, max_results, page + 1)}
+                self._send(
+                    200,
+                    {'data': docs[(page - 1) * max_results:page * max_results], '_links': links,
+                     '_meta': {'total': len(docs), 'page': page, 'max_results': max_results}}
+                )
+
+            def do_PATCH(self):
+                self._count_request()
+                endpoint, doc_id = self._endpoint().rsplit('/', 1)
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode())
+                doc = api.patch(endpoint, doc_id, payload)
+                if doc:
+                    self._send(200, {'_id': doc_id, '_etag': doc['_etag'], '_status': 'OK'})
+                else:
+                    self._send(404, {'_status': 'ERR'})
+
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeLustre:
+    """
+    Stand-in for the `lfs` commands run by the deleters: HSM states are kept in memory, starting as archived for the
+    files given, and `lfs fid2path` finds no Lustre path for the orphan FIDs given.
+    """
+    def __init__(self, archived_files=(), orphan_fids=()):
+        self.lock = threading.Lock()
+        self.states = dict((f, ['exists', 'archived']) for f in archived_files)
+        self.orphan_fids = set(orphan_fids)
+        self.nb_calls = 0
+
+    def _state_line(self, f):
+        states = self.states.get(f, ['exists', 'archived'])
+        return '%s: (0x0000000b) %s, archive_id:1' % (f, ' '.join(states))
+
+    def hsm_command(self, cmd):
+        """Replacement for HSMStates._get_cmd_output, taking the command as a list."""
+        with self.lock:
+            self.nb_calls += 1
+            action, files = cmd[1], cmd[2:]
+            if action == 'hsm_release':
+                for f in files:
+                    self.states[f] = ['released', 'exists', 'archived']
+                return 0, b'', b''
+
+            lines = [self._state_line(f) for f in files if os.path.lexists(f)]
+            return 0, '\n'.join(lines).encode(), b''
+
+    def fid2path(self, cmd):
+        """Replacement for FidLookup._get_cmd_output, taking `lfs fid2path --print-fid <fs> <fid>...` as a list."""
+        with self.lock:
+            self.nb_calls += 1
+        stdout = []
+        stderr = []
+        for fid in cmd[4:]:
+            if fid in self.orphan_fids:
+                stderr.append("lfs fid2path: cannot find '%s': No such file or directory" % fid)
+            else:
+                stdout.append('%s /lustre/some/path/%s' % (fid, fid))
+        return 2 if stderr else 0, '\n'.join(stdout).encode(), '\n'.join(stderr).encode()
@@ -0,0 +1,181 @@
+import os
+from collections import namedtuple
+
+Scale = namedtuple(
+    'Scale',
+    ('nb_runs', 'nb_projects', 'samples_per_project', 'lanes_per_sample', 'raw_files_per_dir', 'dmf_files',
+     'file_size')
+)
+
+scales = {
+    'tiny': Scale(2, 1, 4, 2, 10, 100, 1000),
+    'small': Scale(4, 2, 20, 2, 500, 10000, 100000),
+    'medium': Scale(8, 10, 50, 4, 5000, 100000, 1000000),
+    'large': Scale(32, 20, 200, 8, 30000, 1000000, 10000000)
+}
+
+processed_extensions = ('_R1.fastq.gz', '_R2.fastq.gz', '.bam', '.bam.bai', '.vcf.gz', '.vcf.gz.tbi', '.g.vcf.gz',
+                        '.g.vcf.gz.tbi')
+raw_lanes = 8
+old_date = '01_01_2000_00:00:00'
+
+
+def touch(path, size=0):
+    """Create a sparse file of the given apparent size, without writing any data."""
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+
+class SyntheticData:
+    """
+    Realistic data_deletion trees under a root dir: raw run folders, per-lane fastqs, processed project dirs, delivery
+    batches hard-linked to the processed data, and a DMF filesystem of FID-named files. The Rest API documents
+    describing them are built alongside.
+    """
+    def __init__(self, root, scale):
+        """
+        :param str root: dir to build everything under
+        :param Scale scale:
+        """
+        self.root = root
+        self.scale = scale
+        self.dirs = dict(
+            (k, os.path.join(root, k)) for k in (
+                'raw_data', 'raw_archives', 'fastqs', 'fastq_archives', 'processed_data', 'processed_archives',
+                'delivered_data', 'dmf_filesystem', 'lustre_file_system', 'logs', 'work_dir'
+            )
+        )
+        self.documents = {'runs': [], 'analysis_driver_procs': [], 'run_elements': [], 'samples': []}
+        self.archived_files = []
+        self.orphan_fids = set()
+        self.nb_files = 0
+
+    def config(self):
+        """The data_deletion config section pointing at the synthetic trees."""
+        config = dict((k, v) for k, v in self.dirs.items() if k not in ('logs', 'work_dir'))
+        config['log_dir'] = self.dirs['logs']
+        return config
+
+    def _touch(self, path, size=0):
+        touch(path, size)
+        self.nb_files += 1
+
+    @staticmethod
+    def run_id(i):
+        return '000101_E0000%s_%04d_BENCHRUN' % (i % 10, i)
+
+    @property
+    def run_ids(self):
+        return [self.run_id(i) for i in range(self.scale.nb_runs)]
+
+    @property
+    def sample_ids(self):
+        return [d['sample_id'] for d in self.documents['samples']]
+
+    def build(self):
+        for d in self.dirs.values():
+            os.makedirs(d, exist_ok=True)
+        self.build_raw_runs()
+        self.build_samples()
+        self.build_dmf_filesystem()
+
+    def build_raw_runs(self):
+        """Raw run folders with Data, Logs and Thumbnail_Images, plus the files left behind when they are deleted."""
+        for i, run_id in enumerate(self.run_ids):
+            run_dir = os.path.join(self.dirs['raw_data'], run_id)
+            for lane in range(1, raw_lanes + 1):
+                for sub_dir in ('Data/Intensities/BaseCalls/L00%s' % lane, 'Thumbnail_Images/L00%s' % lane):
+                    d = os.path.join(run_dir, sub_dir)
+                    os.makedirs(d)
+                    for f in range(self.scale.raw_files_per_dir // raw_lanes):
+                        self._touch(os.path.join(d, 'C%s.1_%s.cbcl' % (f, lane)), self.scale.file_size // 100)
+
+            for d in ('Logs', 'InterOp'):
+                os.makedirs(os.path.join(run_dir, d))
+                for f in range(self.scale.raw_files_per_dir // 10):
+                    self._touch(os.path.join(run_dir, d, '%s_%s.log' % (d, f)))
+            self._touch(os.path.join(run_dir, 'RunInfo.xml'))
+
+            proc_id = 'run_%s_proc' % run_id
+            self.documents['runs'].append(
+                {
+                    'run_id': run_id,
+                    'aggregated': {
+                        'review_statuses': ['pass'],
+                        'most_recent_proc': {'proc_id': proc_id, 'status': 'finished'}
+                    }
+                }
+            )
+            self.documents['analysis_driver_procs'].append(
+                {'proc_id': proc_id, 'dataset_type': 'run', 'dataset_name': run_id, 'status': 'finished'}
+            )
+
+    def build_samples(self):
+        """
+        Per-lane fastqs of each sample in the fastq dirs of several runs, processed data in the project dirs, and
+        delivery batches hard-linked to both, as done at delivery.
+        """
+        sample_index = 0
+        for p in range(self.scale.nb_projects):
+            project_id = 'P%03d' % p
+            project_dir = os.path.join(self.dirs['processed_data'], project_id)
+            os.makedirs(project_dir)
+            self._touch(os.path.join(project_dir, project_id + '_genotype_gvcfs.vcf.gz'), self.scale.file_size)
+
+            for s in range(self.scale.samples_per_project):
+                sample_id = '%s_S%04d' % (project_id, s)
+                user_sample_id = 'user_' + sample_id
+                delivered_dir = os.path.join(self.dirs['delivered_data'], project_id, 'batch_%s' % (s % 3), sample_id)
+                os.makedirs(delivered_dir)
+                sample_files = []
+
+                for k in range(self.scale.lanes_per_sample):
+                    run_id = self.run_id((sample_index + k) % self.scale.nb_runs)
+                    lane = k % raw_lanes + 1
+                    fastq_dir = os.path.join(self.dirs['fastqs'], run_id, project_id, sample_id)
+                    os.makedirs(fastq_dir, exist_ok=True)
+                    for r in ('1', '2'):
+                        fastq = '%s_S1_L00%s_R%s_001.fastq.gz' % (sample_id, lane, r)
+                        sample_files.append(os.path.join(fastq_dir, fastq))
+                    self.documents['run_elements'].append(
+                        {
+                            'run_element_id': '%s_%s_%s' % (run_id, lane, sample_id), 'run_id': run_id, 'lane': lane,
+                            'barcode': 'ATGC', 'project_id': project_id, 'sample_id': sample_id,
+                            'useable': 'yes', 'useable_date': old_date
+                        }
+                    )
+
+                sample_dir = os.path.join(project_dir, sample_id)
+                os.makedirs(sample_dir)
+                sample_files.extend(os.path.join(sample_dir, user_sample_id + ext) for ext in processed_extensions)
+
+                for f in sample_files:
+                    self._touch(f, self.scale.file_size)
+                    os.link(f, os.path.join(delivered_dir, os.path.basename(f)))
+                self.archived_files.extend(sample_files)
+                self.documents['samples'].append(
+                    {
+                        'sample_id': sample_id, 'project_id': project_id, 'user_sample_id': user_sample_id,
+                        'useable': 'yes', 'delivered': 'yes', 'data_deleted': 'none'
+                    }
+                )
+                sample_index += 1
+
+        # files that final deletion removes when archiving the runs
+        for run_id in self.run_ids:
+            fastq_dir = os.path.join(self.dirs['fastqs'], run_id)
+            os.makedirs(fastq_dir, exist_ok=True)
+            for lane in range(1, raw_lanes + 1):
+                for name in ('Undetermined_S0_L00%s_R1_001.fastq.gz',
+                             'Undetermined_S0_L00%s_R1_001.fastq_discarded.gz'):
+                    self._touch(os.path.join(fastq_dir, name % lane), self.scale.file_size)
+
+    def build_dmf_filesystem(self, orphan_every=10):
+        """FID-named files over two levels of sub-directories, one in every orphan_every having no Lustre path."""
+        for i in range(self.scale.dmf_files):
+            fid = '0x2000%04x:0x%x:0x0' % (i % 256, i)
+            d = os.path.join(self.dirs['dmf_filesystem'], '%02x' % (i % 256), '%02x' % (i // 256 % 256))
+            os.makedirs(d, exist_ok=True)
+            self._touch(os.path.join(d, fid), self.scale.file_size // 10)
+            if i % orphan_every == 0:
+                self.orphan_fids.add(fid)
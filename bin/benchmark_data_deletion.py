@@ -0,0 +1,9 @@
+import sys
+import os.path
+
+
+if __name__ == '__main__':
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import benchmarks
+    sys.exit(benchmarks.main())
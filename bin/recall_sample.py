@@ -8,7 +8,9 @@ from egcg_core.exceptions import EGCGError
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config import cfg, load_config
-from data_deletion import ProcessedSample, get_file_list_size
+from data_deletion import ProcessedSample
+from data_deletion.disk_usage import get_disk_usage, get_reclaimable_space
+from data_deletion.hsm import HSMStates
 
 logging_default.add_stdout_handler()
 logger = logging_default.get_logger(__name__)
@@ -28,8 +30,10 @@ def main(argv=None):
 
 
 def file_states(sample_id):
-    s = ProcessedSample(rest_communication.get_document('samples', quiet=True,  where={'sample_id': sample_id}))
-    return {f: sorted(am.archive_states(f)) for f in s.raw_data_files + s.processed_data_files}
+    hsm_states = HSMStates()
+    sample_data = rest_communication.get_document('samples', quiet=True,  where={'sample_id': sample_id})
+    s = ProcessedSample(sample_data, hsm_states)
+    return {f: sorted(states) for f, states in hsm_states.query(s.archived_files).items()}
 
 
 def check(sample_id):
@@ -42,25 +46,28 @@ def check(sample_id):
     dirty_files = []
     for f in sorted(fstates):
         states = fstates[f]
-        if am.is_dirty(f, states):
+        if 'dirty' in states:
             dirty_files.append(f)
-        elif am.is_released(f, states):
+        elif 'released' in states:
             restorable_files.append(f)
-        elif am.is_archived(f, states):
+        elif 'archived' in states:
             unreleased_files.append(f)
         else:
             unarchived_files.append(f)
 
     msg_parts = [
-        '%s %s (%s Gb)' % (len(l), name, get_file_list_size(l) / 1000000000)
+        '%s %s (%s Gb)' % (len(l), name, get_disk_usage(l).total_size / 1000000000)
         for name, l in (
             ('restorable', restorable_files), ('unreleased', unreleased_files),
             ('unarchived', unarchived_files), ('dirty', dirty_files)
         )
-
-
     ]
     logger.info('Found %s files: %s', len(fstates), ', '.join(msg_parts))
+    reclaimable_space = get_reclaimable_space(sorted(fstates))
+    logger.info(
+        'Deleting these files would free %s Gb, plus %s Gb only unlinked as hard-linked elsewhere',
+        reclaimable_space.freed / 1000000000, reclaimable_space.unlinked / 1000000000
+    )
     return restorable_files, unreleased_files, unarchived_files, dirty_files
 
 
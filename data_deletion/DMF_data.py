@@ -1,8 +1,28 @@
 import os
+import sys
+import time
+import zlib
+import queue
 import errno
-import subprocess
+import threading
+from cached_property import cached_property
 from egcg_core.config import cfg
+from egcg_core.exceptions import EGCGError
 from data_deletion import Deleter
+from data_deletion.fid2path import FidLookup
+from data_deletion.fid_cache import FidCache, FOUND, ORPHAN
+from data_deletion.plan import DeletionPlan, stat_entry
+
+_end = object()  # marks the end of a stream of items in a pipeline queue
+delete_data_script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin', 'delete_data.py')
+
+
+def parse_shard(shard):
+    """Parse a shard given as 'i/N', with i from 1 to N."""
+    i, n = (int(x) for x in shard.split('/'))
+    if not 1 <= i <= n:
+        raise ValueError('Invalid shard: ' + shard)
+    return i, n
 
 
 class DMFDataDeleter(Deleter):
@@ -17,40 +37,318 @@ class DMFDataDeleter(Deleter):
             raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), self.dmf_file_system)
         if not os.path.exists(self.lustre_file_system):
             raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), self.lustre_file_system)
+        self.fid_lookup = FidLookup(
+            self.lustre_file_system, max_workers=cfg['data_deletion'].get('fid2path_workers'), throttle=self.throttle,
+            metrics=self.metrics
+        )
+        self.fid_batch_size = cfg['data_deletion'].get('fid2path_batch_size', 1000)
+        self.queue_size = cfg['data_deletion'].get('dmf_queue_size', 10000)
+        self.progress_interval = cfg['data_deletion'].get('progress_interval', 60)
+        self.lock = threading.Lock()
+        self.orphans_found = 0
+        self.bytes_reclaimed = 0
+        self.full_scan = self.cmd_args.full_scan
+        self.shard = self.cmd_args.shard
+        self.shards = self.cmd_args.shards
+        self.shard_engine = self.cmd_args.shard_engine
+        self.fid_cache = None
+        if cfg['data_deletion'].get('fid_cache'):
+            self.fid_cache = FidCache(
+                cfg['data_deletion']['fid_cache'], cfg['data_deletion'].get('fid_cache_reverify_days', 30) * 86400
+            )
 
     @staticmethod
-    def _get_cmd_output(cmd):
-        p = subprocess.Popen(cmd.split(' '), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        exit_status = p.wait()
-        o, e = p.stdout.read(), p.stderr.read()
-        p.stdout.close()
-        p.stderr.close()
-        return exit_status, o, e
-
-    def _has_no_lustre_path(self, fid):
-        exit_status, stdout, stderr = self._get_cmd_output('lfs fid2path %s %s' % (self.lustre_file_system, fid))
-        if exit_status == 2 and stdout == b'' and b'No such file or directory' in stderr:
-            return True
-        return False
+    def add_args(argparser):
+        Deleter.add_args(argparser)  # super() doesn't work when calling statically
+        argparser.add_argument('--full_scan', action='store_true',
+                               help='Check all FIDs against Lustre, including those recently found in the FID cache')
+        shards = argparser.add_mutually_exclusive_group()
+        shards.add_argument('--shard', type=parse_shard, default=None,
+                            help='Only scan shard i/N of the DMF filesystem and write its orphans to the work dir')
+        shards.add_argument('--shards', type=int, default=None,
+                            help='Scan the DMF filesystem with this many shards, then merge their results')
+        argparser.add_argument('--shard_engine', choices=('local', 'cluster'), default='local',
+                               help='Run the shards as local processes or as a cluster array job')
+
+    def _in_shard(self, name):
+        """Whether a top-level hash bucket of the DMF filesystem belongs to self.shard."""
+        i, n = self.shard
+        return zlib.crc32(name.encode()) % n == i - 1
+
+    def _scan(self):
+        """
+        Files of the DMF filesystem, listed one directory at a time with os.scandir. With --shard, only the top-level
+        entries of the shard are scanned.
+        """
+        dirs = [self.dmf_file_system]
+        while dirs:
+            d = dirs.pop()
+            with self.throttle.operation():
+                entries = list(os.scandir(d))
+            if self.shard and d == self.dmf_file_system:
+                entries = [e for e in entries if self._in_shard(e.name)]
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                else:
+                    yield entry
+
+    def _find_orphans(self, batch):
+        """
+        Check a batch of files against Lustre, skipping the FIDs recently found in the FID cache unless doing a full
+        scan, and record the verdicts in the cache.
+        :param list[os.DirEntry] batch:
+        :return: the FIDs with no Lustre path
+        :rtype: set[str]
+        """
+        # the name of files in DMF filesystem are fids
+        if not self.fid_cache:
+            return set(self.fid_lookup.find_orphans(e.name for e in batch))
+
+        with self.throttle.operation(len(batch)):
+            mtimes = dict((e.name, e.stat(follow_symlinks=False).st_mtime) for e in batch)
+        skipped = set() if self.full_scan else self.fid_cache.recently_found(mtimes)
+        self.metrics.count('fids_skipped', len(skipped))
+        to_check = [fid for fid in mtimes if fid not in skipped]
+        not_found = set(self.fid_lookup.find_orphans(to_check))
+        self.fid_cache.record([(fid, ORPHAN if fid in not_found else FOUND, mtimes[fid]) for fid in to_check])
+        return not_found
+
+    def iter_orphans(self):
+        """
+        Stream the files of the DMF filesystem with no Lustre path as they are found: a scandir producer thread puts
+        batches of files on a bounded queue, from which self.fid_lookup.max_workers threads check one batch at a time
+        with `lfs fid2path`, putting the orphans on another bounded queue. Memory use is therefore bounded whatever the
+        size of the filesystem, and scanning stops if the consumer stops.
+        :return: os.DirEntry of each orphan file
+        """
+        nb_checkers = self.fid_lookup.max_workers
+        batches = queue.Queue(maxsize=nb_checkers * 2)
+        orphans = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        errors = []
+
+        def _put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def _produce():
+            try:
+                batch = []
+                for entry in self._scan():
+                    batch.append(entry)
+                    if len(batch) == self.fid_batch_size:
+                        _put(batches, batch)
+                        batch = []
+                _put(batches, batch)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                for i in range(nb_checkers):
+                    _put(batches, _end)
+
+        def _check():
+            try:
+                while not stop.is_set():
+                    try:
+                        batch = batches.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    if batch is _end:
+                        break
+                    not_found = self._find_orphans(batch)
+                    with self.lock:
+                        self.file_checked += len(batch)
+                    for entry in batch:
+                        if entry.name in not_found:
+                            _put(orphans, entry)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                _put(orphans, _end)
+
+        threads = [threading.Thread(target=_produce)] + [threading.Thread(target=_check) for i in range(nb_checkers)]
+        for t in threads:
+            t.start()
+        try:
+            nb_finished = 0
+            while nb_finished < nb_checkers and not stop.is_set():
+                try:
+                    entry = orphans.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if entry is _end:
+                    nb_finished += 1
+                else:
+                    yield entry
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+        if errors:
+            raise errors[0]
 
     def find_files_to_delete(self):
-        file_to_delete = []
-        for path, subdirs, files in os.walk(self.dmf_file_system):
-            for name in files:
-                self.file_checked += 1
-                # the name of files in DMF filesystem are fids
-                if self._has_no_lustre_path(name):
-                    file_to_delete.append(os.path.join(path, name))
-        return file_to_delete
+        return [entry.path for entry in self.iter_orphans()]
+
+    def _report_progress(self, start):
+        elapsed = max(time.monotonic() - start, 0.001)
+        self.info(
+            'Checked %s files (%.1f files/s), found %s orphan files, %.2f G %s', self.file_checked,
+            self.file_checked / elapsed, self.orphans_found, self.bytes_reclaimed / 1000000000,
+            'reclaimable' if self.dry_run else 'reclaimed'
+        )
+
+    def _delete_orphans(self, orphans):
+        """
+        Delete orphan files as they come, unless in dry run, and report progress every self.progress_interval seconds.
+        :param orphans: path and size of each orphan file
+        """
+        start = last_report = time.monotonic()
+        deleted_fids = []
+        for path, size in orphans:
+            if not self.dry_run:
+                self.debug('Remove %s', path)
+                with self.throttle.operation():
+                    os.remove(path)
+                self.metrics.count('files_deleted')
+                self.metrics.count('bytes_deleted', size)
+                deleted_fids.append(os.path.basename(path))
+                if self.fid_cache and len(deleted_fids) >= self.fid_batch_size:
+                    self.fid_cache.forget(deleted_fids)
+                    deleted_fids = []
+            self.orphans_found += 1
+            self.bytes_reclaimed += size
+
+            if time.monotonic() - last_report >= self.progress_interval:
+                self._report_progress(start)
+                last_report = time.monotonic()
+        if self.fid_cache:
+            self.fid_cache.forget(deleted_fids)
+        self._report_progress(start)
+
+    def _sized_orphans(self):
+        for entry in self.iter_orphans():
+            with self.throttle.operation():
+                size = entry.stat(follow_symlinks=False).st_size
+            yield entry.path, size
+
+    @cached_property
+    def metrics_file(self):
+        if not self.shard:
+            return super().metrics_file
+        # shards run at the same time and share the log dir, so each needs its own metrics file
+        log_dir = cfg['data_deletion'].get('log_dir', self.work_dir)
+        return os.path.join(log_dir, '%s_metrics_shard_%s_of_%s_%s.json' % (self.alias, *self.shard, self._strnow()))
+
+    @cached_property
+    def shard_dir(self):
+        return os.path.join(self.work_dir, '.dmf_shards_' + self._strnow())
+
+    @staticmethod
+    def shard_file(work_dir, i, n):
+        return os.path.join(work_dir, 'dmf_orphans_%s_of_%s.tsv' % (i, n))
+
+    def _write_shard(self):
+        """
+        Write the path and size of each orphan file of self.shard to its shard file as they are found, followed by the
+        number of files checked, which marks the shard as complete.
+        """
+        shard_file = self.shard_file(self.work_dir, *self.shard)
+        with open(shard_file + '.tmp', 'w') as f:
+            for path, size in self._sized_orphans():
+                f.write('%s\t%s\n' % (path, size))
+            f.write('#files_checked\t%s\n' % self.file_checked)
+        os.rename(shard_file + '.tmp', shard_file)
+        self.info('Checked %s files of shard %s/%s', self.file_checked, *self.shard)
+
+    def _shard_cmd(self, i):
+        cmd = '%s %s dmf_deletion --shard %s/%s --work_dir %s' % (
+            sys.executable, delete_data_script, i, self.shards, self.shard_dir
+        )
+        if self.full_scan:
+            cmd += ' --full_scan'
+        return cmd
+
+    def _run_shards(self):
+        """Scan all shards at once, as local processes or as a cluster array job."""
+        os.makedirs(self.shard_dir)
+        with self.metrics.span('shards'):
+            self._execute(
+                *[self._shard_cmd(i) for i in range(1, self.shards + 1)],
+                cluster_execution=self.shard_engine == 'cluster'
+            )
+
+    def _merge_shards(self):
+        """
+        Read back the orphans found by all shards, checking that each shard completed.
+        :return: path and size of each orphan file
+        :rtype: list[tuple[str, int]]
+        """
+        orphans = []
+        incomplete_shards = []
+        for i in range(1, self.shards + 1):
+            shard_file = self.shard_file(self.shard_dir, i, self.shards)
+            if not os.path.isfile(shard_file):
+                incomplete_shards.append(i)
+                continue
+            with open(shard_file) as f:
+                for line in f:
+                    path, value = line.rstrip('\n').split('\t')
+                    if path == '#files_checked':
+                        self.file_checked += int(value)
+                    else:
+                        orphans.append((path, int(value)))
+
+        if incomplete_shards:
+            raise EGCGError(
+                '%s/%s shards did not complete: %s' % (len(incomplete_shards), self.shards, incomplete_shards)
+            )
+        self.info('Merged %s shards: %s files checked, %s orphan files', self.shards, self.file_checked, len(orphans))
+        return orphans
+
+    def _plan_files(self, files):
+        plan = DeletionPlan(self.alias, self._strnow())
+        for f in files:
+            plan.add(f, [stat_entry(f, self.throttle)])
+        self._save_plan(plan)
 
     def delete_data(self):
-        files_to_delete = self.find_files_to_delete()
-        self.info('Checked %s files and found %s orphan files for deletion in %s',
-                  self.file_checked, len(files_to_delete), self.dmf_file_system)
-        if not files_to_delete or self.dry_run:
+        if self.apply_plan:
+            orphans = [(item['key'], item['files'][0]['size']) for item in self._load_plan().items]
+            with self.metrics.span('delete_files'):
+                self._delete_orphans(orphans)
+            return 0
+
+        if self.shard:
+            with self.metrics.span('discovery'):
+                self._write_shard()
+            return 0
+
+        if self.shards:
+            self._run_shards()
+            orphans = self._merge_shards()
+        else:
+            orphans = None
+
+        if self.write_plan:
+            with self.metrics.span('discovery'):
+                if orphans is None:
+                    files_to_delete = self.find_files_to_delete()
+                else:
+                    files_to_delete = [path for path, size in orphans]
+            self.info('Checked %s files and found %s orphan files for deletion in %s',
+                      self.file_checked, len(files_to_delete), self.dmf_file_system)
+            self._plan_files(files_to_delete)
             return 0
 
-        # Actually remove the files
-        for f in files_to_delete:
-            self.debug('Remove %s', f)
-            os.remove(f)
+        with self.metrics.span('discover_and_delete_files'):
+            self._delete_orphans(self._sized_orphans() if orphans is None else orphans)
+        self.metrics.count('files_checked', self.file_checked)
+        return 0
@@ -1,16 +1,26 @@
 import sys
 import argparse
 import traceback
-from os import listdir, stat
-from os.path import join, isdir, expanduser
+from os import listdir, makedirs
+from os.path import join, isdir, islink, expanduser, dirname
 from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from cached_property import cached_property
 from egcg_core import app_logging, executor, clarity, rest_communication, util, notifications
-from egcg_core.archive_management import is_archived, is_released, ArchivingError
+from egcg_core.archive_management import ArchivingError
 from egcg_core.config import cfg
 from egcg_core.exceptions import EGCGError
 from egcg_core.constants import ELEMENT_SAMPLE_INTERNAL_ID, ELEMENT_PROJECT_ID, ELEMENT_SAMPLE_EXTERNAL_ID, \
     ELEMENT_RUN_NAME, ELEMENT_LANE
+from data_deletion.disk_usage import get_disk_usage, get_reclaimable_space
+from data_deletion.hsm import HSMStates
+from data_deletion.file_operations import move, delete_tree
+from data_deletion.throttling import Throttle
+from data_deletion.rest_queries import get_documents_in
+from data_deletion.delivered_index import DeliveredDataIndex
+from data_deletion.plan import DeletionPlan
+from data_deletion.metrics import Metrics
 
 
 def get_file_list_size(file_list):
@@ -18,16 +28,7 @@ def get_file_list_size(file_list):
     Get the total size of all files. Collapses them by inodes to avoid counting hard links more than once.
     Also descends into directories recursively.
     """
-    def files_by_inode(_file_list):
-        _inode2file = {}
-        for f in _file_list:
-            if isdir(f):
-                _inode2file.update(files_by_inode(join(f, s) for s in listdir(f)))
-            else:
-                _inode2file[stat(f).st_ino] = f
-        return _inode2file
-
-    return sum(stat(f).st_size for f in files_by_inode(file_list).values())
+    return get_disk_usage(file_list).total_size
 
 
 class Deleter(app_logging.AppLogger):
@@ -47,6 +48,20 @@ class Deleter(app_logging.AppLogger):
         self.dry_run = self.cmd_args.dry_run
         self.deletion_limit = self.cmd_args.deletion_limit
         self.manual_delete = self.cmd_args.manual_delete
+        self.write_plan = self.cmd_args.write_plan
+        self.apply_plan = self.cmd_args.apply_plan
+        # shared cap on metadata operations, so that deletions do not starve other users of the filesystem
+        self.throttle = Throttle.from_config(cfg['data_deletion'].get('throttling'))
+        # timings and counters of all phases and sub-operations, reported at the end of self.run
+        self.metrics = Metrics()
+        self.hsm_states = HSMStates(throttle=self.throttle, metrics=self.metrics)
+        self.move_workers = cfg['data_deletion'].get('move_workers', 8)
+        self.delete_engine = self.cmd_args.delete_engine
+        self.delete_workers = cfg['data_deletion'].get('delete_workers', 8)
+        self.cluster_delete_jobs = cfg['data_deletion'].get('cluster_delete_jobs', 16)
+        self.delete_throttle = Throttle(self.cmd_args.max_delete_rate, parent=self.throttle)
+        self.rest_query_size = cfg['data_deletion'].get('rest_query_size', 100)
+        self.rest_workers = cfg['data_deletion'].get('rest_workers', 4)
         self.ntf = notifications.NotificationCentre('%s at %s' % (self.__class__.__name__, self._strnow()))
 
     @staticmethod
@@ -58,6 +73,13 @@ class Deleter(app_logging.AppLogger):
         argparser.add_argument('--work_dir', default=expanduser('~'))
         argparser.add_argument('--deletion_limit', type=int, default=None)
         argparser.add_argument('--manual_delete', type=str, nargs='+', default=[])
+        argparser.add_argument('--delete_engine', choices=('cluster', 'local-parallel'), default='cluster')
+        argparser.add_argument('--max_delete_rate', type=float, default=None,
+                               help='Maximum number of files unlinked per second by the local-parallel engine')
+        argparser.add_argument('--write_plan', type=str, default=None,
+                               help='Write what would be deleted to this plan file instead of deleting anything')
+        argparser.add_argument('--apply_plan', type=str, default=None,
+                               help='Delete what a plan file lists, after checking that its files have not changed')
 
     @cached_property
     def deletion_dir(self):  # need caching because of reference to datetime.now
@@ -65,17 +87,117 @@ class Deleter(app_logging.AppLogger):
 
     def delete_dir(self, d):
         self.debug('Removing dir %s containing: %s', d, listdir(d))
-        self._execute('rm -rfv ' + d, cluster_execution=True)
+        with self.metrics.span('delete_dir'):
+            self._delete_dir(d)
+
+    def _delete_dir(self, d):
+        if self.delete_engine == 'local-parallel':
+            stats = delete_tree(
+                d, max_workers=self.delete_workers, throttle=self.throttle, unlink_throttle=self.delete_throttle
+            )
+            self.metrics.count('files_deleted', stats.nb_files)
+            self.metrics.count('bytes_deleted', stats.total_size)
+            duration = max(stats.duration, 0.001)
+            self.info(
+                'Deleted %s files (%.2f G) in %.1fs: %.1f files/s, %.2f M/s', stats.nb_files,
+                stats.total_size / 1000000000, stats.duration, stats.nb_files / duration,
+                stats.total_size / duration / 1000000
+            )
+        else:
+            self._cluster_delete_dir(d)
+
+    def _cluster_delete_dir(self, d):
+        """
+        Delete a directory with an array job: the paths two levels down (e.g. the Data/Logs/Thumbnail_Images folders
+        of each run) are split round-robin across up to self.cluster_delete_jobs `rm -rf` commands, then the remaining
+        empty directories are removed locally. The array job itself is not covered by self.throttle.
+        """
+        paths = []
+        for top_level in sorted(listdir(d)):
+            top_level = join(d, top_level)
+            if isdir(top_level) and not islink(top_level):
+                paths.extend(join(top_level, x) for x in sorted(listdir(top_level)))
+            else:
+                paths.append(top_level)
+
+        if paths:
+            nb_jobs = min(len(paths), self.cluster_delete_jobs)
+            self._execute(*['rm -rf ' + ' '.join(paths[i::nb_jobs]) for i in range(nb_jobs)], cluster_execution=True)
+        delete_tree(d, throttle=self.throttle)
 
-    def _execute(self, cmd, cluster_execution=False):
+    def _execute(self, *cmds, cluster_execution=False):
+        self.metrics.count('subprocesses', len(cmds))
         if not cluster_execution:
-            e = executor.local_execute(cmd)
+            e = executor.local_execute(*cmds)
         else:
-            e = executor.cluster_execute(cmd, job_name='data_deletion', cpus=1, mem=2, working_dir=self.work_dir)
+            e = executor.cluster_execute(*cmds, job_name='data_deletion', cpus=1, mem=2, working_dir=self.work_dir)
 
-        status = e.join()
+        with self.metrics.span('cluster_execute' if cluster_execution else 'execute'):
+            status = e.join()
         if status:
-            raise EGCGError('Command failed: ' + cmd)
+            raise EGCGError('Command failed: ' + '; '.join(cmds))
+
+    def _mkdir(self, d):
+        with self.throttle.operation():
+            self._execute('mkdir -p ' + d)
+
+    def move_files(self, moves):
+        """
+        Move files or directories in-process, with up to self.move_workers moves running at once.
+        :param list[tuple[str, str]] moves: (source, full destination path) pairs
+        :return: manifest of source -> destination for all files moved
+        :rtype: dict[str, str]
+        """
+        def _move(source, dest):
+            try:
+                with self.throttle.operation():
+                    return move(source, dest)
+            except OSError as e:
+                self.error('Could not move %s to %s: %s', source, dest, e)
+
+        with self.metrics.span('move'), ThreadPoolExecutor(max_workers=self.move_workers) as pool:
+            dests = list(pool.map(lambda m: _move(*m), moves))
+        self.metrics.count('files_moved', len(moves))
+
+        failures = [source for (source, dest), moved in zip(moves, dests) if moved is None]
+        if failures:
+            raise EGCGError('Could not move %s files: %s' % (len(failures), failures))
+        return dict(moves)
+
+    def _get_documents_in(self, endpoint, field, values, where=None):
+        values = list(values)
+        # number of `$in` queries, each fetching one or more pages: other Rest API and Lims calls are not counted here
+        self.metrics.count('rest_in_queries', -(-len(set(values)) // self.rest_query_size))
+        with self.metrics.span('rest_queries'):
+            return get_documents_in(
+                endpoint, field, values, chunk_size=self.rest_query_size, max_workers=self.rest_workers, where=where
+            )
+
+    def _prefetch_run_elements(self, samples):
+        """
+        Fetch the run elements of all samples with a few concurrent bulk queries, and cache them on each sample
+        instead of letting each sample query its own.
+        """
+        run_elements = defaultdict(list)
+        for e in self._get_documents_in('run_elements', ELEMENT_SAMPLE_INTERNAL_ID, [s.sample_id for s in samples]):
+            run_elements[e[ELEMENT_SAMPLE_INTERNAL_ID]].append(e)
+        for s in samples:
+            s.set_run_elements(run_elements[s.sample_id])
+
+    def _save_plan(self, plan):
+        plan.save(self.write_plan)
+        self.info(
+            'Wrote a plan to delete %s items (%.2f G) to %s', len(plan.items), plan.total_size / 1000000000,
+            self.write_plan
+        )
+
+    def _load_plan(self):
+        """Load the plan given with --apply_plan, and check with one stat per file that nothing changed since."""
+        plan = DeletionPlan.load(self.apply_plan, self.alias)
+        with self.metrics.span('validate_plan'):
+            plan.validate(max_workers=self.move_workers, throttle=self.throttle)
+        self.info('Applying a plan written at %s to delete %s items', plan.created, len(plan.items))
+        return plan
 
     def _compare_lists(self, observed, expected, error_message='List comparison mismatch:'):
         observed = sorted(observed)
@@ -101,22 +223,53 @@ class Deleter(app_logging.AppLogger):
         """
         raise NotImplementedError
 
+    @cached_property
+    def metrics_file(self):
+        log_dir = cfg['data_deletion'].get('log_dir', self.work_dir)
+        return join(log_dir, '%s_metrics_%s.json' % (self.alias, self._strnow()))
+
+    def report_metrics(self):
+        """Log a summary table of the metrics recorded so far and save them as JSON in the log dir."""
+        summary = self.metrics.summary()
+        self.info('Deletion metrics:\n%s', summary)
+        try:
+            makedirs(dirname(self.metrics_file), exist_ok=True)
+            self.metrics.save(self.metrics_file)
+        except OSError as e:
+            self.error('Could not save metrics to %s: %s', self.metrics_file, e)
+        return summary
+
     def run(self):
-        """Runs self.delete_data with exception handling and notifications."""
+        """Runs self.delete_data with exception handling, notifications and a report of the metrics recorded."""
         try:
-            self.delete_data()
+            with self.metrics.span('delete_data'):
+                self.delete_data()
         except Exception as e:
             etype, value, tb = sys.exc_info()
             stacktrace = ''.join(traceback.format_exception(etype, value, tb))
             self.critical('Encountered a %s exception: %s. Stacktrace below:\n%s', e.__class__.__name__, e, stacktrace)
-            self.ntf.notify_all(stacktrace)
+            self.ntf.notify_all(stacktrace + '\nMetrics up to the failure:\n' + self.report_metrics())
             executor.stop_running_jobs()
             sys.exit(9)
+        self.report_metrics()
 
 
 class ProcessedSample(app_logging.AppLogger):
-    def __init__(self, sample_data):
+    # properties saved in a DeletionJournal once a sample has been discovered, so a resumed deletion does not recompute
+    journalled_properties = ('run_elements', 'released_data_folder', 'archived_files', 'files_to_purge',
+                             'files_to_remove_from_lustre', 'size_of_files', 'bytes_freed', 'bytes_unlinked')
+
+    def __init__(self, sample_data, hsm_states=None, throttle=None, delivered_data_index=None):
+        """
+        :param dict sample_data:
+        :param HSMStates hsm_states: HSM state cache to share with other samples, e.g. the one of a Deleter
+        :param Throttle throttle: cap on filesystem metadata operations to share with other samples
+        :param DeliveredDataIndex delivered_data_index: index of delivered folders to share with other samples
+        """
         self.sample_data = sample_data
+        self.hsm_states = hsm_states if hsm_states is not None else HSMStates()
+        self.throttle = throttle or Throttle()
+        self.delivered_data_index = delivered_data_index or DeliveredDataIndex(throttle=self.throttle)
 
     @cached_property
     def release_date(self):
@@ -149,6 +302,10 @@ class ProcessedSample(app_logging.AppLogger):
             'run_elements', quiet=True, where={ELEMENT_SAMPLE_INTERNAL_ID: self.sample_id}, all_pages=True
         )
 
+    def set_run_elements(self, run_elements):
+        """Cache run elements fetched in bulk for several samples, so that self.run_elements does not query them."""
+        self.__dict__['run_elements'] = run_elements
+
     @cached_property
     def raw_data_files(self):
         all_fastqs = []
@@ -183,12 +340,7 @@ class ProcessedSample(app_logging.AppLogger):
 
     @cached_property
     def released_data_folder(self):
-        release_folders = util.find_files(
-            cfg['data_deletion']['delivered_data'],
-            self.project_id,
-            '*',
-            clarity.get_sample(self.sample_id).udf.get('2D Barcode') or self.sample_id
-        )
+        release_folders = self.delivered_data_index.released_data_folders(self.project_id, self.sample_id)
 
         if len(release_folders) != 1:
             self.warning(
@@ -201,53 +353,86 @@ class ProcessedSample(app_logging.AppLogger):
             return release_folders[0]
 
     @cached_property
-    def files_to_purge(self):
+    def released_files(self):
         if self.released_data_folder:
             return util.find_files(self.released_data_folder, '*')
         return []
 
     @cached_property
-    def files_to_remove_from_lustre(self):
-        _files_to_remove_from_lustre = []
-        raw_files = self.raw_data_files
-        if raw_files:
-            _files_to_remove_from_lustre.extend(raw_files)
+    def files_to_purge(self):
+        return self.released_files
 
-        processed_files = self.processed_data_files
-        if processed_files:
-            _files_to_remove_from_lustre.extend(processed_files)
+    @cached_property
+    def archived_files(self):
+        """Files expected to be archived to tape, whose HSM states need checking before deletion."""
+        return self.raw_data_files + self.processed_data_files
 
-        unarchived_files = [f for f in _files_to_remove_from_lustre if not is_archived(f)]
+    @cached_property
+    def files_to_remove_from_lustre(self):
+        _files_to_remove_from_lustre = self.archived_files
+        self.hsm_states.query(_files_to_remove_from_lustre)
+        unarchived_files = [f for f in _files_to_remove_from_lustre if not self.hsm_states.is_archived(f)]
         if unarchived_files:
             raise ArchivingError('Unarchived files cannot be released from Lustre: %s' % unarchived_files)
         return _files_to_remove_from_lustre
 
     @cached_property
     def size_of_files(self):
-        return get_file_list_size(self.files_to_purge) + get_file_list_size(self.files_to_remove_from_lustre)
+        return self.reclaimable_space.total_size
+
+    @cached_property
+    def reclaimable_space(self):
+        """Sizes and space given back of the files to purge and to remove from Lustre, from a single stat of each."""
+        return get_reclaimable_space(self.files_to_purge, self.files_to_remove_from_lustre, throttle=self.throttle)
+
+    @cached_property
+    def bytes_freed(self):
+        """Space given back by deleting and releasing the sample's files, counting hard links kept elsewhere."""
+        return self.reclaimable_space.freed
+
+    @cached_property
+    def bytes_unlinked(self):
+        """Space of the files to delete that stays allocated because of hard links outside the deletion."""
+        return self.reclaimable_space.unlinked
+
+    def deletion_patch(self):
+        """The Rest API patch marking the sample as deleted, as (endpoint, payload, id field, id value)."""
+        return 'samples', {'data_deleted': 'on lustre'}, 'sample_id', self.sample_id
 
     def mark_as_deleted(self):
-        rest_communication.patch_entry('samples', {'data_deleted': 'on lustre'}, 'sample_id', self.sample_id)
+        rest_communication.patch_entry(*self.deletion_patch())
+
+    def journal_data(self):
+        data = {'sample_data': self.sample_data}
+        data.update((p, getattr(self, p)) for p in self.journalled_properties)
+        return data
+
+    @classmethod
+    def from_journal(cls, data, *args, **kwargs):
+        """
+        Rebuild a sample from its journal_data, as saved in a journal or plan, without recomputing its file lists.
+        Properties missing from journals written by older versions are recomputed when needed.
+        """
+        sample = cls(data['sample_data'], *args, **kwargs)
+        sample.__dict__.update((p, data[p]) for p in cls.journalled_properties if p in data)
+        return sample
 
     def __repr__(self):
         return self.sample_id + ' (%s)' % self.release_date
 
 
 class FinalSample(ProcessedSample):
-    @cached_property
-    def files_to_purge(self):
-        _files_to_purge = []
-        if self.released_data_folder:
-            _files_to_purge.extend(util.find_files(self.released_data_folder, '*'))
-        raw_files = self.raw_data_files
-        if raw_files:
-            _files_to_purge.extend(raw_files)
+    journalled_properties = ('run_elements', 'released_data_folder', 'archived_files', 'files_to_purge')
 
-        processed_files = self.processed_data_files
-        if processed_files:
-            _files_to_purge.extend(processed_files)
+    @cached_property
+    def archived_files(self):
+        return self.released_files + self.raw_data_files + self.processed_data_files
 
-        unreleased_files = [f for f in _files_to_purge if not is_released(f)]
+    @cached_property
+    def files_to_purge(self):
+        _files_to_purge = self.archived_files
+        self.hsm_states.query(_files_to_purge)
+        unreleased_files = [f for f in _files_to_purge if not self.hsm_states.is_released(f)]
         if unreleased_files:
             raise ArchivingError('Files not yet removed from Lustre cannot be removed from tape: %s' % unreleased_files)
 
@@ -257,5 +442,5 @@ class FinalSample(ProcessedSample):
     def files_to_remove_from_lustre(self):
         return []
 
-    def mark_as_deleted(self):
-        rest_communication.patch_entry('samples', {'data_deleted': 'all'}, 'sample_id', self.sample_id)
+    def deletion_patch(self):
+        return 'samples', {'data_deleted': 'all'}, 'sample_id', self.sample_id
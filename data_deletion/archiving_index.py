@@ -0,0 +1,94 @@
+from collections import namedtuple, defaultdict
+from egcg_core.app_logging import AppLogger
+from egcg_core.constants import ELEMENT_RUN_NAME, ELEMENT_SAMPLE_INTERNAL_ID, ELEMENT_PROJECT_ID
+
+ArchivingReport = namedtuple(
+    'ArchivingReport', ('archivable_runs', 'archivable_projects', 'blocked_runs', 'blocked_projects')
+)
+
+
+class ArchivingIndex(AppLogger):
+    """
+    Index of the samples in each run and project, with their data_deleted states, built from a few bulk Rest API
+    queries and shared by a deletion run. Runs and projects can be archived once all their samples are fully deleted,
+    so the index tells which of them a deletion batch makes archivable and which samples block the others.
+    """
+    def __init__(self, get_documents_in):
+        """
+        :param get_documents_in: function querying an endpoint for the documents whose field is in a list of values,
+                                 e.g. Deleter._get_documents_in
+        """
+        self.get_documents_in = get_documents_in
+        self.sample_states = {}
+        self.run_samples = {}
+        self.project_samples = {}
+
+    def add(self, run_ids=(), project_ids=()):
+        """Fetch the samples of the runs and projects not indexed yet, with their data_deleted states."""
+        run_ids = sorted(set(r for r in run_ids if r not in self.run_samples))
+        project_ids = sorted(set(p for p in project_ids if p not in self.project_samples))
+        run_samples = defaultdict(set)
+        project_samples = defaultdict(set)
+
+        if run_ids:
+            for e in self.get_documents_in('run_elements', ELEMENT_RUN_NAME, run_ids):
+                # remove the unassigned barcode for pooling runs
+                if e[ELEMENT_SAMPLE_INTERNAL_ID] != 'Undetermined':
+                    run_samples[e[ELEMENT_RUN_NAME]].add(e[ELEMENT_SAMPLE_INTERNAL_ID])
+        if project_ids:
+            for s in self.get_documents_in('samples', ELEMENT_PROJECT_ID, project_ids):
+                project_samples[s[ELEMENT_PROJECT_ID]].add(s['sample_id'])
+                self.sample_states[s['sample_id']] = s.get('data_deleted')
+
+        # samples of the runs that belong to other projects
+        unindexed = set().union(*run_samples.values()).difference(self.sample_states)
+        if unindexed:
+            for s in self.get_documents_in('samples', 'sample_id', sorted(unindexed)):
+                self.sample_states[s['sample_id']] = s.get('data_deleted')
+
+        for r in run_ids:
+            self.run_samples[r] = run_samples[r]
+        for p in project_ids:
+            self.project_samples[p] = project_samples[p]
+
+    def mark_deleted(self, sample_ids):
+        for s in sample_ids:
+            self.sample_states[s] = 'all'
+
+    def _blocking_samples(self, sample_ids, deleted=()):
+        return sorted(s for s in sample_ids if self.sample_states.get(s) != 'all' and s not in deleted)
+
+    def run_blockers(self, run_id, deleted=()):
+        """
+        :param deleted: samples to consider fully deleted, e.g. the samples of a deletion batch
+        :return: the samples of a run that are not fully deleted. Samples not found in the Rest API block it too.
+        :rtype: list[str]
+        """
+        if run_id not in self.run_samples:
+            self.add(run_ids=[run_id])
+        return self._blocking_samples(self.run_samples[run_id], deleted)
+
+    def project_blockers(self, project_id, deleted=()):
+        if project_id not in self.project_samples:
+            self.add(project_ids=[project_id])
+        return self._blocking_samples(self.project_samples[project_id], deleted)
+
+    def report(self, deleted=()):
+        """
+        :param deleted: samples to consider fully deleted
+        :return: the indexed runs and projects that can be archived once these samples are deleted, and the samples
+                 blocking the others
+        :rtype: ArchivingReport
+        """
+        deleted = set(deleted)
+        blocked_runs = dict((r, self.run_blockers(r, deleted)) for r in sorted(self.run_samples))
+        blocked_projects = dict((p, self.project_blockers(p, deleted)) for p in sorted(self.project_samples))
+        return ArchivingReport(
+            [r for r, blockers in blocked_runs.items() if not blockers],
+            [p for p, blockers in blocked_projects.items() if not blockers],
+            dict((r, blockers) for r, blockers in blocked_runs.items() if blockers),
+            dict((p, blockers) for p, blockers in blocked_projects.items() if blockers)
+        )
+
+    def state(self, sample_id):
+        return self.sample_states.get(sample_id)
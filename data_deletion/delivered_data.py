@@ -1,40 +1,134 @@
 import os
 import uuid
 from datetime import datetime
-from egcg_core import rest_communication
+from concurrent.futures import ThreadPoolExecutor
+from cached_property import cached_property
+from egcg_core.config import cfg
+from egcg_core.constants import ELEMENT_SAMPLE_INTERNAL_ID
+from egcg_core.exceptions import ArchivingError, EGCGError
 from data_deletion import Deleter, ProcessedSample
-from egcg_core.archive_management import release_file_from_lustre
+from data_deletion.delivered_index import DeliveredDataIndex
+from data_deletion.journal import DeletionJournal
+from data_deletion.plan import DeletionPlan, stat_entry
 
 
 class DeliveredDataDeleter(Deleter):
     alias = 'delivered_data'
+    sample_class = ProcessedSample
 
     def __init__(self, cmd_args):
         super().__init__(cmd_args)
         self.limit_samples = self.cmd_args.sample_ids
+        self.resume = self.cmd_args.resume
+        self.release_workers = cfg['data_deletion'].get('hsm_release_workers', 4)
+        self.discovery_workers = cfg['data_deletion'].get('discovery_workers', 8)
+        self.delivered_data_index = DeliveredDataIndex(throttle=self.throttle, metrics=self.metrics)
 
     @staticmethod
     def add_args(argparser):
         Deleter.add_args(argparser)  # super() doesn't work when calling statically
         argparser.add_argument('--sample_ids', type=str, nargs='+', default=[])
+        argparser.add_argument('--resume', type=str, default=None,
+                               help='Journal of an interrupted deletion to resume from its last checkpoint')
+
+    @cached_property
+    def deletion_dir(self):
+        if self.resume:
+            return self.journal.deletion_dir
+        return super().deletion_dir
+
+    @cached_property
+    def journal(self):
+        """Journal of the phases each sample went through, next to the deletion dir unless resuming with --resume."""
+        if self.resume:
+            return DeletionJournal(self.resume, read_only=self.dry_run)
+        return DeletionJournal(self.deletion_dir + '.journal', read_only=self.dry_run)
 
     def _manually_deletable_samples(self):
-        max_query = 20
-        samples = []
-        for start in range(0, len(self.manual_delete), max_query):
-            samples.extend(
-                rest_communication.get_documents(
-                    'samples',
-                    quiet=True,
-                    where={'$or': [{'sample_id': s} for s in self.manual_delete[start:start + max_query]]},
-                    all_pages=True
-                )
-            )
+        """
+        Fetch the samples given with --manual_delete with concurrent `$in` queries of rest_query_size samples, and
+        warn about those not found in the Rest API.
+        """
+        samples = self._get_documents_in('samples', ELEMENT_SAMPLE_INTERNAL_ID, self.manual_delete)
+        found = set(s[ELEMENT_SAMPLE_INTERNAL_ID] for s in samples)
+        not_found = sorted(set(self.manual_delete).difference(found))
+        if not_found:
+            self.metrics.count('samples_not_found', len(not_found))
+            self.warning('%s requested samples were not found: %s', len(not_found), not_found)
         return samples
 
     def deletable_samples(self):
-        samples = [ProcessedSample(s) for s in self._manually_deletable_samples()]
-        return sorted(samples + self._auto_deletable_samples(), key=lambda e: e.sample_data['sample_id'])
+        samples = [
+            ProcessedSample(s, self.hsm_states, self.throttle, self.delivered_data_index)
+            for s in self._manually_deletable_samples()
+        ]
+        samples += self._auto_deletable_samples()
+        self._prefetch(samples)
+        return sorted(samples, key=lambda e: e.sample_data['sample_id'])
+
+    def _samples_to_delete(self):
+        """
+        The samples chosen by a resumed deletion, the samples of the plan given with --apply_plan, or newly found
+        deletable samples.
+        """
+        if self.resume:
+            return self._resumed_samples()
+
+        if self.apply_plan:
+            plan = self._load_plan()
+            # the files have not changed since the plan was written, so neither have their HSM states
+            for item in plan.items:
+                self.hsm_states.states.update((f['path'], f['hsm_state']) for f in item['files'] if 'hsm_state' in f)
+            return [self._from_journal(item['data']) for item in plan.items]
+
+        deletable_samples = self.deletable_samples()
+        if self.limit_samples:
+            deletable_samples = [s for s in deletable_samples if s.sample_id in self.limit_samples]
+        return deletable_samples
+
+    def _from_journal(self, data):
+        return self.sample_class.from_journal(data, self.hsm_states, self.throttle, self.delivered_data_index)
+
+    def _resumed_samples(self):
+        """
+        Rebuild the samples a resumed deletion had discovered from its journal, and fetch again those it had chosen
+        but not discovered yet.
+        """
+        chosen = self.journal.data('chosen', 'deletion')
+        discovered = self.journal.keys('discovered')
+        if not chosen and not discovered:
+            raise EGCGError('No samples to resume in journal %s' % self.resume)
+
+        samples = dict((k, self._from_journal(self.journal.data('discovered', k))) for k in discovered)
+        sample_ids = chosen['sample_ids'] if chosen else discovered
+        undiscovered = [i for i in sample_ids if i not in samples]
+        if undiscovered:
+            self.info('Fetching %s samples chosen but not discovered before the interruption', len(undiscovered))
+            fetched = [
+                self.sample_class(s, self.hsm_states, self.throttle, self.delivered_data_index)
+                for s in self._get_documents_in('samples', ELEMENT_SAMPLE_INTERNAL_ID, undiscovered)
+            ]
+            self._prefetch(fetched)
+            samples.update((s.sample_id, s) for s in fetched)
+
+        missing = [i for i in sample_ids if i not in samples]
+        if missing:
+            raise EGCGError('Could not find %s chosen samples to resume: %s' % (len(missing), missing))
+        return [samples[i] for i in sample_ids]
+
+    def _start_journal(self, samples):
+        """
+        Start the journal and record the samples chosen before discovering them, so that a deletion interrupted
+        during discovery resumes with the same samples.
+        """
+        self.journal.start(self.alias, self.deletion_dir)
+        if not self.journal.done('chosen', 'deletion'):
+            self.journal.record('chosen', 'deletion', {'sample_ids': [s.sample_id for s in samples]})
+
+    def _prefetch(self, samples):
+        """Fetch the samples' run elements and Lims 2D barcodes in bulk rather than one sample at a time."""
+        self._prefetch_run_elements(samples)
+        self.delivered_data_index.resolve_barcodes(s.sample_id for s in samples)
 
     def _auto_deletable_samples(self):
         return []
@@ -53,41 +147,146 @@ class DeliveredDataDeleter(Deleter):
         #         samples.append(s)
         # return samples
 
-    def _move_to_unique_file_name(self, source, dest_dir):
-        source_name = os.path.basename(source)
-        dest = os.path.join(dest_dir, str(uuid.uuid4()) + '_' + source_name)
-        self._execute('mv %s %s' % (source, dest))
+    @staticmethod
+    def _unique_file_name(source, dest_dir):
+        return os.path.join(dest_dir, str(uuid.uuid4()) + '_' + os.path.basename(source))
+
+    def _move_to_unique_file_names(self, sources, dest_dir, journal_key=None):
+        """
+        Move files into dest_dir under unique names, so that files with the same name from different folders do not
+        overwrite each other. With a journal_key, the planned moves are journalled before moving anything, and an
+        interrupted staging is resumed by only moving the files still at their source.
+        :return: manifest of source -> destination
+        """
+        staging = self.journal.data('staging', journal_key) if journal_key else None
+        if staging:
+            manifest = staging['manifest']
+            self.move_files([(f, dest) for f, dest in manifest.items() if os.path.lexists(f)])
+        else:
+            manifest = dict((f, self._unique_file_name(f, dest_dir)) for f in sources)
+            if journal_key:
+                self.journal.record('staging', journal_key, {'manifest': manifest})
+            self.move_files(list(manifest.items()))
+
+        self._compare_lists(
+            os.listdir(dest_dir),
+            [os.path.basename(f) for f in manifest.values()],
+            'Files staged in %s do not match the files moved:' % dest_dir
+        )
+        if journal_key:
+            self.journal.record('staged', journal_key)
+        return manifest
+
+    def _for_each_sample(self, func, samples):
+        """
+        Call func on up to self.discovery_workers samples at once, for read-only work such as finding, checking and
+        sizing files. Each sample is handled by a single thread, so its cached properties are computed once.
+        :return: the results of func, in sample order
+        """
+        with ThreadPoolExecutor(max_workers=self.discovery_workers) as pool:
+            return list(pool.map(func, samples))
+
+    def _discover(self, samples):
+        """
+        Find the samples' files concurrently, query the HSM states of all their archived files at once, then check
+        and size them concurrently.
+        :return: the journal_data of each sample, in order
+        """
+        with self.metrics.span('find_files'):
+            self._for_each_sample(lambda s: s.archived_files, samples)
+        self._query_hsm_states(samples)
+        with self.metrics.span('find_and_size_files'):
+            return self._for_each_sample(lambda s: s.journal_data(), samples)
+
+    def _record_discovered(self, samples):
+        """
+        Discover the samples not journalled yet, then journal their file lists and sizes one at a time, so that
+        resuming does not recompute them.
+        """
+        samples = [s for s in samples if not self.journal.done('discovered', s.sample_id)]
+        if self.apply_plan:
+            # planned samples were discovered when the plan was written, and rebuilt from it
+            sample_data = [s.journal_data() for s in samples]
+        else:
+            sample_data = self._discover(samples)
+        for s, data in zip(samples, sample_data):
+            self.journal.record('discovered', s.sample_id, data)
+
+    def _stage_sample(self, sample):
+        """Move a sample's files to purge to its folder in the deletion dir, unless the journal has them staged."""
+        if len(sample.files_to_purge) and not self.journal.done('staged', sample.sample_id):
+            deletable_data_dir = os.path.join(self.deletion_dir, sample.sample_id)
+            self._mkdir(deletable_data_dir)
+            self._move_to_unique_file_names(sample.files_to_purge, deletable_data_dir, journal_key=sample.sample_id)
+
+    def _query_hsm_states(self, samples):
+        """Query the HSM states of all the samples' archived files in as few `lfs hsm_state` calls as possible."""
+        self.hsm_states.query(f for s in samples for f in s.archived_files)
+
+    def release_files_from_lustre(self, files):
+        """
+        Release files from Lustre in batches of concurrent `lfs hsm_release` calls. In dry run mode, only log the
+        commands that would be run.
+        """
+        if not files:
+            return
+
+        if self.dry_run:
+            for cmd in self.hsm_states.release_commands(files):
+                self.info('Will run: %s', ' '.join(cmd))
+            return
+
+        failures = self.hsm_states.release(files, max_workers=self.release_workers)
+        if failures:
+            for f in sorted(failures):
+                self.error('Could not release %s from Lustre: %s', f, failures[f])
+            raise ArchivingError('%s files could not be released from Lustre' % len(failures))
 
     def setup_samples_for_deletion(self, samples):
         total_size_to_delete = 0
+        total_bytes_freed = 0
+        total_bytes_unlinked = 0
+        files_to_release = []
+        self._record_discovered(samples)
 
         for s in samples:
             total_size_to_delete += s.size_of_files
+            total_bytes_freed += s.bytes_freed
+            total_bytes_unlinked += s.bytes_unlinked
             deletable_data_dir = os.path.join(self.deletion_dir, s.sample_id)
+            if not self.journal.done('released', s.sample_id):
+                files_to_release.extend(s.files_to_remove_from_lustre)
 
             if not self.dry_run:
-                if len(s.files_to_purge):
-                    self._execute('mkdir -p ' + deletable_data_dir)
-                    for f in s.files_to_purge:
-                        self._move_to_unique_file_name(f, deletable_data_dir)
-                if len(s.files_to_remove_from_lustre):
-                    for f in s.files_to_remove_from_lustre:
-                        release_file_from_lustre(f)
+                self._stage_sample(s)
             else:
                 self.info(
-                    'Sample %s has %s files to delete and %s files to remove from Lustre (%.2f G)\n%s\n%s',
+                    'Sample %s has %s files to delete and %s files to remove from Lustre (%.2f G, %.2f G freed, '
+                    '%.2f G only unlinked)\n%s\n%s',
                     s,
                     len(s.files_to_purge),
                     len(s.files_to_remove_from_lustre),
                     s.size_of_files/1000000000,
+                    s.bytes_freed/1000000000,
+                    s.bytes_unlinked/1000000000,
                     '\n'.join(s.files_to_purge),
                     '\n'.join(s.files_to_remove_from_lustre)
                 )
                 if len(s.files_to_purge):
                     self.info('Will run: mv %s %s', ' '.join(s.files_to_purge), deletable_data_dir)
-                if len(s.files_to_remove_from_lustre):
-                    self.info('Will run: %s', '\n'.join(['lfs hsm_release %s' % f for f in s.files_to_remove_from_lustre]))
-        self.info('Will delete %.2f G of data', total_size_to_delete / 1000000000)
+
+        self.release_files_from_lustre(files_to_release)
+        if not self.dry_run:
+            for s in samples:
+                if not self.journal.done('released', s.sample_id):
+                    self.journal.record('released', s.sample_id)
+        self.metrics.count('bytes_to_delete', total_size_to_delete)
+        self.metrics.count('bytes_to_free', total_bytes_freed)
+        self.metrics.count('bytes_only_unlinked', total_bytes_unlinked)
+        self.info(
+            'Will delete %.2f G of data: %.2f G freed, %.2f G only unlinked as hard-linked elsewhere',
+            total_size_to_delete / 1000000000, total_bytes_freed / 1000000000, total_bytes_unlinked / 1000000000
+        )
 
     @classmethod
     def _old_enough_for_deletion(cls, date_run, age_threshold=90):
@@ -95,32 +294,67 @@ class DeliveredDataDeleter(Deleter):
         age = cls._now() - datetime(int(year), int(month), int(day))
         return age.days > age_threshold
 
-    def delete_data(self):
-        deletable_samples = self.deletable_samples()
-        if self.limit_samples:
-            deletable_samples = [s for s in deletable_samples if s.sample_id in self.limit_samples]
+    def _plan_samples(self, samples):
+        """Write the files, HSM states and Rest API patches of each sample to the plan file given with --write_plan."""
+        sample_data = self._discover(samples)
+        plan = DeletionPlan(self.alias, self._strnow())
 
+        def _stat_entries(s):
+            return [
+                stat_entry(f, self.throttle, self.hsm_states) for f in s.files_to_purge + s.files_to_remove_from_lustre
+            ]
+
+        with self.metrics.span('stat_files'):
+            files = self._for_each_sample(_stat_entries, samples)
+        for s, f, data in zip(samples, files, sample_data):
+            plan.add(s.sample_id, f, [s.deletion_patch()], data)
+        self._save_plan(plan)
+
+    def _mark_samples_as_deleted(self, samples):
+        with self.metrics.span('mark_as_deleted'):
+            for s in samples:
+                if not self.journal.done('marked', s.sample_id):
+                    s.mark_as_deleted()
+                    self.metrics.count('rest_patches')
+                    self.journal.record('marked', s.sample_id)
+
+    def delete_data(self):
+        with self.metrics.span('discovery'):
+            deletable_samples = self._samples_to_delete()
         sample_ids = [e.sample_id for e in deletable_samples]
         self.debug('Found %s samples for deletion: %s', len(deletable_samples), sample_ids)
-        self.setup_samples_for_deletion(deletable_samples)
+        if self.write_plan:
+            self._plan_samples(deletable_samples)
+            return 0
+
+        if deletable_samples:
+            self._start_journal(deletable_samples)
+        with self.metrics.span('setup'):
+            self.setup_samples_for_deletion(deletable_samples)
 
         if not deletable_samples or self.dry_run:
             return 0
 
-        for s in deletable_samples:
-            s.mark_as_deleted()
+        self._mark_samples_as_deleted(deletable_samples)
 
         if self.deletion_dir and os.path.isdir(self.deletion_dir):
             self.delete_dir(self.deletion_dir)
 
+        with self.metrics.span('clean_up_released_folders'):
+            self._clean_up_released_folders(deletable_samples)
+
+    def _clean_up_released_folders(self, deletable_samples):
         # Data has been deleted, so now clean up empty released directories
         for s in deletable_samples:
-            sample_dir = s.released_data_folder
-            if not sample_dir:
+            if self.journal.done('deleted', s.sample_id):
                 continue
 
-            assert not os.listdir(sample_dir)
-            self._execute('rm -r ' + sample_dir)
-            release_dir = os.path.dirname(sample_dir)
-            if not os.listdir(release_dir):
-                self._execute('rm -r ' + release_dir)
+            sample_dir = s.released_data_folder
+            # a resumed deletion may already have cleaned up the folder
+            if sample_dir and os.path.isdir(sample_dir):
+                assert not os.listdir(sample_dir)
+                self._execute('rm -r ' + sample_dir)
+                release_dir = os.path.dirname(sample_dir)
+                if not os.listdir(release_dir):
+                    self._execute('rm -r ' + release_dir)
+            self.journal.record('deleted', s.sample_id)
@@ -0,0 +1,95 @@
+import os
+import threading
+from collections import defaultdict
+from egcg_core import clarity
+from egcg_core.app_logging import AppLogger
+from egcg_core.config import cfg
+from data_deletion.throttling import Throttle
+from data_deletion.metrics import Metrics
+
+
+def _lims_names(sample_id):
+    """
+    The names a sample can have in the Lims. Like clarity.get_list_of_samples, each substitution is applied to the
+    name produced by the previous one, e.g. X__A_01 -> X__A:01 -> X _A:01.
+    """
+    names = []
+    name = sample_id
+    for pattern, repl in clarity.substitutions:
+        if pattern:
+            name = pattern.sub(repl, name)
+        names.append(name)
+    return names
+
+
+class DeliveredDataIndex(AppLogger):
+    """
+    Index of the delivered data folders, built with a single scan of delivered_data/<project>/*/* per project, and
+    shared by all samples of a deletion run. Samples' 2D barcodes, which name their delivered folders, are resolved
+    from the Lims in bulk.
+    """
+    def __init__(self, delivered_data_dir=None, throttle=None, metrics=None):
+        self.delivered_data_dir = delivered_data_dir or cfg['data_deletion']['delivered_data']
+        self.throttle = throttle or Throttle()
+        self.metrics = metrics or Metrics()
+        self.folders = {}
+        self.barcodes = {}
+        self.lock = threading.Lock()
+        self.project_locks = {}
+
+    def _scandir(self, d):
+        with self.throttle.operation():
+            return sorted(os.scandir(d), key=lambda e: e.name)
+
+    def project_folders(self, project_id):
+        """
+        :return: the paths of all entries found in the delivery batches of a project, indexed by name
+        :rtype: dict[str, list[str]]
+        """
+        if project_id not in self.folders:
+            # samples discovered concurrently wait for a single scan of their project
+            with self.lock:
+                project_lock = self.project_locks.setdefault(project_id, threading.Lock())
+            with project_lock:
+                if project_id not in self.folders:
+                    with self.metrics.span('delivered_data_scan'):
+                        self.folders[project_id] = self._scan_project(
+                            os.path.join(self.delivered_data_dir, project_id)
+                        )
+        return self.folders[project_id]
+
+    def _scan_project(self, project_dir):
+        folders = defaultdict(list)
+        if os.path.isdir(project_dir):
+            for batch in self._scandir(project_dir):
+                # same entries as the glob delivered_data/<project>/*/*, which skips hidden names
+                if batch.is_dir() and not batch.name.startswith('.'):
+                    for entry in self._scandir(batch.path):
+                        folders[entry.name].append(entry.path)
+        return folders
+
+    def resolve_barcodes(self, sample_ids):
+        """Query the Lims once for all samples whose 2D barcode is not known yet."""
+        to_resolve = sorted(set(s for s in sample_ids if s not in self.barcodes))
+        if not to_resolve:
+            return
+
+        self.metrics.count('lims_queries')
+        with self.metrics.span('lims_queries'):
+            lims_samples = dict((s.name, s) for s in clarity.get_list_of_samples(to_resolve))
+        for sample_id in to_resolve:
+            lims_sample = next((lims_samples[n] for n in _lims_names(sample_id) if n in lims_samples), None)
+            if lims_sample is None:
+                self.warning('Could not find sample %s in the Lims', sample_id)
+                self.barcodes[sample_id] = None
+            else:
+                self.barcodes[sample_id] = lims_sample.udf.get('2D Barcode')
+
+    def barcode(self, sample_id):
+        if sample_id not in self.barcodes:
+            self.resolve_barcodes([sample_id])
+        return self.barcodes[sample_id]
+
+    def released_data_folders(self, project_id, sample_id):
+        """Delivered folders of a sample, named after its 2D barcode if it has one, or its sample ID otherwise."""
+        return self.project_folders(project_id).get(self.barcode(sample_id) or sample_id, [])
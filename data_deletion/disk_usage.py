@@ -0,0 +1,122 @@
+import os
+import stat
+from collections import namedtuple, Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from data_deletion.throttling import Throttle
+
+DiskUsage = namedtuple('DiskUsage', ('total_size', 'nb_files', 'nb_inodes'))
+ReclaimableSpace = namedtuple('ReclaimableSpace', ('freed', 'unlinked', 'nb_inodes', 'total_size'))
+default_max_workers = 8
+size_units = {'': 1, 'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12, 'P': 10 ** 15}
+
+
+def parse_size(size):
+    """
+    Parse a human-readable size in decimal units, e.g. '80T', '1.5 TB' or '2000000'.
+    :rtype: int
+    """
+    value = size.strip().upper()
+    if value.endswith('B'):
+        value = value[:-1]
+    unit = value[-1] if value and value[-1] in size_units else ''
+    try:
+        return int(float(value[:len(value) - len(unit)]) * size_units[unit])
+    except ValueError:
+        raise ValueError('Invalid size: ' + size)
+
+
+def _scan_dir(directory, throttle):
+    """
+    Scan a single directory level with os.scandir, so that file types come from the directory listing rather than from
+    one stat call per entry.
+    :return: the stat result of each file found and the sub-directories to descend into
+    """
+    files = []
+    subdirs = []
+    with throttle.operation():
+        entries = list(os.scandir(directory))
+    for entry in entries:
+        if entry.is_dir():
+            subdirs.append(entry.path)
+        else:
+            with throttle.operation():
+                files.append(entry.stat())
+    return files, subdirs
+
+
+def _file_stats(file_list, max_workers, throttle):
+    """
+    Stat all files, descending into directories recursively. Each directory is scanned as a separate task on a bounded
+    thread pool, so sibling directories are listed concurrently.
+    :return: the stat result of each file, once per path
+    """
+    dirs = []
+    for f in file_list:
+        with throttle.operation():
+            st = os.stat(f)
+        if stat.S_ISDIR(st.st_mode):
+            dirs.append(f)
+        else:
+            yield st
+
+    if dirs:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            pending = set(pool.submit(_scan_dir, d, throttle) for d in dirs)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, subdirs = future.result()
+                    yield from files
+                    pending.update(pool.submit(_scan_dir, d, throttle) for d in subdirs)
+
+
+def get_disk_usage(file_list, max_workers=default_max_workers, throttle=None):
+    """
+    Get the total size of all files, descending into directories recursively. Files are collapsed by inode to avoid
+    counting hard links more than once. Each directory is scanned as a separate task on a bounded thread pool, so
+    sibling directories are listed concurrently.
+    :param file_list: files and/or directories to size
+    :param int max_workers: maximum number of directories scanned at once
+    :param Throttle throttle: optional cap on the rate and concurrency of directory scans and stat calls
+    :rtype: DiskUsage
+    """
+    inode_sizes = {}
+    nb_files = 0
+    for st in _file_stats(file_list, max_workers, throttle or Throttle()):
+        inode_sizes[st.st_ino] = st.st_size
+        nb_files += 1
+    return DiskUsage(sum(inode_sizes.values()), nb_files, len(inode_sizes))
+
+
+def get_reclaimable_space(files_to_delete, files_to_release=(), max_workers=default_max_workers, throttle=None):
+    """
+    Estimate the space that deleting and releasing files would give back, from the blocks allocated to each inode. A
+    deleted file only frees its blocks if all of its hard links are deleted with it, otherwise it is only unlinked.
+    Releasing a file from Lustre frees its blocks whatever its links, since they all share the released inode.
+    The apparent size of the files is taken from the same stat calls, as get_disk_usage would give for each list.
+    :param files_to_delete: files and/or directories to delete
+    :param files_to_release: files and/or directories to release from Lustre
+    :param int max_workers: maximum number of directories scanned at once
+    :param Throttle throttle: optional cap on the rate and concurrency of directory scans and stat calls
+    :rtype: ReclaimableSpace
+    """
+    throttle = throttle or Throttle()
+    released_inodes = dict((st.st_ino, st) for st in _file_stats(files_to_release, max_workers, throttle))
+    released_blocks = dict((inode, st.st_blocks * 512) for inode, st in released_inodes.items())
+    deleted_links = Counter()
+    deleted_inodes = {}
+    for st in _file_stats(files_to_delete, max_workers, throttle):
+        deleted_links[st.st_ino] += 1
+        deleted_inodes[st.st_ino] = st
+
+    freed = sum(released_blocks.values())
+    unlinked = 0
+    for inode, st in deleted_inodes.items():
+        if inode in released_blocks:
+            continue
+        if deleted_links[inode] >= st.st_nlink:
+            freed += st.st_blocks * 512
+        else:
+            unlinked += st.st_blocks * 512
+    total_size = sum(st.st_size for st in released_inodes.values()) + sum(st.st_size for st in deleted_inodes.values())
+    return ReclaimableSpace(freed, unlinked, len(released_blocks.keys() | deleted_inodes.keys()), total_size)
@@ -0,0 +1,93 @@
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from egcg_core.app_logging import AppLogger
+from data_deletion.hsm import chunk_paths
+from data_deletion.throttling import Throttle
+from data_deletion.metrics import Metrics
+
+# e.g. "lfs fid2path: cannot find '[0x200000400:0x1:0x0]': No such file or directory"
+not_found_re = re.compile(r"cannot find '?\[?([^\]':]+(?::[^\]':]+)*)\]?'?: No such file or directory")
+not_found_msg = 'No such file or directory'
+
+
+def _bare_fid(fid):
+    """A FID without the brackets that lfs may or may not print around it, e.g. [0x200000400:0x1:0x0]"""
+    return fid.strip().strip('[]')
+
+
+class FidLookup(AppLogger):
+    """
+    Find which FIDs have no path on a Lustre filesystem, with one `lfs fid2path` call per chunk of FIDs and several
+    calls running at once.
+    """
+    max_arg_length = 100000
+
+    def __init__(self, lustre_file_system, max_arg_length=None, max_workers=None, throttle=None, metrics=None):
+        """
+        :param str lustre_file_system: mount point of the Lustre filesystem to look the FIDs up in
+        :param int max_arg_length: maximum total length of the FIDs passed to one lfs call
+        :param int max_workers: maximum number of concurrent lfs calls, defaulting to the number of cores
+        :param Throttle throttle: optional cap on the rate and concurrency of lfs calls, counted per FID
+        :param Metrics metrics: optional record of the time spent in lfs calls
+        """
+        self.lustre_file_system = lustre_file_system
+        self.max_arg_length = max_arg_length or self.max_arg_length
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.throttle = throttle or Throttle()
+        self.metrics = metrics or Metrics()
+
+    @staticmethod
+    def _get_cmd_output(cmd):
+        # communicate reads stdout and stderr as they come, so a large output cannot fill a pipe and block the process
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        o, e = p.communicate()
+        return p.returncode, o, e
+
+    def _fid2path(self, fids):
+        """
+        :return: the FIDs that `lfs fid2path` reported as not found, as requested, with or without brackets. FIDs that
+                 failed for any other reason are not returned, so that they are not mistaken for orphans.
+        :rtype: set[str]
+        """
+        self.metrics.count('subprocesses')
+        self.metrics.count('fid2path_fids', len(fids))
+        with self.throttle.operation(len(fids)), self.metrics.span('fid2path'):
+            exit_status, stdout, stderr = self._get_cmd_output(
+                ['lfs', 'fid2path', '--print-fid', self.lustre_file_system] + fids
+            )
+
+        requested = dict((_bare_fid(f), f) for f in fids)
+        not_found = set()
+        unmatched = []
+        other_errors = []
+        for line in stderr.decode('utf-8').splitlines():
+            match = not_found_re.search(line)
+            if match and _bare_fid(match.group(1)) in requested:
+                not_found.add(requested[_bare_fid(match.group(1))])
+            elif not_found_msg in line:
+                unmatched.append(line)
+            elif line.strip():
+                other_errors.append(line)
+        if unmatched:
+            # an lfs output format not understood here would otherwise silently report no orphans
+            self.warning(
+                'lfs fid2path reported %s FIDs as not found that do not match the FIDs requested: %s',
+                len(unmatched), unmatched
+            )
+        if other_errors:
+            self.error('lfs fid2path on %s FIDs -> (%s, %s)', len(fids), exit_status, other_errors)
+        return not_found
+
+    def find_orphans(self, fids):
+        """
+        Look up FIDs in chunks, with up to self.max_workers lfs calls running at once.
+        :param fids: FIDs to look up
+        :return: the FIDs with no Lustre path, in the order given
+        :rtype: list[str]
+        """
+        fids = list(fids)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            not_found = set().union(*pool.map(self._fid2path, chunk_paths(fids, self.max_arg_length)))
+        return [f for f in fids if f in not_found]
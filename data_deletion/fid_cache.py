@@ -0,0 +1,85 @@
+import time
+import sqlite3
+import threading
+from data_deletion.rest_queries import chunks
+
+FOUND = 'found'
+ORPHAN = 'orphan'
+
+
+class FidCache:
+    """
+    Persistent record of the last `lfs fid2path` verdict on each FID of the DMF filesystem, so that FIDs recently
+    found on Lustre do not need checking again. Safe to use from several threads.
+    """
+    schema = '''CREATE TABLE IF NOT EXISTS fids(
+       fid TEXT PRIMARY KEY,
+       verdict TEXT,
+       mtime REAL,
+       last_checked REAL
+    );'''
+    max_variables = 500  # below SQLite's default limit of 999 parameters per query
+    lock_timeout = 300  # seconds to wait for another process, e.g. a concurrent shard, to release the database
+
+    def __init__(self, path, reverify_interval):
+        """
+        :param str path: SQLite database file, created if needed
+        :param float reverify_interval: seconds after which a FID found on Lustre is checked again
+        """
+        self.reverify_interval = reverify_interval
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=self.lock_timeout, check_same_thread=False)
+        self.cursor = self.db.cursor()
+        self.cursor.execute(self.schema)
+        self.db.commit()
+
+    @staticmethod
+    def _now():
+        return time.time()
+
+    def recently_found(self, mtimes):
+        """
+        :param dict[str, float] mtimes: current mtime of each FID's file
+        :return: the FIDs found on Lustre within the re-verification interval, whose files have not changed since.
+                 New FIDs and FIDs last seen as orphans are never returned.
+        :rtype: set[str]
+        """
+        oldest_check = self._now() - self.reverify_interval
+        found = set()
+        with self.lock:
+            for chunk in chunks(mtimes, self.max_variables):
+                self.cursor.execute(
+                    'SELECT fid, mtime FROM fids WHERE verdict = ? AND last_checked >= ? AND fid IN (%s)' % (
+                        ', '.join('?' * len(chunk))
+                    ),
+                    [FOUND, oldest_check] + chunk
+                )
+                found.update(fid for fid, mtime in self.cursor.fetchall() if mtime == mtimes[fid])
+        return found
+
+    def record(self, verdicts):
+        """
+        :param list[tuple[str, str, float]] verdicts: FID, verdict (FOUND or ORPHAN) and mtime of each FID checked
+        """
+        now = self._now()
+        with self.lock:
+            self.cursor.executemany(
+                'INSERT OR REPLACE INTO fids (fid, verdict, mtime, last_checked) VALUES (?, ?, ?, ?);',
+                [(fid, verdict, mtime, now) for fid, verdict, mtime in verdicts]
+            )
+            self.db.commit()
+
+    def forget(self, fids):
+        """Remove FIDs from the cache, e.g. once their files have been deleted."""
+        with self.lock:
+            for chunk in chunks(fids, self.max_variables):
+                self.cursor.execute('DELETE FROM fids WHERE fid IN (%s)' % ', '.join('?' * len(chunk)), chunk)
+            self.db.commit()
+
+    def verdicts(self):
+        with self.lock:
+            self.cursor.execute('SELECT fid, verdict, mtime, last_checked FROM fids')
+            return dict((row[0], row[1:]) for row in self.cursor.fetchall())
+
+    def close(self):
+        self.db.close()
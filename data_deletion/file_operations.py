@@ -0,0 +1,130 @@
+import os
+import time
+import errno
+import shutil
+import fnmatch
+from collections import namedtuple, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from data_deletion.throttling import Throttle
+
+DeletionStats = namedtuple('DeletionStats', ('nb_files', 'total_size', 'duration'))
+
+
+def move(source, dest):
+    """
+    Move a file or directory to dest, which should be the full destination path. Within a filesystem this is a single
+    in-process rename. Across devices, the data is copied then the source is removed.
+    :return: dest
+    """
+    try:
+        os.rename(source, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        if os.path.isdir(source) and not os.path.islink(source):
+            shutil.copytree(source, dest, symlinks=True)
+            shutil.rmtree(source)
+        else:
+            shutil.copy2(source, dest, follow_symlinks=False)
+            os.unlink(source)
+    return dest
+
+
+def _empty_dir(directory, throttle, unlink_throttle):
+    """
+    Unlink all non-directory entries of a directory. Scans and stats go through throttle, unlinks through
+    unlink_throttle.
+    :return: the number and total size of the files removed, and the sub-directories left to empty
+    """
+    files = []
+    subdirs = []
+    with throttle.operation():
+        entries = list(os.scandir(directory))
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+        else:
+            with throttle.operation():
+                files.append((entry.path, entry.stat(follow_symlinks=False).st_size))
+
+    for f, size in files:
+        with unlink_throttle.operation():
+            os.unlink(f)
+    return len(files), sum(size for f, size in files), subdirs
+
+
+def delete_tree(top, max_workers=8, throttle=None, unlink_throttle=None):
+    """
+    Delete a directory tree bottom-up: directories are emptied concurrently on a bounded thread pool, then removed
+    deepest first.
+    :param str top: directory to delete
+    :param int max_workers: maximum number of directories processed at once
+    :param Throttle throttle: optional cap on the rate and concurrency of scans, stats and rmdirs
+    :param Throttle unlink_throttle: optional cap on the rate and concurrency of unlinks, defaulting to throttle
+    :rtype: DeletionStats
+    """
+    throttle = throttle or Throttle()
+    unlink_throttle = unlink_throttle or throttle
+    start = time.time()
+    nb_files = 0
+    total_size = 0
+    dirs_by_depth = defaultdict(list)
+    dirs_by_depth[0].append(top)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {pool.submit(_empty_dir, top, throttle, unlink_throttle): 0}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                depth = pending.pop(future)
+                _nb_files, _size, subdirs = future.result()
+                nb_files += _nb_files
+                total_size += _size
+                for d in subdirs:
+                    dirs_by_depth[depth + 1].append(d)
+                    pending[pool.submit(_empty_dir, d, throttle, unlink_throttle)] = depth + 1
+
+        def _rmdir(d):
+            with throttle.operation():
+                os.rmdir(d)
+
+        for depth in sorted(dirs_by_depth, reverse=True):
+            list(pool.map(_rmdir, dirs_by_depth[depth]))
+
+    return DeletionStats(nb_files, total_size, time.time() - start)
+
+
+def _is_glob(pattern):
+    return any(c in pattern for c in '*?[')
+
+
+def find_files_matching(top, patterns, throttle=None):
+    """
+    Find the files under a directory matching any of several patterns, in a single os.scandir traversal. A pattern
+    containing glob characters is matched against file names with fnmatch, otherwise it is a file name suffix.
+    Symlinks to directories are not followed, as with os.walk.
+    :param str top: directory to search
+    :param patterns: suffixes and/or glob patterns
+    :param Throttle throttle: optional cap on the rate and concurrency of directory scans
+    :return: the paths matching each pattern, sorted. A file matching several patterns is listed under each.
+    :rtype: dict[str, list[str]]
+    """
+    throttle = throttle or Throttle()
+    matches = dict((p, []) for p in patterns)
+    dirs = [top]
+    while dirs:
+        d = dirs.pop()
+        with throttle.operation():
+            entries = list(os.scandir(d))
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    dirs.append(entry.path)
+                continue
+            for p in matches:
+                if fnmatch.fnmatchcase(entry.name, p) if _is_glob(p) else entry.name.endswith(p):
+                    matches[p].append(entry.path)
+
+    for p in matches:
+        matches[p].sort()
+    return matches
@@ -1,14 +1,15 @@
 import os
-from egcg_core import rest_communication
-from egcg_core.constants import ELEMENT_RUN_NAME, ELEMENT_SAMPLE_INTERNAL_ID
-from egcg_core.util import find_all_fastqs
+from egcg_core.constants import ELEMENT_RUN_NAME
 from egcg_core.config import cfg
 from data_deletion import FinalSample
 from data_deletion.delivered_data import DeliveredDataDeleter
+from data_deletion.file_operations import find_files_matching
+from data_deletion.archiving_index import ArchivingIndex
 
 
 class FinalDataDeleter(DeliveredDataDeleter):
     alias = 'final_deletion'
+    sample_class = FinalSample
 
     def __init__(self, cmd_args):
         super().__init__(cmd_args)
@@ -16,19 +17,22 @@ class FinalDataDeleter(DeliveredDataDeleter):
         self.project_archive_dir = cfg['data_deletion']['processed_archives']
         self.fastq_dir = cfg['data_deletion']['fastqs']
         self.projects_dir = cfg['data_deletion']['processed_data']
+        self.archiving_index = ArchivingIndex(self._get_documents_in)
 
     def deletable_samples(self):
-        samples = [FinalSample(s) for s in self._manually_deletable_samples()]
+        samples = [
+            FinalSample(s, self.hsm_states, self.throttle, self.delivered_data_index)
+            for s in self._manually_deletable_samples()
+        ]
+        self._prefetch(samples)
         return sorted(samples, key=lambda e: e.sample_data['sample_id'])
 
     def setup_samples_for_deletion(self, samples):
+        self._record_discovered(samples)
         for s in samples:
             deletable_data_dir = os.path.join(self.deletion_dir, s.sample_id)
             if not self.dry_run:
-                if len(s.files_to_purge):
-                    self._execute('mkdir -p ' + deletable_data_dir)
-                    for f in s.files_to_purge:
-                        self._move_to_unique_file_name(f, deletable_data_dir)
+                self._stage_sample(s)
             else:
                 self.info(
                     'Sample %s has %s files to delete\n%s',
@@ -51,85 +55,135 @@ class FinalDataDeleter(DeliveredDataDeleter):
                 ret = False
         return ret
 
-    @staticmethod
-    def _find_files_with_suffix(location, suffix):
-        file_names = []
-        for name, dirs, files in os.walk(location):
-            file_names.extend(os.path.join(name, f) for f in files if f.endswith(suffix))
-        return file_names
+    def _find_files(self, location, *patterns):
+        """Find the files under location matching any of the patterns, in one traversal."""
+        with self.metrics.span('find_cleanup_files'):
+            matches = find_files_matching(location, patterns, self.throttle)
+        return [f for p in patterns for f in matches[p]]
+
+    def _report_archivability(self, samples):
+        """
+        Index the runs and projects of the samples to delete, then report those that this batch makes archivable
+        and the samples blocking the others.
+        :rtype: ArchivingReport
+        """
+        run_ids = sorted(set(re[ELEMENT_RUN_NAME] for s in samples for re in s.run_elements))
+        project_ids = sorted(set(s.project_id for s in samples))
+        with self.metrics.span('archiving_index'):
+            self.archiving_index.add(
+                [r for r in run_ids if not self.journal.done('archived', 'run ' + r)],
+                [p for p in project_ids if not self.journal.done('archived', 'project ' + p)]
+            )
+        report = self.archiving_index.report(deleted=[s.sample_id for s in samples])
+        self.metrics.count('archivable_runs', len(report.archivable_runs))
+        self.metrics.count('archivable_projects', len(report.archivable_projects))
+        self.info(
+            'After this batch, %s runs and %s projects can be archived: %s',
+            len(report.archivable_runs), len(report.archivable_projects),
+            report.archivable_runs + report.archivable_projects
+        )
+        for kind, blocked in (('Run', report.blocked_runs), ('Project', report.blocked_projects)):
+            for dataset, blockers in blocked.items():
+                self.info(
+                    '%s %s is blocked by %s samples: %s', kind, dataset, len(blockers),
+                    ', '.join('%s (%s)' % (b, self.archiving_index.state(b)) for b in blockers)
+                )
+        return report
+
+    def _mark_samples_as_deleted(self, samples):
+        super()._mark_samples_as_deleted(samples)
+        self.archiving_index.mark_deleted(s.sample_id for s in samples)
 
     def _try_archive_run(self, run_id):
+        if self.journal.done('archived', 'run ' + run_id):
+            return
         # Ensure that all samples in that run have been fully deleted.
-        run_elements = rest_communication.get_documents('run_elements', where={'run_id': run_id}, all_pages=True)
-        # Get all sample id involved in that run (removing the unassigned barcode for pooling runs)
-        sample_ids = set(re[ELEMENT_SAMPLE_INTERNAL_ID] for re in run_elements
-                         if re[ELEMENT_SAMPLE_INTERNAL_ID] != "Undetermined")
-        samples = (rest_communication.get_document('samples', where={'sample_id': sample_id}) for sample_id in sample_ids)
-        if all((sample['data_deleted'] == 'all' for sample in samples)):
+        if not self.archiving_index.run_blockers(run_id):
             # remove all extra fastq files
             run_dir = os.path.join(self.fastq_dir, run_id)
             # Do not archive runs that do not exist or have already been archived
             if os.path.isdir(run_dir):
-                files_to_remove = find_all_fastqs(run_dir)  # That should be the undetermined since all others were removed
-                files_to_remove.extend(self._find_files_with_suffix(run_dir, 'fastq_discarded.gz'))  # phix and adapters
-                files_to_remove.extend(self._find_files_with_suffix(run_dir, 'fastq.gz.original'))  # original when filtered
+                files_to_remove = self._find_files(
+                    run_dir,
+                    '.fastq.gz',  # That should be the undetermined since all others were removed
+                    'fastq_discarded.gz',  # phix and adapters
+                    'fastq.gz.original'  # original when filtered
+                )
                 if files_to_remove:
                     deletable_data_dir = os.path.join(self.deletion_dir, run_id)
-                    self._execute('mkdir -p ' + deletable_data_dir)
-                    for f in files_to_remove:
-                        self._move_to_unique_file_name(f, deletable_data_dir)
+                    self._mkdir(deletable_data_dir)
+                    self._move_to_unique_file_names(files_to_remove, deletable_data_dir, journal_key='run ' + run_id)
 
                 self.debug('Archiving processed run: ' + run_id)
-                self._execute('mv %s %s' % (run_dir, os.path.join(self.run_archive_dir, run_id)))
+                self.move_files([(run_dir, os.path.join(self.run_archive_dir, run_id))])
+                self.journal.record('archived', 'run ' + run_id)
 
     def _try_archive_project(self, project_id):
+        if self.journal.done('archived', 'project ' + project_id):
+            return
         # Ensure that all samples of that project have been fully deleted.
-        samples = rest_communication.get_documents('samples', where={'project_id': project_id}, all_pages=True)
-        if all((sample['data_deleted'] == 'all' for sample in samples)):
+        if not self.archiving_index.project_blockers(project_id):
             # remove the extra vcf file from project process
             project_dir = os.path.join(self.projects_dir, project_id)
             # Do not archive project that have already been archived
             if os.path.isdir(project_dir):
-                files_to_remove = self._find_files_with_suffix(project_dir, 'genotype_gvcfs.vcf.gz')
+                files_to_remove = self._find_files(project_dir, 'genotype_gvcfs.vcf.gz')
                 if files_to_remove:
                     deletable_data_dir = os.path.join(self.deletion_dir, project_id)
-                    self._execute('mkdir -p ' + deletable_data_dir)
-                    for f in files_to_remove:
-                        self._move_to_unique_file_name(f, deletable_data_dir)
+                    self._mkdir(deletable_data_dir)
+                    self._move_to_unique_file_names(
+                        files_to_remove, deletable_data_dir, journal_key='project ' + project_id
+                    )
 
                 self.debug('Archiving processed project: ' + project_id)
-                self._execute('mv %s %s' % (project_dir, os.path.join(self.project_archive_dir, project_id)))
+                self.move_files([(project_dir, os.path.join(self.project_archive_dir, project_id))])
+                self.journal.record('archived', 'project ' + project_id)
 
     def delete_data(self):
-        deletable_samples = self.deletable_samples()
-        if self.limit_samples:
-            deletable_samples = [s for s in deletable_samples if s.sample_id in self.limit_samples]
-
+        with self.metrics.span('discovery'):
+            deletable_samples = self._samples_to_delete()
         sample_ids = [e.sample_id for e in deletable_samples]
         self.debug('Found %s samples for deletion: %s', len(deletable_samples), sample_ids)
-        if not self.check_all_deletable(deletable_samples):
+        # samples of a resumed deletion or of a plan were checked before being journalled or planned
+        with self.metrics.span('check_all_deletable'):
+            all_deletable = self.resume or self.apply_plan or self.check_all_deletable(deletable_samples)
+        if not all_deletable:
             return 1
 
-        self.setup_samples_for_deletion(deletable_samples)
+        if deletable_samples:
+            self._report_archivability(deletable_samples)
+
+        if self.write_plan:
+            self._plan_samples(deletable_samples)
+            return 0
+
+        if deletable_samples:
+            self._start_journal(deletable_samples)
+        with self.metrics.span('setup'):
+            self.setup_samples_for_deletion(deletable_samples)
 
         if not deletable_samples or self.dry_run:
             return 0
 
-        for s in deletable_samples:
-            s.mark_as_deleted()
+        # the indexed states are updated as samples are marked
+        self._mark_samples_as_deleted(deletable_samples)
 
         # Data has been marked as deleted.
         # Now clean up runs directories if possible
-        run_ids = set((re[ELEMENT_RUN_NAME] for s in deletable_samples for re in s.run_elements))
-        if run_ids:
+        run_ids = sorted(set(re[ELEMENT_RUN_NAME] for s in deletable_samples for re in s.run_elements))
+        with self.metrics.span('archive_runs'):
             for r in run_ids:
                 self._try_archive_run(r)
 
         # Now clean up project directories if possible
-        project_ids = set((s.project_id for s in deletable_samples))
-        if project_ids:
+        project_ids = sorted(set(s.project_id for s in deletable_samples))
+        with self.metrics.span('archive_projects'):
             for p in project_ids:
                 self._try_archive_project(p)
 
         if self.deletion_dir and os.path.isdir(self.deletion_dir):
             self.delete_dir(self.deletion_dir)
+
+        for s in deletable_samples:
+            if not self.journal.done('deleted', s.sample_id):
+                self.journal.record('deleted', s.sample_id)
@@ -0,0 +1,161 @@
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from egcg_core.app_logging import AppLogger
+from egcg_core.archive_management import state_re
+from egcg_core.exceptions import ArchivingError
+from data_deletion.throttling import Throttle
+from data_deletion.metrics import Metrics
+
+
+def chunk_paths(file_paths, max_length):
+    """
+    Split file paths into lists whose total length on a command line does not exceed max_length. A path longer than
+    max_length ends up in its own chunk.
+    """
+    chunk = []
+    chunk_length = 0
+    for f in file_paths:
+        if chunk and chunk_length + len(f) + 1 > max_length:
+            yield chunk
+            chunk = []
+            chunk_length = 0
+        chunk.append(f)
+        chunk_length += len(f) + 1
+    if chunk:
+        yield chunk
+
+
+class HSMStates(AppLogger):
+    """
+    Query Lustre HSM states for many files with one `lfs hsm_state` call per chunk of paths, and cache the results so
+    that each file is only queried once.
+    """
+    max_arg_length = 100000
+
+    def __init__(self, max_arg_length=None, throttle=None, metrics=None):
+        """
+        :param int max_arg_length: maximum total length of the paths passed to one lfs call
+        :param Throttle throttle: optional cap on the rate and concurrency of lfs calls, counted per file
+        :param Metrics metrics: optional record of the time spent in lfs calls
+        """
+        self.max_arg_length = max_arg_length or self.max_arg_length
+        self.throttle = throttle or Throttle()
+        self.metrics = metrics or Metrics()
+        self.states = {}
+
+    @staticmethod
+    def _get_cmd_output(cmd):
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        o, e = p.communicate()
+        return p.returncode, o, e
+
+    def _hsm_state(self, file_paths):
+        self.metrics.count('subprocesses')
+        self.metrics.count('hsm_state_files', len(file_paths))
+        with self.throttle.operation(len(file_paths)), self.metrics.span('hsm_state'):
+            exit_status, stdout, stderr = self._get_cmd_output(['lfs', 'hsm_state'] + file_paths)
+        msg = 'lfs hsm_state on %s files -> (%s, %s)' % (len(file_paths), exit_status, stderr)
+        if exit_status:
+            self.error(msg)
+        else:
+            self.debug(msg)
+
+        states = {}
+        for line in stdout.decode('utf-8').splitlines():
+            match = state_re.match(line)
+            if match:
+                state_and_id = match.group(3)
+                states[match.group(1)] = state_and_id.split(',')[0].split() if state_and_id else []
+        return states
+
+    def query(self, file_paths):
+        """
+        Query the states of all files not already cached.
+        :param file_paths: paths to query
+        :return: the states of the files requested
+        :rtype: dict[str, list[str]]
+        """
+        file_paths = list(file_paths)
+        to_query = sorted(set(f for f in file_paths if f not in self.states))
+        for chunk in chunk_paths(to_query, self.max_arg_length):
+            self.states.update(self._hsm_state(chunk))
+
+        missing_files = [f for f in to_query if f not in self.states]
+        if missing_files:
+            raise ArchivingError('Could not hsm_state files: %s' % missing_files)
+        return {f: self.states[f] for f in file_paths}
+
+    def archive_states(self, file_path):
+        return self.query([file_path])[file_path]
+
+    def invalidate(self, file_paths):
+        """Remove files from the cache, e.g. after their states were changed by a release or recall."""
+        for f in file_paths:
+            self.states.pop(f, None)
+
+    def is_of_state(self, state, file_path):
+        return state in self.archive_states(file_path)
+
+    def is_archived(self, file_path):
+        return self.is_of_state('archived', file_path)
+
+    def is_released(self, file_path):
+        return self.is_of_state('released', file_path)
+
+    def is_dirty(self, file_path):
+        return self.is_of_state('dirty', file_path)
+
+    def release_commands(self, file_paths):
+        """The batched `lfs hsm_release` commands that would release the given files."""
+        return [['lfs', 'hsm_release'] + chunk for chunk in chunk_paths(file_paths, self.max_arg_length)]
+
+    def release(self, file_paths, max_workers=4):
+        """
+        Release archived files from Lustre, with one `lfs hsm_release` call per chunk of paths and up to max_workers
+        calls running at once. Files already released are skipped.
+        :param file_paths: files to release
+        :param int max_workers: maximum number of concurrent `lfs hsm_release` calls
+        :return: the files that could not be released, with the reason why
+        :rtype: dict[str, str]
+        """
+        file_paths = list(file_paths)
+        self.query(file_paths)
+        failures = {}
+        to_release = []
+        for f in file_paths:
+            if self.is_dirty(f):
+                failures[f] = 'dirty'
+            elif not self.is_archived(f):
+                failures[f] = 'not archived'
+            elif not self.is_released(f):
+                to_release.append(f)
+
+        def _release(cmd):
+            self.metrics.count('subprocesses')
+            with self.throttle.operation(len(cmd) - 2), self.metrics.span('hsm_release'):
+                return self._get_cmd_output(cmd)
+
+        with self.throttle.operation(len(to_release)):
+            total_size = sum(os.stat(f).st_size for f in to_release)
+        released_size = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = dict((pool.submit(_release, cmd), cmd[2:]) for cmd in self.release_commands(to_release))
+            for future in as_completed(futures):
+                chunk = futures[future]
+                exit_status, stdout, stderr = future.result()
+                if exit_status:
+                    self.error('lfs hsm_release on %s files -> (%s, %s)', len(chunk), exit_status, stderr)
+                with self.throttle.operation(len(chunk)):
+                    chunk_size = sum(os.stat(f).st_size for f in chunk)
+                released_size += chunk_size
+                if not exit_status:
+                    self.metrics.count('bytes_released', chunk_size)
+                self.info('Released %.2f/%.2f G from Lustre', released_size / 1000000000, total_size / 1000000000)
+
+        self.invalidate(to_release)
+        self.query(to_release)
+        for f in to_release:
+            if not self.is_released(f):
+                failures[f] = 'not released after lfs hsm_release'
+        return failures
@@ -0,0 +1,80 @@
+import os
+import json
+from collections import OrderedDict
+from datetime import datetime
+from egcg_core.app_logging import AppLogger
+from egcg_core.exceptions import EGCGError
+
+
+class DeletionJournal(AppLogger):
+    """
+    Append-only record of the phases each sample, run or project of a deletion has been through, stored as JSON lines
+    next to the deletion dir. An interrupted deletion can then be resumed from its last checkpoint instead of
+    re-running discovery, HSM checks and sizing. Phases, in order: chosen, discovered, staging, staged, released,
+    marked, archived, deleted.
+    """
+    def __init__(self, path=None, read_only=False):
+        """
+        :param str path: journal file to load and append to. If None, the journal is only kept in memory.
+        :param bool read_only: load the journal file but do not write to it, e.g. in dry run mode
+        """
+        self.path = path
+        self.read_only = read_only
+        self.entries = OrderedDict()  # keys are resumed in the order they were recorded
+        self.truncated = False
+        if path and os.path.isfile(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                self.truncated = not line.endswith('\n')
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line is incomplete if the previous deletion died while writing it
+                    self.warning('Ignoring incomplete line in journal %s: %s', self.path, line)
+                    continue
+                self.entries[(entry['phase'], entry['key'])] = entry['data']
+
+    def record(self, phase, key, data=None):
+        """Record that key has been through a phase, flushing it to disk before returning."""
+        data = data or {}
+        self.entries[(phase, key)] = data
+        if self.path and not self.read_only:
+            line = json.dumps({'time': datetime.utcnow().isoformat(), 'phase': phase, 'key': key, 'data': data})
+            if self.truncated:
+                line = '\n' + line
+                self.truncated = False
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def done(self, phase, key):
+        return (phase, key) in self.entries
+
+    def data(self, phase, key):
+        return self.entries.get((phase, key))
+
+    def keys(self, phase):
+        """All keys recorded for a phase, in the order they were first recorded."""
+        return [k for p, k in self.entries if p == phase]
+
+    def start(self, deleter, deletion_dir):
+        """Record the start of a deletion, or check that a resumed journal was written by the same kind of Deleter."""
+        started = self.data('started', 'deletion')
+        if started is None:
+            self.record('started', 'deletion', {'deleter': deleter, 'deletion_dir': deletion_dir})
+        elif started['deleter'] != deleter:
+            raise EGCGError('Cannot resume a %s deletion with a %s deleter' % (started['deleter'], deleter))
+
+    @property
+    def deletion_dir(self):
+        started = self.data('started', 'deletion')
+        if started is None:
+            raise EGCGError('No deletion to resume in %s' % self.path)
+        return started['deletion_dir']
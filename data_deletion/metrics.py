@@ -0,0 +1,54 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Thread-safe timing spans and counters for the phases and sub-operations of a deletion, e.g. how long was spent on
+    Rest API queries or `lfs hsm_state` calls, and how many files were moved.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = OrderedDict()  # in the order they were first recorded, on Python 3.5 too
+        self.counters = {}
+
+    @contextmanager
+    def span(self, name):
+        """Time a block of code, adding to the total time and number of calls recorded under name."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            with self.lock:
+                calls, total = self.spans.get(name, (0, 0))
+                self.spans[name] = (calls + 1, total + duration)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'spans': OrderedDict((k, {'calls': c, 'seconds': round(s, 3)}) for k, (c, s) in self.spans.items()),
+                'counters': dict(self.counters)
+            }
+
+    def summary(self):
+        """Plain text table of all spans in the order they were first recorded, then all counters."""
+        metrics = self.to_dict()
+        lines = ['%-30s %8s %12s' % ('span', 'calls', 'seconds')]
+        for name, span in metrics['spans'].items():
+            lines.append('%-30s %8s %12.3f' % (name, span['calls'], span['seconds']))
+        lines.append('%-30s %21s' % ('counter', 'value'))
+        for name in sorted(metrics['counters']):
+            lines.append('%-30s %21s' % (name, metrics['counters'][name]))
+        return '\n'.join(lines)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
@@ -0,0 +1,95 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from egcg_core.app_logging import AppLogger
+from egcg_core.exceptions import EGCGError
+from data_deletion.throttling import Throttle
+
+
+def stat_entry(path, throttle=None, hsm_states=None):
+    """
+    Identity of a file or directory at planning time, to check it has not changed when the plan is applied.
+    :param str path:
+    :param Throttle throttle: optional cap on stat calls
+    :param HSMStates hsm_states: HSM state cache to take the file's state from, if it has been queried
+    :rtype: dict
+    """
+    with (throttle or Throttle()).operation():
+        st = os.lstat(path)
+    entry = {'path': path, 'inode': st.st_ino, 'size': st.st_size, 'mtime': st.st_mtime}
+    if hsm_states and path in hsm_states.states:
+        entry['hsm_state'] = hsm_states.states[path]
+    return entry
+
+
+class DeletionPlan(AppLogger):
+    """
+    Machine-readable record of what a Deleter would do: for each sample, run or file to delete, the files involved
+    with their inodes, sizes, mtimes and HSM states, the Rest API patches to apply, and the data needed to apply the
+    plan later without rediscovering it.
+    """
+    def __init__(self, deleter, created=None, items=None):
+        """
+        :param str deleter: alias of the Deleter writing the plan
+        :param str created: when the plan was written
+        :param list[dict] items:
+        """
+        self.deleter = deleter
+        self.created = created
+        self.items = items or []
+
+    def add(self, key, files, rest_patches=None, data=None):
+        """
+        :param str key: what is deleted, e.g. a sample ID
+        :param list[dict] files: stat_entry of each file or directory involved
+        :param list rest_patches: (endpoint, payload, id field, id value) of each Rest API patch to apply
+        :param dict data: anything else needed to apply the plan
+        """
+        self.items.append({'key': key, 'files': files, 'rest_patches': rest_patches or [], 'data': data or {}})
+
+    @property
+    def total_size(self):
+        """Total size of the files in the plan, counting hard links only once."""
+        inode_sizes = {}
+        for item in self.items:
+            inode_sizes.update((f['inode'], f['size']) for f in item['files'])
+        return sum(inode_sizes.values())
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'deleter': self.deleter, 'created': self.created, 'items': self.items}, f, indent=2)
+
+    @classmethod
+    def load(cls, path, deleter):
+        """Load a plan, checking that it was written by the same kind of Deleter."""
+        with open(path) as f:
+            content = json.load(f)
+        if content['deleter'] != deleter:
+            raise EGCGError('Cannot apply a %s plan with a %s deleter' % (content['deleter'], deleter))
+        return cls(content['deleter'], content['created'], content['items'])
+
+    def changed_files(self, max_workers=8, throttle=None):
+        """
+        Stat all files of the plan again.
+        :return: the files that were removed, replaced or modified since the plan was written, with the reason why
+        :rtype: dict[str, str]
+        """
+        def _check(entry):
+            try:
+                current = stat_entry(entry['path'], throttle)
+            except FileNotFoundError:
+                return entry['path'], 'missing'
+            for k in ('inode', 'size', 'mtime'):
+                if current[k] != entry[k]:
+                    return entry['path'], '%s changed from %s to %s' % (k, entry[k], current[k])
+
+        entries = [f for item in self.items for f in item['files']]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return dict(c for c in pool.map(_check, entries) if c)
+
+    def validate(self, max_workers=8, throttle=None):
+        changed = self.changed_files(max_workers, throttle)
+        if changed:
+            for f in sorted(changed):
+                self.error('%s: %s', f, changed[f])
+            raise EGCGError('%s files have changed since the deletion plan was written' % len(changed))
@@ -1,12 +1,17 @@
-from os import listdir
-from os.path import join, isdir
+from os import listdir, rmdir
+from os.path import join, isdir, basename
+from shutil import disk_usage
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 from egcg_core import rest_communication
 from egcg_core.constants import ELEMENT_RUN_NAME, ELEMENT_PROCS, ELEMENT_STATUS, DATASET_DELETED, ELEMENT_PROC_ID
 from egcg_core.config import cfg
+from egcg_core.exceptions import EGCGError
 from egcg_core.util import query_dict
 
 from data_deletion import Deleter
+from data_deletion.disk_usage import get_disk_usage, parse_size
+from data_deletion.plan import DeletionPlan, stat_entry
 
 reporting_app_date_format = '%d_%m_%Y_%H:%M:%S'
 
@@ -23,6 +28,34 @@ class RawDataDeleter(Deleter):
         threshold = datetime.timedelta(cfg['data_deletion'].get('run_age_threshold_in_days', 14))
         self.deletion_threshold = self._now() - threshold
 
+        self.target_bytes = self.cmd_args.target_bytes
+        self.target_free_fraction = self.cmd_args.target_free_fraction
+        self.selection_order = self.cmd_args.selection_order
+        self.newest_useable_dates = {}
+        self.run_sizes = {}
+        self.run_workers = cfg['data_deletion'].get('run_workers', 4)
+        self.failed_runs = {}
+        self.archived_runs = set()
+
+    @staticmethod
+    def add_args(argparser):
+        Deleter.add_args(argparser)  # super() doesn't work when calling statically
+        target = argparser.add_mutually_exclusive_group()
+        target.add_argument('--target_bytes', type=parse_size, default=None,
+                            help='Select runs until this much would be freed, e.g. 80T')
+        target.add_argument('--target_free_fraction', type=float, default=None,
+                            help='Select runs until this fraction of the raw data filesystem would be free')
+        argparser.add_argument('--selection_order', choices=('oldest', 'largest'), default='oldest',
+                               help='Order in which runs are selected when a target is given')
+
+    def _bytes_to_free(self):
+        """How much to free to reach --target_bytes or --target_free_fraction, or None if neither was given."""
+        if self.target_bytes is not None:
+            return self.target_bytes
+        if self.target_free_fraction is not None:
+            usage = disk_usage(self.raw_data_dir)
+            return max(int(usage.total * self.target_free_fraction) - usage.free, 0)
+
     def deletable_runs(self):
         manual_runs = [
             rest_communication.get_document('runs', where={'run_id': run_id})
@@ -37,85 +70,270 @@ class RawDataDeleter(Deleter):
         )
         # filter out the run with no review status so we only have run that have been reviewed
         auto_runs = [r for r in auto_runs if query_dict(r, 'aggregated.review_statuses')]
-        runs = manual_runs + [r for r in auto_runs if self._run_old_enough_for_deletion(r['run_id'])]
-        return runs[:self.deletion_limit]
+        bytes_to_free = self._bytes_to_free()
+        if bytes_to_free is not None:
+            return self._runs_within_budget(manual_runs, self._old_enough_runs(auto_runs), bytes_to_free)
 
-    def _run_element_old_enough_for_deletion(self, run_element):
-        useable_date = run_element.get('useable_date')
-        if useable_date and datetime.datetime.strptime(useable_date, reporting_app_date_format) <= self.deletion_threshold:
-            return True
+        if self.deletion_limit is None:
+            limit = None
         else:
-            return False
+            limit = max(self.deletion_limit - len(manual_runs), 0)
+        return (manual_runs + self._old_enough_runs(auto_runs, limit))[:self.deletion_limit]
 
-    def _run_old_enough_for_deletion(self, run_id):
-        run_elements = rest_communication.get_documents(
-            'run_elements',
-            where={'run_id': run_id, 'barcode': {'$ne': 'unknown'}},
-            all_pages=True
-        )
-        if run_elements:
-            return all(self._run_element_old_enough_for_deletion(e) for e in run_elements)
+    def _run_size(self, run_id):
+        """Size of the deletable dirs of a run, i.e. what deleting it would free."""
+        if run_id not in self.run_sizes:
+            raw_data = join(self.raw_data_dir, run_id)
+            deletable_dirs = [join(raw_data, d) for d in self.deletable_sub_dirs if isdir(join(raw_data, d))]
+            self.run_sizes[run_id] = get_disk_usage(deletable_dirs, throttle=self.throttle).total_size
+        return self.run_sizes[run_id]
+
+    def _runs_within_budget(self, manual_runs, auto_runs, bytes_to_free):
+        """
+        Select runs until deleting them would free bytes_to_free. The manually deleted runs are always selected, then
+        the others are added oldest-first or largest-first depending on --selection_order. Runs are only sized as
+        they are considered, except when selecting largest-first.
+        """
+        if self.selection_order == 'largest':
+            auto_runs = sorted(auto_runs, key=lambda r: self._run_size(r[ELEMENT_RUN_NAME]), reverse=True)
         else:
-            return False
+            auto_runs = sorted(auto_runs, key=lambda r: self.newest_useable_dates[r[ELEMENT_RUN_NAME]])
+
+        runs = list(manual_runs)
+        with self.metrics.span('size_runs'):
+            projected_bytes = sum(self._run_size(r[ELEMENT_RUN_NAME]) for r in runs)
+            for run in auto_runs:
+                if projected_bytes >= bytes_to_free:
+                    break
+                if self.deletion_limit is not None and len(runs) >= self.deletion_limit:
+                    break
+                runs.append(run)
+                projected_bytes += self._run_size(run[ELEMENT_RUN_NAME])
+
+        self.metrics.count('bytes_to_delete', projected_bytes)
+        self.info(
+            'Selected %s runs to free %.2f G of the %.2f G targeted', len(runs), projected_bytes / 1000000000,
+            bytes_to_free / 1000000000
+        )
+        if projected_bytes < bytes_to_free:
+            self.warning('Not enough deletable runs to reach the target')
+        return runs
+
+    def _old_enough_runs(self, runs, limit=None):
+        """
+        Select the runs whose run elements are all old enough for deletion, in order. The run elements are fetched
+        with concurrent `$in` queries over one batch of runs at a time, stopping as soon as limit runs are found.
+        """
+        old_enough_runs = []
+        batch_size = self.rest_query_size * self.rest_workers
+        for i in range(0, len(runs), batch_size):
+            if limit is not None and len(old_enough_runs) >= limit:
+                break
+            batch = runs[i:i + batch_size]
+            run_elements = self._get_documents_in(
+                'run_elements', ELEMENT_RUN_NAME, [r[ELEMENT_RUN_NAME] for r in batch],
+                where={'barcode': {'$ne': 'unknown'}}
+            )
+            newest_dates = self._newest_useable_dates(run_elements)
+            self.newest_useable_dates.update(newest_dates)
+            for r in batch:
+                newest_date = newest_dates.get(r[ELEMENT_RUN_NAME])
+                if newest_date and newest_date <= self.deletion_threshold:
+                    old_enough_runs.append(r)
+        return old_enough_runs[:limit]
+
+    @staticmethod
+    def _newest_useable_dates(run_elements):
+        """
+        Newest useable date of each run in one pass over its run elements, or None if any of them has no useable date.
+        :rtype: dict[str, datetime.datetime]
+        """
+        newest_dates = {}
+        for e in run_elements:
+            run_id = e[ELEMENT_RUN_NAME]
+            if run_id in newest_dates and newest_dates[run_id] is None:
+                continue
+            useable_date = e.get('useable_date')
+            if not useable_date:
+                newest_dates[run_id] = None
+                continue
+            useable_date = datetime.datetime.strptime(useable_date, reporting_app_date_format)
+            if run_id not in newest_dates or useable_date > newest_dates[run_id]:
+                newest_dates[run_id] = useable_date
+        return newest_dates
 
     def _setup_run_for_deletion(self, run_id):
         raw_data = join(self.raw_data_dir, run_id)
         deletable_data = join(self.deletion_dir, run_id)
         self.debug('Creating deletion dir: ' + deletable_data)
-        self._execute('mkdir -p ' + deletable_data)
+        self._mkdir(deletable_data)
+
+        manifest = self.move_files(
+            [(join(raw_data, d), join(deletable_data, d)) for d in self.deletable_sub_dirs if isdir(join(raw_data, d))]
+        )
+        deletable_dirs = listdir(deletable_data)  # Data, Thumbnail_Images, etc.
+        self._compare_lists(deletable_dirs, [basename(d) for d in manifest.values()])
+        return deletable_dirs
+
+    def _for_each_run(self, func, runs):
+        """
+        Call func on up to self.run_workers runs at once. A run that fails is logged and recorded in self.failed_runs,
+        without stopping the others.
+        :return: the runs func succeeded on, in order
+        """
+        def _try(run):
+            try:
+                func(run)
+            except Exception as e:
+                self.error('%s failed for run %s: %s', func.__name__, run[ELEMENT_RUN_NAME], e)
+                self.failed_runs[run[ELEMENT_RUN_NAME]] = '%s: %s' % (func.__name__, e)
+                return False
+            return True
 
-        for d in self.deletable_sub_dirs:
-            from_d = join(raw_data, d)
-            if isdir(from_d):
-                to_d = join(deletable_data, d)
-                self._execute('mv %s %s' % (from_d, to_d))
+        with ThreadPoolExecutor(max_workers=self.run_workers) as pool:
+            succeeded = list(pool.map(_try, runs))
+        return [r for r, ok in zip(runs, succeeded) if ok]
 
-        return listdir(deletable_data)  # Data, Thumbnail_Images, etc.
+    def _stage_run(self, run):
+        deletable_dirs = self._setup_run_for_deletion(run[ELEMENT_RUN_NAME])
+        if sorted(self.deletable_sub_dirs) != sorted(deletable_dirs):
+            self.warning(
+                'Not all deletable dirs were present for run %s: %s',
+                run[ELEMENT_RUN_NAME],
+                [d for d in self.deletable_sub_dirs if d not in deletable_dirs]
+            )
 
     def setup_runs_for_deletion(self, runs):
-        run_ids = [r[ELEMENT_RUN_NAME] for r in runs]
-        for run in run_ids:
-            deletable_dirs = self._setup_run_for_deletion(run)
-            if sorted(self.deletable_sub_dirs) != sorted(deletable_dirs):
-                self.warning(
-                    'Not all deletable dirs were present for run %s: %s',
-                    run,
-                    [d for d in self.deletable_sub_dirs if d not in deletable_dirs]
-                )
+        """
+        Stage the deletable dirs of several runs concurrently.
+        :return: the runs staged successfully
+        """
+        # resolved once before the workers start, since it is named after the current time
+        deletion_dir = self.deletion_dir
+        staged_runs = self._for_each_run(self._stage_run, runs)
+        staged_run_ids = [r[ELEMENT_RUN_NAME] for r in staged_runs]
+        self._compare_lists([d for d in listdir(deletion_dir) if d not in self.failed_runs], staged_run_ids)
+        return staged_runs
 
-        self._compare_lists(listdir(self.deletion_dir), run_ids)
+    def _restore_run(self, run_id):
+        """
+        Move back the dirs staged for a run that could not be archived to the raw data dir, so that it can be deleted
+        later.
+        :return: whether nothing of the run is left in the deletion dir
+        """
+        staged_run = join(self.deletion_dir, run_id)
+        if not isdir(staged_run):
+            return True
+        run_dir = join(self.raw_data_dir, run_id)
+        if not isdir(run_dir):
+            self.error('Could not restore the staged dirs of run %s: %s does not exist', run_id, run_dir)
+            return False
+        try:
+            self.move_files([(join(staged_run, d), join(run_dir, d)) for d in listdir(staged_run)])
+            rmdir(staged_run)
+        except (OSError, EGCGError) as e:
+            self.error('Could not restore the staged dirs of run %s to %s: %s', run_id, run_dir, e)
+            return False
+        return True
+
+    def _archive_and_mark_run(self, run):
+        run_id = run[ELEMENT_RUN_NAME]
+        assert listdir(join(self.deletion_dir, run_id))
+        assert listdir(join(self.raw_data_dir, run_id))
+        self.archive_run(run_id)
+        assert listdir(join(self.archive_dir, run_id))
+        self.archived_runs.add(run_id)
+        self.mark_run_as_deleted(run)
+
+    @staticmethod
+    def _deletion_patch(run):
+        return ELEMENT_PROCS, {ELEMENT_STATUS: DATASET_DELETED}, ELEMENT_PROC_ID, \
+            run['aggregated']['most_recent_proc'][ELEMENT_PROC_ID]
 
     def mark_run_as_deleted(self, run):
         self.debug('Updating dataset status for ' + run[ELEMENT_RUN_NAME])
         if not self.dry_run:
-            rest_communication.patch_entry(
-                ELEMENT_PROCS,
-                {ELEMENT_STATUS: DATASET_DELETED},
-                ELEMENT_PROC_ID,
-                run['aggregated']['most_recent_proc'][ELEMENT_PROC_ID]
+            rest_communication.patch_entry(*self._deletion_patch(run))
+            self.metrics.count('rest_patches')
+
+    def _plan_runs(self, runs):
+        """Write the deletable dirs, sizes and Rest API patch of each run to the plan file given with --write_plan."""
+        plan = DeletionPlan(self.alias, self._strnow())
+        for run in runs:
+            raw_data = join(self.raw_data_dir, run[ELEMENT_RUN_NAME])
+            deletable_dirs = [join(raw_data, d) for d in self.deletable_sub_dirs if isdir(join(raw_data, d))]
+            plan.add(
+                run[ELEMENT_RUN_NAME],
+                [stat_entry(d, self.throttle) for d in deletable_dirs],
+                [self._deletion_patch(run)],
+                {'run': run, 'size': self._run_size(run[ELEMENT_RUN_NAME])}
             )
+        self._save_plan(plan)
 
     def archive_run(self, run_id):
         run_to_be_archived = join(self.raw_data_dir, run_id)
         self.debug('Archiving ' + run_id)
         assert not any([d in self.deletable_sub_dirs for d in listdir(run_to_be_archived)])
-        self._execute('mv %s %s' % (join(self.raw_data_dir, run_id), join(self.archive_dir, run_id)))
+        self.move_files([(join(self.raw_data_dir, run_id), join(self.archive_dir, run_id))])
 
     def delete_data(self):
-        deletable_runs = self.deletable_runs()
+        with self.metrics.span('discovery'):
+            if self.apply_plan:
+                deletable_runs = [item['data']['run'] for item in self._load_plan().items]
+            else:
+                deletable_runs = self.deletable_runs()
         self.debug('Found %s runs for deletion: %s', len(deletable_runs), [r[ELEMENT_RUN_NAME] for r in deletable_runs])
+        if self.write_plan:
+            self._plan_runs(deletable_runs)
+            return 0
+
         if self.dry_run or not deletable_runs:
             return 0
 
-        self.setup_runs_for_deletion(deletable_runs)
-        runs_to_delete = listdir(self.deletion_dir)
-        self._compare_lists(runs_to_delete, [run[ELEMENT_RUN_NAME] for run in deletable_runs])
-        assert all([listdir(join(self.raw_data_dir, r)) for r in runs_to_delete])
+        # measured before staging, since moving runs to a work_dir on another device already frees their space
+        free_space = disk_usage(self.raw_data_dir).free
+        with self.metrics.span('setup'):
+            staged_runs = self.setup_runs_for_deletion(deletable_runs)
+
+        with self.metrics.span('archive_and_mark_as_deleted'):
+            deleted_runs = [r[ELEMENT_RUN_NAME] for r in self._for_each_run(self._archive_and_mark_run, staged_runs)]
+
+        # runs archived but not marked as deleted can no longer be staged from the raw data dir, so their staged dirs
+        # are deleted anyway and the Rest API patch is reported
+        unmarked_runs = []
+        for run in staged_runs:
+            run_id = run[ELEMENT_RUN_NAME]
+            if run_id in self.archived_runs and run_id in self.failed_runs:
+                self.error('Run %s was archived but could not be marked as deleted, patch %s manually',
+                           run_id, self._deletion_patch(run))
+                self.failed_runs[run_id] += ' - archived and deleted, but not marked as deleted'
+                unmarked_runs.append(run_id)
 
-        for run in deletable_runs:
-            assert run[ELEMENT_RUN_NAME] in runs_to_delete
-            self.mark_run_as_deleted(run)
-            self.archive_run(run[ELEMENT_RUN_NAME])
-            assert listdir(join(self.archive_dir, run[ELEMENT_RUN_NAME]))
+        # other runs that failed are left as they were, so they can be deleted later
+        left_in_deletion_dir = [
+            r for r in sorted(self.failed_runs) if r not in self.archived_runs and not self._restore_run(r)
+        ]
+        runs_to_delete = deleted_runs + unmarked_runs
+        if left_in_deletion_dir:
+            for run_id in runs_to_delete:
+                self.delete_dir(join(self.deletion_dir, run_id))
+        elif runs_to_delete:
+            self.delete_dir(self.deletion_dir)
+        else:
+            rmdir(self.deletion_dir)
 
-        self.delete_dir(self.deletion_dir)
+        bytes_freed = disk_usage(self.raw_data_dir).free - free_space
+        self.metrics.count('bytes_freed', bytes_freed)
+        self.info(
+            'Deleted %s runs, freeing %.2f G on the raw data filesystem', len(runs_to_delete), bytes_freed / 1000000000
+        )
+
+        if self.failed_runs:
+            self.metrics.count('failed_runs', len(self.failed_runs))
+            if left_in_deletion_dir:
+                self.error('Staged dirs of runs %s left in %s', left_in_deletion_dir, self.deletion_dir)
+            raise EGCGError(
+                'Could not delete %s runs: %s' % (
+                    len(self.failed_runs), ', '.join('%s (%s)' % (k, v) for k, v in sorted(self.failed_runs.items()))
+                )
+            )
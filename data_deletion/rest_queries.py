@@ -0,0 +1,42 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from egcg_core.rest_communication import Communicator
+
+_local = threading.local()
+
+
+def _communicator():
+    """One Communicator per thread, since a Communicator sends its requests one at a time behind a lock."""
+    if not hasattr(_local, 'communicator'):
+        _local.communicator = Communicator()
+    return _local.communicator
+
+
+def chunks(values, chunk_size):
+    values = list(values)
+    return [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+
+
+def get_documents_in(endpoint, field, values, chunk_size=100, max_workers=4, where=None):
+    """
+    Get all documents where field is one of values, with one `$in` query per chunk of values. The queries run
+    concurrently and all their pages are merged.
+    :param str endpoint:
+    :param str field: the field to query on, e.g. 'sample_id'
+    :param values: the values field can take
+    :param int chunk_size: maximum number of values per query
+    :param int max_workers: maximum number of queries running at once
+    :param dict where: additional query terms
+    :rtype: list[dict]
+    """
+    def _query(chunk):
+        _where = dict(where or {})
+        _where[field] = {'$in': chunk}
+        return _communicator().get_documents(endpoint, quiet=True, where=_where, all_pages=True)
+
+    values = sorted(set(values))
+    if not values:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return [doc for docs in pool.map(_query, chunks(values, chunk_size)) for doc in docs]
@@ -0,0 +1,101 @@
+import time
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+
+def _parse_time(t):
+    return datetime.strptime(t, '%H:%M').time()
+
+
+class Throttle:
+    """
+    Thread-safe cap on the rate and concurrency of filesystem metadata operations (stats, renames, unlinks, HSM calls),
+    to avoid overloading a shared Lustre metadata server. Limits can be overridden during time-of-day windows, and a
+    throttle can be chained to a parent so that both sets of limits apply.
+    """
+    def __init__(self, max_ops_per_second=None, max_concurrent_ops=None, windows=None, parent=None):
+        """
+        :param float max_ops_per_second: maximum number of operations started per second
+        :param int max_concurrent_ops: maximum number of operations running at once
+        :param list[dict] windows: time-of-day overrides, each with a start and end time as 'HH:MM' and optionally
+                                   max_ops_per_second and max_concurrent_ops. Windows can wrap around midnight.
+        :param Throttle parent: another throttle that all operations also go through
+        """
+        self.max_ops_per_second = max_ops_per_second
+        self.max_concurrent_ops = max_concurrent_ops
+        self.windows = [
+            (
+                _parse_time(w['start']),
+                _parse_time(w['end']),
+                w.get('max_ops_per_second', max_ops_per_second),
+                w.get('max_concurrent_ops', max_concurrent_ops)
+            )
+            for w in windows or []
+        ]
+        self.parent = parent
+        self.condition = threading.Condition()
+        self.active_ops = 0
+        self.next_slot = time.monotonic()
+
+    @classmethod
+    def from_config(cls, config, parent=None):
+        """
+        Build a throttle from a config section, e.g. data_deletion.throttling:
+            max_ops_per_second: 2000
+            max_concurrent_ops: 16
+            windows:
+                - {start: '08:00', end: '20:00', max_ops_per_second: 200, max_concurrent_ops: 4}
+        """
+        config = config or {}
+        return cls(
+            config.get('max_ops_per_second'), config.get('max_concurrent_ops'), config.get('windows'), parent
+        )
+
+    @staticmethod
+    def _now():
+        return datetime.now().time()
+
+    def limits(self):
+        """The (max_ops_per_second, max_concurrent_ops) applying at the current time of day."""
+        now = self._now()
+        for start, end, max_ops_per_second, max_concurrent_ops in self.windows:
+            if (start <= now < end) if start <= end else (now >= start or now < end):
+                return max_ops_per_second, max_concurrent_ops
+        return self.max_ops_per_second, self.max_concurrent_ops
+
+    def _wait_for_slot(self, max_ops_per_second, nb_ops):
+        if not max_ops_per_second:
+            return
+
+        with self.condition:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + nb_ops / max_ops_per_second
+
+        if slot > now:
+            time.sleep(slot - now)
+
+    @contextmanager
+    def operation(self, nb_ops=1):
+        """
+        Wait until an operation is allowed to start, and hold a concurrency slot while it runs.
+        :param int nb_ops: number of metadata operations this counts as, e.g. the number of files in a batched call
+        """
+        max_ops_per_second, max_concurrent_ops = self.limits()
+        with self.condition:
+            while max_concurrent_ops and self.active_ops >= max_concurrent_ops:
+                self.condition.wait()
+            self.active_ops += 1
+
+        try:
+            self._wait_for_slot(max_ops_per_second, nb_ops)
+            if self.parent:
+                with self.parent.operation(nb_ops):
+                    yield
+            else:
+                yield
+        finally:
+            with self.condition:
+                self.active_ops -= 1
+                self.condition.notify()
@@ -1,7 +1,8 @@
 import os
 from shutil import rmtree
 from datetime import timedelta
-from unittest.mock import Mock, patch
+from unittest.mock import patch
+from tests import NamedMock
 from integration_tests import IntegrationTest, integration_cfg, setup_delivered_samples, \
     setup_samples_deleted_from_tier1
 from egcg_core import rest_communication, archive_management
@@ -13,17 +14,21 @@ work_dir = os.path.dirname(__file__)
 
 
 def fake_get_sample(sample_id):
-    m = Mock(udf={})
+    m = NamedMock(name=sample_id, udf={})
     if sample_id == 'sample_4':
         m.udf['2D Barcode'] = 'sample_4_2d_barcode'
 
     return m
 
 
+def fake_get_list_of_samples(sample_ids):
+    return [fake_get_sample(s) for s in sample_ids]
+
+
 class TestDeletion(IntegrationTest):
     patches = (
         patch('data_deletion.client.load_config'),
-        patch('data_deletion.clarity.get_sample', new=fake_get_sample)
+        patch('data_deletion.delivered_index.clarity.get_list_of_samples', new=fake_get_list_of_samples)
     )
 
     @staticmethod
@@ -4,7 +4,8 @@ from time import sleep
 from egcg_core import archive_management, rest_communication
 from egcg_core.config import cfg
 from egcg_core.exceptions import EGCGError
-from unittest.mock import Mock, patch
+from unittest.mock import patch
+from tests import NamedMock
 from integration_tests import IntegrationTest, integration_cfg, setup_delivered_samples
 import data_deletion.client
 from bin import recall_sample
@@ -19,7 +20,10 @@ class TestRecall(IntegrationTest):
     fastq_archive_dir = os.path.join(work_dir, 'fastq_archives')
     processed_archive_dir = os.path.join(work_dir, 'processed_archives')
     patches = (
-        patch('data_deletion.clarity.get_sample', return_value=Mock(udf={})),
+        patch(
+            'data_deletion.delivered_index.clarity.get_list_of_samples',
+            new=lambda sample_ids: [NamedMock(name=s, udf={}) for s in sample_ids]
+        ),
     )
 
     @classmethod
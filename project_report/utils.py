@@ -5,6 +5,7 @@ from math import ceil
 import pandas as pd
 import matplotlib
 from egcg_core.util import query_dict
+from data_deletion.disk_usage import get_disk_usage
 
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
@@ -38,14 +39,7 @@ def get_folder_size(folder):
     :param folder: The folder to be sized
     :return: the size of the folder
     """
-    total_size = os.path.getsize(folder)
-    for item in os.listdir(folder):
-        itempath = os.path.join(folder, item)
-        if os.path.isfile(itempath):
-            total_size += os.path.getsize(itempath)
-        elif os.path.isdir(itempath):
-            total_size += get_folder_size(itempath)
-    return total_size
+    return get_disk_usage([folder]).total_size
 
 
 def yield_vs_coverage_plot(project_information, working_dir):
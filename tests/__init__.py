@@ -1,4 +1,5 @@
 import hashlib
+import tempfile
 from os.path import join, dirname, abspath
 from egcg_core.config import cfg
 from unittest import TestCase
@@ -22,6 +23,10 @@ class TestProjectManagement(TestCase):
     @classmethod
     def setUpClass(cls):
         cfg.load_config_file(join(cls.root_path, 'etc', cls.config_file))
+        # keep the notification logs written by the tests out of the source tree
+        log_notification = cfg.query('notifications', 'log')
+        if log_notification and 'log_file' in log_notification:
+            log_notification['log_file'] = join(tempfile.gettempdir(), 'project_management_notifications.log')
 
     @staticmethod
     def md5(fname):
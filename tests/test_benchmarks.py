@@ -0,0 +1,46 @@
+import tempfile
+from shutil import rmtree
+from egcg_core import rest_communication
+from egcg_core.config import cfg
+from benchmarks import run_benchmarks
+from benchmarks.fake_services import matches
+from benchmarks.synthetic_data import scales
+from tests import TestProjectManagement
+
+
+class TestFakeRestAPI(TestProjectManagement):
+    def test_matches(self):
+        doc = {'sample_id': 's1', 'aggregated': {'run_ids': ['r1', 'r2']}, 'data_deleted': 'none'}
+        assert matches(doc, {'sample_id': 's1'})
+        assert matches(doc, {'aggregated.run_ids': 'r2'})
+        assert matches(doc, {'sample_id': {'$in': ['s1', 's2']}, 'data_deleted': {'$ne': 'all'}})
+        assert matches(doc, {'$or': [{'sample_id': 's2'}, {'aggregated.run_ids': {'$in': ['r1']}}]})
+        assert not matches(doc, {'sample_id': {'$nin': ['s1']}})
+        assert not matches(doc, {'missing.key': 'value'})
+        with self.assertRaises(ValueError):
+            matches(doc, {'sample_id': {'$regex': 's'}})
+
+
+class TestBenchmarks(TestProjectManagement):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cfg_content = cfg.content
+
+    def tearDown(self):
+        cfg.content = self.cfg_content
+        rmtree(self.work_dir)
+
+    def test_run_benchmarks(self):
+        config, baseurl = cfg.content, rest_communication.default._baseurl
+        results = run_benchmarks(scales['tiny'], self.work_dir, ('raw', 'delivered_data', 'final_deletion', 'dmf_deletion'))
+        # the config and Rest API url are restored
+        assert cfg.content is config
+        assert rest_communication.default._baseurl == baseurl
+        deleters = dict((r['deleter'], r) for r in results['deleters'])
+        assert sorted(deleters) == ['delivered_data', 'dmf_deletion', 'final_deletion', 'raw']
+
+        assert deleters['raw']['metrics']['counters']['rest_patches'] == 2
+        assert deleters['delivered_data']['metrics']['counters']['rest_patches'] == 4
+        assert deleters['final_deletion']['metrics']['counters']['rest_patches'] == 4
+        assert deleters['dmf_deletion']['metrics']['counters']['files_deleted'] == 10
+        assert deleters['dmf_deletion']['lfs_calls'] < 100  # FIDs are looked up in batches
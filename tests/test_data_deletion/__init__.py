@@ -1,6 +1,13 @@
+import os
+import json
+import errno
 from os.path import join
+from shutil import rmtree
 from unittest.mock import Mock, patch
+from egcg_core.config import cfg
+from egcg_core.exceptions import EGCGError
 from data_deletion import Deleter
+from data_deletion.file_operations import delete_tree
 from tests import TestProjectManagement
 
 
@@ -14,7 +21,19 @@ class TestDeleter(TestProjectManagement):
         dry_run=None,
         deletion_limit=None,
         manual_delete=[],
-        sample_ids=[]
+        sample_ids=[],
+        delete_engine='cluster',
+        max_delete_rate=None,
+        resume=None,
+        write_plan=None,
+        apply_plan=None,
+        target_bytes=None,
+        target_free_fraction=None,
+        selection_order='oldest',
+        full_scan=False,
+        shard=None,
+        shards=None,
+        shard_engine='local'
     )
 
     def setUp(self):
@@ -24,6 +43,86 @@ class TestDeleter(TestProjectManagement):
         with patch.object(self.deleter.__class__, '_strnow', return_value='t'):
             assert self.deleter.deletion_dir == join(self.deleter.work_dir, '.data_deletion_t')
 
+    def test_throttle(self):
+        with patch.dict(cfg.content['data_deletion'], {'throttling': {'max_ops_per_second': 100}}):
+            deleter = self.deleter.__class__(self.cmd_args)
+        assert deleter.throttle.limits() == (100, None)
+        assert deleter.hsm_states.throttle is deleter.throttle
+        assert deleter.delete_throttle.parent is deleter.throttle
+
+    def test_move_files(self):
+        source_dir = join(self.assets_deletion, 'files_to_move')
+        dest_dir = join(self.assets_deletion, 'moved_files')
+        os.makedirs(join(source_dir, 'a_dir'), exist_ok=True)
+        os.makedirs(dest_dir, exist_ok=True)
+        open(join(source_dir, 'a_file'), 'w').close()
+        moves = [(join(source_dir, f), join(dest_dir, f)) for f in ('a_file', 'a_dir')]
+
+        assert self.deleter.move_files(moves) == dict(moves)
+        assert os.listdir(source_dir) == []
+        assert sorted(os.listdir(dest_dir)) == ['a_dir', 'a_file']
+
+        with self.assertRaises(EGCGError) as e:
+            self.deleter.move_files([(join(source_dir, 'a_file'), join(dest_dir, 'another_file'))])
+        assert str(e.exception) == 'Could not move 1 files: %s' % [join(source_dir, 'a_file')]
+        rmtree(source_dir)
+        rmtree(dest_dir)
+
+    @patch('data_deletion.file_operations.os.rename', side_effect=OSError(errno.EXDEV, 'Invalid cross-device link'))
+    def test_move_files_across_devices(self, mocked_rename):
+        source_dir = join(self.assets_deletion, 'files_to_move')
+        dest_dir = join(self.assets_deletion, 'moved_files')
+        os.makedirs(join(source_dir, 'a_dir'), exist_ok=True)
+        os.makedirs(dest_dir, exist_ok=True)
+        with open(join(source_dir, 'a_dir', 'a_file'), 'w') as f:
+            f.write('some data')
+
+        self.deleter.move_files([(join(source_dir, 'a_dir'), join(dest_dir, 'a_dir'))])
+        assert os.listdir(source_dir) == []
+        with open(join(dest_dir, 'a_dir', 'a_file')) as f:
+            assert f.read() == 'some data'
+        rmtree(source_dir)
+        rmtree(dest_dir)
+
+    def _setup_tree(self, top):
+        for d in ('a_run/Data/Intensities', 'a_run/Logs', 'another_run/Thumbnail_Images'):
+            os.makedirs(join(top, d), exist_ok=True)
+        for f in ('a_run/Data/Intensities/a_file', 'a_run/Logs/a_log', 'another_run/Thumbnail_Images/a_jpg'):
+            with open(join(top, f), 'w') as open_file:
+                open_file.write('some data')
+
+    @patch.object(Deleter, 'info')
+    def test_delete_dir_local_parallel(self, mocked_log):
+        top = join(self.assets_deletion, 'tree_to_delete')
+        self._setup_tree(top)
+        self.deleter.delete_engine = 'local-parallel'
+        with patch('data_deletion.delete_tree', wraps=delete_tree) as mocked_delete_tree:
+            self.deleter.delete_dir(top)
+        assert not os.path.exists(top)
+        # --max_delete_rate only caps the unlinks
+        mocked_delete_tree.assert_called_once_with(
+            top, max_workers=8, throttle=self.deleter.throttle, unlink_throttle=self.deleter.delete_throttle
+        )
+        assert mocked_log.call_args[0][0] == 'Deleted %s files (%.2f G) in %.1fs: %.1f files/s, %.2f M/s'
+        assert mocked_log.call_args[0][1] == 3
+
+    def test_delete_dir_cluster(self):
+        top = join(self.assets_deletion, 'tree_to_delete')
+        self._setup_tree(top)
+        self.deleter._execute = mocked_execute = Mock(
+            side_effect=lambda *cmds, cluster_execution: rmtree(join(top, 'a_run', 'Data'))
+        )
+        self.deleter.delete_engine = 'cluster'
+        self.deleter.cluster_delete_jobs = 2
+        self.deleter.delete_dir(top)
+        mocked_execute.assert_called_once_with(
+            'rm -rf %s %s' % (join(top, 'a_run', 'Data'), join(top, 'another_run', 'Thumbnail_Images')),
+            'rm -rf %s' % join(top, 'a_run', 'Logs'),
+            cluster_execution=True
+        )
+        # the local clean up is left with the files the job did not remove
+        assert not os.path.exists(top)
+
     @patch('egcg_core.notifications.log.LogNotification.notify')
     def test_crash_report(self, mocked_notify):
         patched_delete = patch.object(self.deleter.__class__, 'delete_data', side_effect=ValueError('Something broke'))
@@ -31,3 +130,21 @@ class TestDeleter(TestProjectManagement):
             self.deleter.run()
 
         assert 'ValueError: Something broke' in mocked_notify.call_args[0][0]
+        assert 'Metrics up to the failure:' in mocked_notify.call_args[0][0]
+        with open(self.deleter.metrics_file) as f:
+            assert 'delete_data' in json.load(f)['spans']
+        os.remove(self.deleter.metrics_file)
+
+    def test_run_metrics(self):
+        def fake_delete_data():
+            self.deleter.metrics.count('files_moved', 2)
+
+        patched_delete = patch.object(self.deleter.__class__, 'delete_data', side_effect=fake_delete_data)
+        with patch.object(self.deleter.__class__, 'info') as mocked_log, patched_delete:
+            self.deleter.run()
+        mocked_log.assert_called_with('Deletion metrics:\n%s', self.deleter.metrics.summary())
+        with open(self.deleter.metrics_file) as f:
+            metrics = json.load(f)
+        assert metrics['spans']['delete_data']['calls'] == 1
+        assert metrics['counters'] == {'files_moved': 2}
+        os.remove(self.deleter.metrics_file)
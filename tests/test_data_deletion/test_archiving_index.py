@@ -0,0 +1,57 @@
+from unittest.mock import Mock
+from data_deletion.archiving_index import ArchivingIndex
+from tests import TestProjectManagement
+
+run_elements = [
+    {'run_id': 'a_run', 'project_id': 'a_project', 'sample_id': 'sample1'},
+    {'run_id': 'a_run', 'project_id': 'another_project', 'sample_id': 'sample3'},
+    {'run_id': 'a_run', 'project_id': 'default', 'sample_id': 'Undetermined'},
+    {'run_id': 'another_run', 'project_id': 'a_project', 'sample_id': 'sample2'}
+]
+project_samples = [
+    {'sample_id': 'sample1', 'project_id': 'a_project', 'data_deleted': 'on lustre'},
+    {'sample_id': 'sample2', 'project_id': 'a_project', 'data_deleted': 'all'}
+]
+other_samples = [{'sample_id': 'sample3', 'project_id': 'another_project', 'data_deleted': 'on lustre'}]
+
+
+class TestArchivingIndex(TestProjectManagement):
+    def setUp(self):
+        self.get_documents_in = Mock(side_effect=[run_elements, project_samples, other_samples])
+        self.index = ArchivingIndex(self.get_documents_in)
+        self.index.add(['a_run', 'another_run'], ['a_project'])
+
+    def test_add(self):
+        self.get_documents_in.assert_any_call('run_elements', 'run_id', ['a_run', 'another_run'])
+        self.get_documents_in.assert_any_call('samples', 'project_id', ['a_project'])
+        # only the samples from other projects are queried by sample id
+        self.get_documents_in.assert_called_with('samples', 'sample_id', ['sample3'])
+        assert self.index.run_samples == {'a_run': {'sample1', 'sample3'}, 'another_run': {'sample2'}}
+        assert self.index.project_samples == {'a_project': {'sample1', 'sample2'}}
+        assert self.index.sample_states == {'sample1': 'on lustre', 'sample2': 'all', 'sample3': 'on lustre'}
+
+        self.index.add(['a_run'], ['a_project'])
+        assert self.get_documents_in.call_count == 3
+
+    def test_blockers(self):
+        assert self.index.run_blockers('a_run') == ['sample1', 'sample3']
+        assert self.index.run_blockers('a_run', deleted=['sample1']) == ['sample3']
+        assert self.index.run_blockers('another_run') == []
+        assert self.index.project_blockers('a_project') == ['sample1']
+
+        self.index.mark_deleted(['sample1'])
+        assert self.index.run_blockers('a_run') == ['sample3']
+        assert self.index.project_blockers('a_project') == []
+
+    def test_blockers_unindexed(self):
+        # samples not found in the Rest API block their run
+        self.get_documents_in.side_effect = [[{'run_id': 'a_new_run', 'sample_id': 'sample4'}], []]
+        assert self.index.run_blockers('a_new_run') == ['sample4']
+        assert self.index.state('sample4') is None
+
+    def test_report(self):
+        report = self.index.report(deleted=['sample1'])
+        assert report.archivable_runs == ['another_run']
+        assert report.archivable_projects == ['a_project']
+        assert report.blocked_runs == {'a_run': ['sample3']}
+        assert report.blocked_projects == {}
@@ -1,10 +1,18 @@
 import os
+import time
+from shutil import rmtree
 from datetime import datetime
 from unittest.mock import patch, Mock, PropertyMock
-from data_deletion import ProcessedSample
+from data_deletion import ProcessedSample, disk_usage
+from data_deletion.hsm import HSMStates
 from data_deletion.delivered_data import DeliveredDataDeleter
-from egcg_core.exceptions import ArchivingError
-from tests import TestProjectManagement
+from data_deletion.delivered_index import DeliveredDataIndex, _lims_names
+from data_deletion.final_data import FinalDataDeleter
+from data_deletion.journal import DeletionJournal
+from data_deletion.plan import DeletionPlan
+from egcg_core.exceptions import ArchivingError, EGCGError
+from tests import TestProjectManagement, NamedMock
+from benchmarks.fake_services import FakeLustre
 from tests.test_data_deletion import TestDeleter, patched_patch_entry
 
 run_elements1 = [
@@ -83,14 +91,52 @@ class TestProcessedSample(TestProjectManagement):
             'tests/assets/data_deletion/projects/a_project/a_sample/a_user_sample_id.g.vcf.gz.tbi'
         ]
 
-    @patch(ppath + 'clarity.get_sample', return_value=Mock(udf={}))
-    @patch(ppath + 'util.find_files', side_effect=fake_find_files)
-    def test_released_data_folder(self, mocked_find_files, mocked_get_sample):
-        base_dir = 'tests/assets/data_deletion/delivered_data/a_project/star/'
-        assert self.sample.released_data_folder == base_dir + 'a_sample'
-        del self.sample.__dict__['released_data_folder']
-        mocked_get_sample.return_value.udf['2D Barcode'] = 'a_2d_barcode'
-        assert self.sample.released_data_folder == base_dir + 'a_2d_barcode'
+    @patch('data_deletion.delivered_index.clarity.get_list_of_samples')
+    def test_released_data_folder(self, mocked_lims_samples):
+        base_dir = 'tests/assets/data_deletion/delivered_data/a_project'
+        for d in ('a_batch/a_sample', 'another_batch/a_2d_barcode', 'another_batch/yet_another_sample',
+                  'yet_another_batch/yet_another_sample'):
+            os.makedirs(os.path.join(base_dir, d), exist_ok=True)
+
+        mocked_lims_samples.return_value = [NamedMock(name='a_sample', udf={})]
+        assert self.sample.released_data_folder == os.path.join(base_dir, 'a_batch', 'a_sample')
+
+        self.sample = ProcessedSample(sample1)
+        mocked_lims_samples.return_value = [NamedMock(name='a_sample', udf={'2D Barcode': 'a_2d_barcode'})]
+        assert self.sample.released_data_folder == os.path.join(base_dir, 'another_batch', 'a_2d_barcode')
+
+        # the index is only built once per project, and barcodes only resolved once per sample
+        index = self.sample.delivered_data_index
+        with patch('os.scandir') as mocked_scandir:
+            assert index.released_data_folders('a_project', 'a_sample') == [
+                os.path.join(base_dir, 'another_batch', 'a_2d_barcode')
+            ]
+            mocked_scandir.assert_not_called()
+        assert mocked_lims_samples.call_count == 2
+
+        # samples delivered in several batches are ambiguous
+        mocked_lims_samples.return_value = [NamedMock(name='yet_another_sample', udf={})]
+        assert index.released_data_folders('a_project', 'yet_another_sample') == [
+            os.path.join(base_dir, 'another_batch', 'yet_another_sample'),
+            os.path.join(base_dir, 'yet_another_batch', 'yet_another_sample')
+        ]
+        rmtree(base_dir)
+
+    @patch('data_deletion.delivered_index.clarity.get_list_of_samples')
+    def test_resolve_barcodes(self, mocked_lims_samples):
+        # the Lims names are found by applying clarity's substitutions one after another
+        assert _lims_names('X__A_01') == ['X__A_01', 'X__A:01', 'X _A:01']
+        mocked_lims_samples.return_value = [
+            NamedMock(name='a_sample', udf={'2D Barcode': 'a_2d_barcode'}),
+            NamedMock(name='Y:01', udf={'2D Barcode': 'another_2d_barcode'}),
+            NamedMock(name='X _A:01', udf={'2D Barcode': 'yet_another_2d_barcode'})
+        ]
+        index = DeliveredDataIndex('a_delivered_data_dir')
+        index.resolve_barcodes(['a_sample', 'Y_01', 'X__A_01', 'unknown_sample'])
+        assert index.barcodes == {
+            'a_sample': 'a_2d_barcode', 'Y_01': 'another_2d_barcode', 'X__A_01': 'yet_another_2d_barcode',
+            'unknown_sample': None
+        }
 
     @patch(ppath + 'util.find_files', return_value=['a_deletion_dir/a_file'])
     def test_files_to_purge(self, mocked_find_files):
@@ -98,6 +144,7 @@ class TestProcessedSample(TestProjectManagement):
             assert self.sample.files_to_purge == []
 
         del self.sample.__dict__['files_to_purge']
+        del self.sample.__dict__['released_files']
 
         with patch.object(ProcessedSample, 'released_data_folder', new='a_deletion_dir'):
             assert self.sample.files_to_purge == ['a_deletion_dir/a_file']
@@ -105,28 +152,49 @@ class TestProcessedSample(TestProjectManagement):
 
     @patch.object(ProcessedSample, 'raw_data_files', new=['R1.fastq.gz', 'R2.fastq.gz'])
     @patch.object(ProcessedSample, 'processed_data_files', new=['sample.vcf.gz', 'sample.bam'])
-    @patch(ppath + 'is_archived')
-    def test_files_to_remove_from_lustre(self, mocked_is_archived):
+    @patch.object(HSMStates, '_hsm_state')
+    def test_files_to_remove_from_lustre(self, mocked_hsm_state):
         exp = ['R1.fastq.gz', 'R2.fastq.gz', 'sample.vcf.gz', 'sample.bam']
-        mocked_is_archived.return_value = False
+        mocked_hsm_state.return_value = {f: ['exists'] for f in exp}
         with self.assertRaises(ArchivingError) as e:
             _ = self.sample.files_to_remove_from_lustre
 
         assert str(e.exception) == 'Unarchived files cannot be released from Lustre: ' + str(exp)
+        mocked_hsm_state.assert_called_once_with(sorted(exp))
 
-        mocked_is_archived.return_value = True
+        self.sample.hsm_states.invalidate(exp)
+        mocked_hsm_state.return_value = {f: ['exists', 'archived'] for f in exp}
         assert self.sample.files_to_remove_from_lustre == exp
 
     def test_size_of_files(self):
-        patched_stat = patch(ppath + 'stat', return_value=Mock(st_ino='123456', st_size=10000))
+        folder = os.path.join(self.assets_path, 'project_report', 'folder_sizing')
         patched_purge = patch(ppath + 'ProcessedSample.files_to_purge',
-                              new_callable=PropertyMock(return_value=['file1', 'file2']))
+                              new_callable=PropertyMock(return_value=[folder]))
         patched_remove = patch(ppath + 'ProcessedSample.files_to_remove_from_lustre',
-                               new_callable=PropertyMock(return_value=[]))
-
-        with patched_stat, patched_purge, patched_remove:
-            file_size = self.sample.size_of_files
-            assert file_size == 10000
+                               new_callable=PropertyMock(return_value=[os.path.join(folder, 'a_file.txt')]))
+
+        with patched_purge, patched_remove, \
+                patch(ppath + 'disk_usage._file_stats', wraps=disk_usage._file_stats) as mocked_file_stats:
+            assert self.sample.size_of_files == 59
+            _ = self.sample.bytes_freed, self.sample.bytes_unlinked
+        # sizes and reclaimable space come from a single stat pass over each list of files
+        assert mocked_file_stats.call_count == 2
+
+    def test_reclaimable_space(self):
+        delivered_file = os.path.join(self.assets_deletion, 'a_delivered_file')
+        processed_file = os.path.join(self.assets_deletion, 'a_processed_file')
+        with open(processed_file, 'w') as f:
+            f.write('a' * 10000)
+        os.link(processed_file, delivered_file)
+
+        self.sample.__dict__.update(files_to_purge=[delivered_file], files_to_remove_from_lustre=[])
+        blocks = os.stat(processed_file).st_blocks * 512
+        assert (self.sample.bytes_freed, self.sample.bytes_unlinked) == (0, blocks)
+        self.sample.__dict__.pop('reclaimable_space')
+        self.sample.__dict__.update(files_to_remove_from_lustre=[processed_file])
+        assert self.sample.reclaimable_space == (blocks, 0, 1, 20000)
+        os.remove(delivered_file)
+        os.remove(processed_file)
 
     @patched_patch_entry
     def test_mark_as_deleted(self, mocked_patch):
@@ -140,66 +208,245 @@ class TestDeliveredDataDeleter(TestDeleter):
         'R2.fastq.gz', 'R1_fastqc.html', 'R2_fastqc.html'
     )
     samples = (
-        Mock(sample_id='this', files_to_purge=['folder_this'], files_to_remove_from_lustre=['a_file'], size_of_files=2),
-        Mock(sample_id='that', files_to_purge=['folder_that'], files_to_remove_from_lustre=['another_file'], size_of_files=4)
+        Mock(sample_id='this', files_to_purge=['folder_this'], files_to_remove_from_lustre=['a_file'], size_of_files=2,
+             bytes_freed=1, bytes_unlinked=1, archived_files=[]),
+        Mock(sample_id='that', files_to_purge=['folder_that'], files_to_remove_from_lustre=['another_file'],
+             size_of_files=4, bytes_freed=4, bytes_unlinked=0, archived_files=[])
     )
 
     def setUp(self):
         self.deleter = DeliveredDataDeleter(self.cmd_args)
-
-    @patch('egcg_core.rest_communication.get_documents', return_value=[{'some': 'data'}])
-    def test_manually_deletable_samples(self, mocked_get):
-        self.deleter.manual_delete = list(range(25))  # 2 pages worth
-        assert self.deleter._manually_deletable_samples() == [{'some': 'data'}, {'some': 'data'}]
-        mocked_get.assert_any_call('samples', quiet=True, where={'$or': [{'sample_id': s} for s in range(20)]}, all_pages=True)
-        mocked_get.assert_any_call('samples', quiet=True, where={'$or': [{'sample_id': s} for s in range(20, 25)]}, all_pages=True)
+        self.deleter.journal = DeletionJournal()
+
+    @patch.object(DeliveredDataDeleter, 'warning')
+    @patch('data_deletion.get_documents_in')
+    def test_manually_deletable_samples(self, mocked_get_in, mocked_log):
+        self.deleter.manual_delete = ['sample%s' % i for i in range(250)] + ['sample0']
+        mocked_get_in.return_value = [{'sample_id': 'sample%s' % i} for i in range(2, 250)]
+        assert self.deleter._manually_deletable_samples() == mocked_get_in.return_value
+        mocked_get_in.assert_called_once_with(
+            'samples', 'sample_id', self.deleter.manual_delete, chunk_size=100, max_workers=4, where=None
+        )
+        assert self.deleter.metrics.counters['rest_in_queries'] == 3
+        assert self.deleter.metrics.counters['samples_not_found'] == 2
+        mocked_log.assert_called_once_with('%s requested samples were not found: %s', 2, ['sample0', 'sample1'])
 
     @patch.object(ProcessedSample, 'release_date', new='now')
     @patch.object(DeliveredDataDeleter, '_manually_deletable_samples')
-    def test_deletable_samples(self, mocked_get):
+    @patch('data_deletion.get_documents_in')
+    @patch('data_deletion.delivered_index.clarity.get_list_of_samples', return_value=[])
+    def test_deletable_samples(self, mocked_lims_samples, mocked_get_in, mocked_get):
         mocked_get.return_value = []
+        mocked_get_in.return_value = []
         assert self.deleter.deletable_samples() == []
         mocked_get.return_value = [{'sample_id': 'this'}, {'sample_id': 'that'}]
-        assert [s.sample_data for s in self.deleter.deletable_samples()] == list(reversed(mocked_get.return_value))
+        mocked_get_in.return_value = [
+            {'sample_id': 'this', 'run_id': 'a_run'}, {'sample_id': 'this', 'run_id': 'another_run'}
+        ]
+        samples = self.deleter.deletable_samples()
+        assert [s.sample_data for s in samples] == list(reversed(mocked_get.return_value))
+        mocked_get_in.assert_called_with(
+            'run_elements', 'sample_id', ['this', 'that'], chunk_size=100, max_workers=4, where=None
+        )
+        mocked_lims_samples.assert_called_once_with(['that', 'this'])
+        # run elements are cached on each sample
+        assert samples[0].run_elements == []
+        assert samples[1].run_elements == mocked_get_in.return_value
+
+    def test_move_to_unique_file_names(self):
+        source_dir = os.path.join(self.assets_deletion, 'files_to_move')
+        dest_dir = os.path.join(self.assets_deletion, 'moved_files')
+        for d in (source_dir, dest_dir):
+            os.makedirs(d, exist_ok=True)
+        sources = [os.path.join(source_dir, f) for f in ('this', 'that')]
+        for f in sources:
+            open(f, 'w').close()
+
+        with patch('uuid.uuid4', side_effect=['a_uuid', 'another_uuid']):
+            manifest = self.deleter._move_to_unique_file_names(sources, dest_dir)
+
+        assert manifest == {
+            sources[0]: os.path.join(dest_dir, 'a_uuid_this'),
+            sources[1]: os.path.join(dest_dir, 'another_uuid_that')
+        }
+        assert os.listdir(source_dir) == []
+        self.compare_lists(os.listdir(dest_dir), ['a_uuid_this', 'another_uuid_that'])
+        rmtree(source_dir)
+        rmtree(dest_dir)
+
+    def test_resume_move_to_unique_file_names(self):
+        source_dir = os.path.join(self.assets_deletion, 'files_to_move')
+        dest_dir = os.path.join(self.assets_deletion, 'moved_files')
+        for d in (source_dir, dest_dir):
+            os.makedirs(d, exist_ok=True)
+        sources = [os.path.join(source_dir, f) for f in ('this', 'that')]
+        manifest = {sources[0]: os.path.join(dest_dir, 'a_uuid_this'), sources[1]: os.path.join(dest_dir, 'a_uuid_that')}
+
+        # staging was interrupted after moving the first file
+        open(sources[1], 'w').close()
+        open(manifest[sources[0]], 'w').close()
+        self.deleter.journal.record('staging', 'a_sample', {'manifest': manifest})
+
+        with patch.object(DeliveredDataDeleter, 'move_files', wraps=self.deleter.move_files) as mocked_move:
+            assert self.deleter._move_to_unique_file_names(sources, dest_dir, journal_key='a_sample') == manifest
+        mocked_move.assert_called_once_with([(sources[1], manifest[sources[1]])])
+        assert os.listdir(source_dir) == []
+        assert self.deleter.journal.done('staged', 'a_sample')
+        rmtree(source_dir)
+        rmtree(dest_dir)
+
+    @patch('data_deletion.get_documents_in')
+    @patch('data_deletion.delivered_index.clarity.get_list_of_samples', return_value=[])
+    def test_resume_interrupted_discovery(self, mocked_lims_samples, mocked_get_in):
+        journal = DeletionJournal()
+        journal.start('delivered_data', 'a_deletion_dir')
+        journal.record('chosen', 'deletion', {'sample_ids': ['yet_another_sample', 'a_sample']})
+        sample = ProcessedSample(sample1)
+        sample.__dict__.update(
+            run_elements=run_elements1, released_data_folder='a_folder', archived_files=['another_file'],
+            files_to_purge=['a_file'], files_to_remove_from_lustre=['another_file'], size_of_files=2, bytes_freed=1,
+            bytes_unlinked=1
+        )
+        journal.record('discovered', 'a_sample', sample.journal_data())
+        self.deleter.journal = journal
+        self.deleter.resume = 'a_deletion.journal'
+
+        # samples chosen but not discovered before the interruption are fetched again
+        documents = {'samples': [sample2], 'run_elements': []}
+        mocked_get_in.side_effect = lambda endpoint, *args, **kwargs: documents[endpoint]
+        samples = self.deleter._samples_to_delete()
+        assert [s.sample_data for s in samples] == [sample2, sample1]
+        assert samples[1].files_to_purge == ['a_file']
+        mocked_get_in.assert_any_call(
+            'samples', 'sample_id', ['yet_another_sample'], chunk_size=100, max_workers=4, where=None
+        )
 
-    @patch.object(DeliveredDataDeleter, '_execute')
-    def test_move_to_unique_file_name(self, mocked_exec):
-        with patch('uuid.uuid4', return_value='a_uuid'):
-            self.deleter._move_to_unique_file_name('this/that', 'other')
-            mocked_exec.assert_called_with('mv this/that other/a_uuid_that')
+        mocked_get_in.side_effect = lambda endpoint, *args, **kwargs: []
+        with self.assertRaises(EGCGError) as e:
+            self.deleter._samples_to_delete()
+        assert str(e.exception) == "Could not find 1 chosen samples to resume: ['yet_another_sample']"
+
+        # a journal started but interrupted before any sample was chosen cannot be resumed
+        self.deleter.journal = DeletionJournal()
+        self.deleter.journal.start('delivered_data', 'a_deletion_dir')
+        with self.assertRaises(EGCGError) as e:
+            self.deleter._samples_to_delete()
+        assert str(e.exception) == 'No samples to resume in journal a_deletion.journal'
+
+    @patch('data_deletion.delivered_index.clarity.get_list_of_samples')
+    def test_resume(self, mocked_lims_samples):
+        journal_file = os.path.join(self.assets_deletion, 'a_deletion.journal')
+        journal = DeletionJournal(journal_file)
+        journal.start('delivered_data', 'a_deletion_dir')
+        sample = ProcessedSample(sample1)
+        sample.__dict__.update(
+            run_elements=run_elements1, released_data_folder='a_folder', files_to_purge=['a_file'],
+            files_to_remove_from_lustre=['another_file'], size_of_files=2, bytes_freed=1, bytes_unlinked=1
+        )
+        journal.record('discovered', 'a_sample', sample.journal_data())
+
+        self.deleter.resume = journal_file
+        del self.deleter.journal
+        assert self.deleter.deletion_dir == 'a_deletion_dir'
+        samples = self.deleter._samples_to_delete()
+        assert [s.sample_data for s in samples] == [sample1]
+        assert samples[0].files_to_purge == ['a_file']
+        assert samples[0].files_to_remove_from_lustre == ['another_file']
+        assert samples[0].size_of_files == 2
+        assert samples[0].bytes_freed == 1
+        assert samples[0].run_elements == run_elements1
+        mocked_lims_samples.assert_not_called()
+
+        final_deleter = FinalDataDeleter(self.cmd_args)
+        final_deleter.resume = journal_file
+        with self.assertRaises(EGCGError) as e:
+            final_deleter.journal.start('final_deletion', final_deleter.deletion_dir)
+        assert str(e.exception) == 'Cannot resume a delivered_data deletion with a final_deletion deleter'
+        os.remove(journal_file)
 
     @patch.object(DeliveredDataDeleter, 'deletion_dir', new='a_deletion_dir')
     @patch.object(DeliveredDataDeleter, '_execute')
-    @patch.object(DeliveredDataDeleter, '_move_to_unique_file_name')
-    @patch('data_deletion.delivered_data.release_file_from_lustre')
+    @patch.object(DeliveredDataDeleter, '_move_to_unique_file_names')
+    @patch.object(HSMStates, 'release', return_value={})
     def test_setup_samples_for_deletion(self, mocked_release, mocked_move, mocked_execute):
         self.deleter.setup_samples_for_deletion(self.samples)
 
-        mocked_release.assert_any_call('a_file')
-        mocked_release.assert_any_call('another_file')
-        mocked_move.assert_any_call('folder_this', 'a_deletion_dir/this')
-        mocked_move.assert_any_call('folder_that', 'a_deletion_dir/that')
+        mocked_release.assert_called_once_with(['a_file', 'another_file'], max_workers=4)
+        mocked_move.assert_any_call(['folder_this'], 'a_deletion_dir/this', journal_key='this')
+        mocked_move.assert_any_call(['folder_that'], 'a_deletion_dir/that', journal_key='that')
         mocked_execute.assert_any_call('mkdir -p a_deletion_dir/this')
         mocked_execute.assert_any_call('mkdir -p a_deletion_dir/that')
+        for phase in ('discovered', 'released'):
+            assert self.deleter.journal.keys(phase) == ['this', 'that']
+
+        # samples already released are not released again
+        mocked_release.reset_mock()
+        self.deleter.journal.entries.pop(('released', 'that'))
+        self.deleter.setup_samples_for_deletion(self.samples)
+        mocked_release.assert_called_once_with(['another_file'], max_workers=4)
+
+    @patch.object(DeliveredDataDeleter, '_query_hsm_states')
+    def test_record_discovered(self, mocked_query):
+        samples = [
+            Mock(sample_id='sample%s' % i, archived_files=['file%s' % i], journal_data=Mock(return_value={'i': i}))
+            for i in range(20)
+        ]
+        # samples discovered concurrently are still journalled in sample order
+        samples[0].journal_data.side_effect = lambda: time.sleep(0.05) or {'i': 0}
+        self.deleter.journal.record('discovered', 'sample1', {'i': 'journalled'})
+        self.deleter.discovery_workers = 4
+        self.deleter._record_discovered(samples)
+        expected_order = ['sample1', 'sample0'] + ['sample%s' % i for i in range(2, 20)]
+        assert self.deleter.journal.keys('discovered') == expected_order
+        assert self.deleter.journal.data('discovered', 'sample0') == {'i': 0}
+        assert self.deleter.journal.data('discovered', 'sample1') == {'i': 'journalled'}
+        samples[1].journal_data.assert_not_called()
+        mocked_query.assert_called_once_with(samples[:1] + samples[2:])
+
+    @patch.object(DeliveredDataDeleter, '_query_hsm_states')
+    def test_record_discovered_failure(self, mocked_query):
+        samples = [
+            Mock(sample_id='this', journal_data=Mock(side_effect=ArchivingError('Unarchived files'))),
+            Mock(sample_id='that', journal_data=Mock(return_value={}))
+        ]
+        with self.assertRaises(ArchivingError):
+            self.deleter._record_discovered(samples)
+        assert self.deleter.journal.keys('discovered') == []
 
     @patch.object(DeliveredDataDeleter, 'deletion_dir', new='a_deletion_dir')
     @patch.object(DeliveredDataDeleter, 'info')
     def test_setup_dry_run(self, mocked_log):
         self.deleter.dry_run = True
         self.deleter.setup_samples_for_deletion(self.samples)
+        msg = 'Sample %s has %s files to delete and %s files to remove from Lustre (%.2f G, %.2f G freed, ' \
+              '%.2f G only unlinked)\n%s\n%s'
         mocked_log.assert_any_call(
-            'Sample %s has %s files to delete and %s files to remove from Lustre (%.2f G)\n%s\n%s',
-            self.samples[0], 1, 1, 2 / 1000000000, 'folder_this', 'a_file'
+            msg, self.samples[0], 1, 1, 2 / 1000000000, 1 / 1000000000, 1 / 1000000000, 'folder_this', 'a_file'
         )
         mocked_log.assert_any_call(
-            'Sample %s has %s files to delete and %s files to remove from Lustre (%.2f G)\n%s\n%s',
-            self.samples[1], 1, 1, 4 / 1000000000, 'folder_that', 'another_file'
+            msg, self.samples[1], 1, 1, 4 / 1000000000, 4 / 1000000000, 0, 'folder_that', 'another_file'
         )
         mocked_log.assert_any_call('Will run: mv %s %s', 'folder_this', 'a_deletion_dir/this')
         mocked_log.assert_any_call('Will run: mv %s %s', 'folder_that', 'a_deletion_dir/that')
-        mocked_log.assert_any_call('Will run: %s', 'lfs hsm_release a_file')
-        mocked_log.assert_any_call('Will run: %s', 'lfs hsm_release another_file')
-        mocked_log.assert_any_call('Will delete %.2f G of data', 6 / 1000000000)
+        mocked_log.assert_any_call('Will run: %s', 'lfs hsm_release a_file another_file')
+        mocked_log.assert_any_call(
+            'Will delete %.2f G of data: %.2f G freed, %.2f G only unlinked as hard-linked elsewhere',
+            6 / 1000000000, 5 / 1000000000, 1 / 1000000000
+        )
+        assert self.deleter.metrics.counters['bytes_to_free'] == 5
+        assert self.deleter.metrics.counters['bytes_only_unlinked'] == 1
+
+    @patch.object(HSMStates, 'release', return_value={'a_file': 'dirty'})
+    @patch.object(DeliveredDataDeleter, 'error')
+    def test_release_files_from_lustre(self, mocked_log, mocked_release):
+        self.deleter.release_files_from_lustre([])
+        mocked_release.assert_not_called()
+
+        with self.assertRaises(ArchivingError) as e:
+            self.deleter.release_files_from_lustre(['a_file', 'another_file'])
+
+        assert str(e.exception) == '1 files could not be released from Lustre'
+        mocked_log.assert_called_with('Could not release %s from Lustre: %s', 'a_file', 'dirty')
 
     @patch.object(DeliveredDataDeleter, 'setup_samples_for_deletion')
     @patch.object(DeliveredDataDeleter, 'deletable_samples')
@@ -220,6 +467,7 @@ class TestDeliveredDataDeleter(TestDeleter):
     @patch.object(DeliveredDataDeleter, 'deletable_samples')
     def test_delete(self, mocked_deletable_samples, mocked_setup, mocked_execute, mocked_listdir):
         fake_released_sample = os.path.join(self.assets_deletion, 'a_project', 'a_release_date', 'other')
+        os.makedirs(fake_released_sample, exist_ok=True)
         mocked_deletable_samples.return_value = [
             Mock(sample_id='this', released_data_folder=None),
             Mock(sample_id='that', released_data_folder=fake_released_sample)
@@ -233,6 +481,97 @@ class TestDeliveredDataDeleter(TestDeleter):
         mocked_execute.assert_any_call('rm -r ' + fake_released_sample)
         mocked_execute.assert_called_with('rm -r ' + os.path.dirname(fake_released_sample))
         assert mocked_execute.call_count == 2  # one sample + the release folder
+        assert self.deleter.journal.keys('deleted') == ['this', 'that']
+        assert self.deleter.journal.data('chosen', 'deletion') == {'sample_ids': ['this', 'that']}
+
+        # a resumed deletion skips the samples already marked and deleted
+        self.deleter.journal.entries.pop(('deleted', 'that'))
+        self.deleter.delete_data()
+        for s in mocked_deletable_samples.return_value:
+            assert s.mark_as_deleted.call_count == 1
+        assert mocked_execute.call_count == 4
+        rmtree(os.path.join(self.assets_deletion, 'a_project'))
+
+    @patch.object(DeliveredDataDeleter, 'setup_samples_for_deletion')
+    @patch.object(DeliveredDataDeleter, 'deletable_samples')
+    def test_plan_and_apply(self, mocked_deletable_samples, mocked_setup):
+        plan_file = os.path.join(self.assets_deletion, 'delivered_plan.json')
+        files = [os.path.join(self.assets_deletion, f) for f in ('a_released_file', 'an_archived_file')]
+        for f in files:
+            open(f, 'w').close()
+
+        sample = ProcessedSample(sample1)
+        sample.__dict__.update(
+            run_elements=run_elements1, released_data_folder=None, files_to_purge=files[:1],
+            files_to_remove_from_lustre=files[1:], size_of_files=0
+        )
+        mocked_deletable_samples.return_value = [sample]
+        self.deleter.hsm_states.states[files[1]] = ['exists', 'archived']
+        self.deleter.write_plan = plan_file
+        assert self.deleter.delete_data() == 0
+        mocked_setup.assert_not_called()
+
+        plan = DeletionPlan.load(plan_file, 'delivered_data')
+        assert [f['path'] for f in plan.items[0]['files']] == files
+        assert plan.items[0]['files'][1]['hsm_state'] == ['exists', 'archived']
+        assert plan.items[0]['rest_patches'] == [['samples', {'data_deleted': 'on lustre'}, 'sample_id', 'a_sample']]
+
+        self.deleter.write_plan = None
+        self.deleter.apply_plan = plan_file
+        with patched_patch_entry as mocked_patch:
+            self.deleter.delete_data()
+        mocked_patch.assert_called_once_with('samples', {'data_deleted': 'on lustre'}, 'sample_id', 'a_sample')
+        assert mocked_deletable_samples.call_count == 1
+        samples = mocked_setup.call_args[0][0]
+        assert [s.sample_data for s in samples] == [sample1]
+        assert samples[0].files_to_remove_from_lustre == files[1:]
+
+        for f in files + [plan_file]:
+            os.remove(f)
+
+    @patch.object(DeliveredDataDeleter, '_execute')
+    @patch.object(DeliveredDataDeleter, '_move_to_unique_file_names')
+    @patch.object(DeliveredDataDeleter, 'deletable_samples')
+    def test_apply_plan_without_discovery(self, mocked_deletable_samples, mocked_move, mocked_execute):
+        plan_file = os.path.join(self.assets_deletion, 'delivered_plan.json')
+        files = [os.path.join(self.assets_deletion, f) for f in ('a_released_file', 'an_archived_file')]
+        for f in files:
+            open(f, 'w').close()
+
+        sample = ProcessedSample(sample1)
+        sample.__dict__.update(
+            run_elements=run_elements1, released_data_folder=None, archived_files=files[1:], files_to_purge=files[:1],
+            files_to_remove_from_lustre=files[1:]
+        )
+        mocked_deletable_samples.return_value = [sample]
+        self.deleter.hsm_states.states[files[1]] = ['exists', 'archived']
+        self.deleter.write_plan = plan_file
+        self.deleter.delete_data()
+
+        # a new deleter, with nothing cached, applies the plan
+        self.deleter = DeliveredDataDeleter(self.cmd_args)
+        self.deleter.journal = DeletionJournal()
+        self.deleter.apply_plan = plan_file
+        lustre = FakeLustre(archived_files=files[1:])
+        with patch(ppath + 'util.find_file') as mocked_find_file, \
+                patch(ppath + 'util.find_files') as mocked_find_files, \
+                patch(ppath + 'util.find_fastqs') as mocked_find_fastqs, \
+                patch.object(HSMStates, '_get_cmd_output', side_effect=lustre.hsm_command) as mocked_lfs, \
+                patched_patch_entry as mocked_patch:
+            self.deleter.delete_data()
+
+        for m in (mocked_find_file, mocked_find_files, mocked_find_fastqs):
+            m.assert_not_called()
+        # the only lfs calls release the files, then check they were released
+        assert [c[0][0][:2] for c in mocked_lfs.call_args_list] == [['lfs', 'hsm_release'], ['lfs', 'hsm_state']]
+        mocked_move.assert_called_once_with(files[:1], os.path.join(self.deleter.deletion_dir, 'a_sample'),
+                                            journal_key='a_sample')
+        mocked_patch.assert_called_once_with('samples', {'data_deleted': 'on lustre'}, 'sample_id', 'a_sample')
+        assert self.deleter.journal.data('discovered', 'a_sample')['archived_files'] == files[1:]
+        mocked_deletable_samples.assert_called_once_with()
+
+        for f in files + [plan_file]:
+            os.remove(f)
 
     def test_auto_deletable_samples(self):
         # FIXME: The test is commented out because the function is disabled
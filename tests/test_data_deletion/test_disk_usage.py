@@ -0,0 +1,66 @@
+import os
+from shutil import rmtree
+from data_deletion.disk_usage import get_disk_usage, get_reclaimable_space, parse_size
+from tests import TestProjectManagement
+
+
+class TestDiskUsage(TestProjectManagement):
+    folder = os.path.join(TestProjectManagement.assets_path, 'project_report', 'folder_sizing')
+    linked_folder = os.path.join(TestProjectManagement.assets_deletion, 'linked_files')
+
+    def setUp(self):
+        os.makedirs(os.path.join(self.linked_folder, 'a_subfolder'), exist_ok=True)
+        os.link(os.path.join(self.folder, 'a_file.txt'), os.path.join(self.linked_folder, 'a_link.txt'))
+        os.link(
+            os.path.join(self.folder, 'a_subfolder', 'yet_another_file.txt'),
+            os.path.join(self.linked_folder, 'a_subfolder', 'another_link.txt')
+        )
+
+    def tearDown(self):
+        rmtree(self.linked_folder)
+
+    def test_get_disk_usage(self):
+        assert get_disk_usage([self.folder]) == (45, 3, 3)
+        assert get_disk_usage([os.path.join(self.folder, 'a_file.txt')]) == (14, 1, 1)
+        assert get_disk_usage([]) == (0, 0, 0)
+
+    def test_get_disk_usage_hard_links(self):
+        assert get_disk_usage([self.linked_folder]) == (26, 2, 2)
+        assert get_disk_usage([self.folder, self.linked_folder], max_workers=1) == (45, 5, 3)
+
+    def test_parse_size(self):
+        assert parse_size('2000000') == 2000000
+        assert parse_size('80T') == 80000000000000
+        assert parse_size('1.5 TB') == 1500000000000
+        assert parse_size('10g') == 10000000000
+        for size in ('', 'TB', 'lots'):
+            with self.assertRaises(ValueError):
+                parse_size(size)
+
+    def test_get_reclaimable_space(self):
+        def blocks(*files):
+            return sum(os.stat(os.path.join(self.folder, f)).st_blocks * 512 for f in files)
+
+        def size(*files):
+            return sum(os.stat(os.path.join(self.folder, f)).st_size for f in files)
+
+        # files hard-linked from the linked folder are only unlinked, unless their links are deleted as well
+        assert get_reclaimable_space([self.folder]) == (
+            blocks('another_file.txt'), blocks('a_file.txt', 'a_subfolder/yet_another_file.txt'), 3,
+            get_disk_usage([self.folder]).total_size
+        )
+        assert get_reclaimable_space([self.folder, self.linked_folder]) == (
+            blocks('another_file.txt', 'a_file.txt', 'a_subfolder/yet_another_file.txt'), 0, 3,
+            get_disk_usage([self.folder]).total_size
+        )
+        # releasing frees the blocks of an inode whatever its links
+        assert get_reclaimable_space([], [self.linked_folder]) == (
+            blocks('a_file.txt', 'a_subfolder/yet_another_file.txt'), 0, 2,
+            size('a_file.txt', 'a_subfolder/yet_another_file.txt')
+        )
+        assert get_reclaimable_space([self.folder], [self.linked_folder]) == (
+            blocks('another_file.txt', 'a_file.txt', 'a_subfolder/yet_another_file.txt'), 0, 3,
+            # as for size_of_files, files both deleted and released are counted in each list
+            get_disk_usage([self.folder]).total_size + size('a_file.txt', 'a_subfolder/yet_another_file.txt')
+        )
+        assert get_reclaimable_space([]) == (0, 0, 0, 0)
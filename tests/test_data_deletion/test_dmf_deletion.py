@@ -1,5 +1,11 @@
+import os
+import tempfile
+from shutil import rmtree
 from unittest.mock import patch
-from data_deletion.DMF_data import DMFDataDeleter
+from egcg_core.exceptions import EGCGError
+from data_deletion.DMF_data import DMFDataDeleter, parse_shard
+from data_deletion.fid2path import FidLookup
+from data_deletion.fid_cache import FidCache, FOUND, ORPHAN
 from tests.test_data_deletion import TestDeleter
 
 ppath = 'data_deletion.'
@@ -9,19 +15,206 @@ class TestDMFDataDeleter(TestDeleter):
     def setUp(self):
         self.deleter = DMFDataDeleter(self.cmd_args)
 
-    def test_get_cmd_output(self):
-        exist_status, stdout, stderr = self.deleter._get_cmd_output('ls %s' % self.deleter.dmf_file_system)
-        assert exist_status == 0
-        assert stdout == b'afid\n'
-        assert stderr == b''
-
-        exist_status, stdout, stderr = self.deleter._get_cmd_output('ls non_existing_directory')
-        assert exist_status != 0  # exist status seems to be os dependent
-        assert stdout == b''
-        assert b'No such file or directory' in stderr
-
-    @patch.object(DMFDataDeleter, '_get_cmd_output', return_value=(2, b'', b'No such file or directory'))
+    @patch.object(FidLookup, '_get_cmd_output', return_value=(2, b'', b"cannot find 'afid': No such file or directory"))
     def test_find_files_to_delete(self, mock_cmd_out):
         files_to_delete = self.deleter.find_files_to_delete()
         assert files_to_delete == ['tests/assets/dmf_filesystem/afid']
-        mock_cmd_out.assert_called_once_with('lfs fid2path tests/assets/lustre_file_system afid')
+        mock_cmd_out.assert_called_once_with(
+            ['lfs', 'fid2path', '--print-fid', 'tests/assets/lustre_file_system', 'afid']
+        )
+        assert self.deleter.file_checked == 1
+
+        mock_cmd_out.return_value = (0, b'afid /lustre/a_file\n', b'')
+        assert self.deleter.find_files_to_delete() == []
+
+    @patch('os.remove')
+    @patch.object(FidLookup, '_get_cmd_output', return_value=(2, b'', b"cannot find 'afid': No such file or directory"))
+    def test_plan_and_apply(self, mock_cmd_out, mocked_remove):
+        plan_file = os.path.join(self.assets_deletion, 'dmf_plan.json')
+        self.deleter.write_plan = plan_file
+        assert self.deleter.delete_data() == 0
+        mocked_remove.assert_not_called()
+
+        self.deleter.write_plan = None
+        self.deleter.apply_plan = plan_file
+        self.deleter.fid_cache = FidCache(':memory:', reverify_interval=100)
+        self.deleter.fid_cache.record([('afid', ORPHAN, 1.0)])
+        with patch.object(self.deleter.throttle, 'operation', wraps=self.deleter.throttle.operation) as mocked_op:
+            self.deleter.delete_data()
+        mocked_remove.assert_called_once_with('tests/assets/dmf_filesystem/afid')
+        assert mock_cmd_out.call_count == 1  # the plan is applied without calling fid2path again
+        # removals are throttled and forgotten by the fid cache
+        assert mocked_op.call_count >= 2  # validating the plan, then removing the file
+        assert self.deleter.fid_cache.verdicts() == {}
+        assert self.deleter.metrics.counters['files_deleted'] == 1
+        os.unlink(plan_file)
+
+
+class TestDMFPipeline(TestDeleter):
+    def setUp(self):
+        self.deleter = DMFDataDeleter(self.cmd_args)
+        self.deleter.dmf_file_system = tempfile.mkdtemp()
+        self.fids = ['0x2000:0x%s:0x0' % i for i in range(50)]
+        for i, fid in enumerate(self.fids):
+            d = os.path.join(self.deleter.dmf_file_system, str(i % 3), str(i % 2))
+            os.makedirs(d, exist_ok=True)
+            with open(os.path.join(d, fid), 'w') as f:
+                f.write('a' * 10)
+        self.orphans = sorted(self.fids[::5])
+        self.deleter.fid_lookup.max_workers = 3
+        self.deleter.fid_batch_size = 7
+        self.deleter.queue_size = 2
+
+    def tearDown(self):
+        rmtree(self.deleter.dmf_file_system)
+
+    def fake_find_orphans(self, fids):
+        return [f for f in fids if f in self.orphans]
+
+    def test_iter_orphans(self):
+        with patch.object(self.deleter.fid_lookup, 'find_orphans', side_effect=self.fake_find_orphans) as mocked:
+            orphans = list(self.deleter.iter_orphans())
+        assert sorted(e.name for e in orphans) == self.orphans
+        assert self.deleter.file_checked == 50
+        assert mocked.call_count == 8  # batches of 7 files, plus the last one
+        assert all(os.path.dirname(e.path).startswith(self.deleter.dmf_file_system) for e in orphans)
+
+    def test_iter_orphans_error(self):
+        def broken_find_orphans(fids):
+            raise OSError('Something broke')
+
+        with patch.object(self.deleter.fid_lookup, 'find_orphans', side_effect=broken_find_orphans):
+            with self.assertRaises(OSError):
+                list(self.deleter.iter_orphans())
+
+    def test_iter_orphans_stopped(self):
+        with patch.object(self.deleter.fid_lookup, 'find_orphans', side_effect=self.fake_find_orphans):
+            orphans = self.deleter.iter_orphans()
+            next(orphans)
+            orphans.close()  # the producer and checkers are stopped rather than blocked on full queues
+        assert self.deleter.file_checked < 50
+
+    def test_delete_data(self):
+        with patch.object(self.deleter.fid_lookup, 'find_orphans', side_effect=self.fake_find_orphans):
+            self.deleter.dry_run = True
+            self.deleter.delete_data()
+            assert self.deleter.orphans_found == 10
+            assert self.deleter.bytes_reclaimed == 100
+            assert 'files_deleted' not in self.deleter.metrics.counters
+
+            self.deleter.dry_run = False
+            self.deleter.progress_interval = 0
+            with patch.object(self.deleter, '_report_progress') as mocked_report:
+                self.deleter.delete_data()
+            assert mocked_report.call_count == 11  # after each orphan and at the end
+
+        remaining = [f for path, dirs, files in os.walk(self.deleter.dmf_file_system) for f in files]
+        assert sorted(remaining) == sorted(set(self.fids) - set(self.orphans))
+        assert self.deleter.metrics.counters['files_deleted'] == 10
+        assert self.deleter.metrics.counters['bytes_deleted'] == 100
+
+    def test_delete_data_with_fid_cache(self):
+        self.deleter.fid_cache = FidCache(':memory:', reverify_interval=100)
+        checked = []
+
+        def fake_find_orphans(fids):
+            fids = list(fids)
+            checked.extend(fids)
+            return self.fake_find_orphans(fids)
+
+        with patch.object(self.deleter.fid_lookup, 'find_orphans', side_effect=fake_find_orphans):
+            self.deleter.dry_run = True
+            self.deleter.delete_data()
+            assert sorted(checked) == sorted(self.fids)
+            verdicts = self.deleter.fid_cache.verdicts()
+            assert sorted(f for f in verdicts if verdicts[f][0] == ORPHAN) == self.orphans
+
+            # FIDs found on Lustre are skipped, orphans are checked again
+            checked.clear()
+            self.deleter.delete_data()
+            assert sorted(checked) == self.orphans
+            assert self.deleter.metrics.counters['fids_skipped'] == 40
+
+            # files changed since they were checked are checked again
+            changed_fid = os.path.join(self.deleter.dmf_file_system, '1', '1', self.fids[1])
+            os.utime(changed_fid, (0, 0))
+            checked.clear()
+            self.deleter.delete_data()
+            assert sorted(checked) == sorted(self.orphans + [self.fids[1]])
+
+            # so are all FIDs when doing a full scan
+            checked.clear()
+            self.deleter.full_scan = True
+            self.deleter.delete_data()
+            assert sorted(checked) == sorted(self.fids)
+
+            # deleted orphans are removed from the cache
+            self.deleter.dry_run = False
+            self.deleter.delete_data()
+        verdicts = self.deleter.fid_cache.verdicts()
+        assert sorted(verdicts) == sorted(set(self.fids) - set(self.orphans))
+        assert all(v[0] == FOUND for v in verdicts.values())
+
+    def test_parse_shard(self):
+        assert parse_shard('1/4') == (1, 4)
+        assert parse_shard('4/4') == (4, 4)
+        for shard in ('0/4', '5/4', '4', 'a/b'):
+            with self.assertRaises(ValueError):
+                parse_shard(shard)
+
+    def test_in_shard(self):
+        buckets = ['%02x' % i for i in range(256)]
+        shards = []
+        for i in range(1, 5):
+            self.deleter.shard = (i, 4)
+            shards.append([b for b in buckets if self.deleter._in_shard(b)])
+        assert sorted(b for shard in shards for b in shard) == buckets
+        assert all(shards)
+
+    def test_metrics_file(self):
+        with patch.object(DMFDataDeleter, '_strnow', return_value='now'):
+            assert os.path.basename(self.deleter.metrics_file) == 'dmf_deletion_metrics_now.json'
+            self.deleter.shard = (2, 3)
+            del self.deleter.metrics_file
+            assert os.path.basename(self.deleter.metrics_file) == 'dmf_deletion_metrics_shard_2_of_3_now.json'
+
+    def _run_shard(self, cmd):
+        args = cmd.split(' ')
+        deleter = DMFDataDeleter(self.cmd_args)
+        deleter.work_dir = args[args.index('--work_dir') + 1]
+        deleter.shard = parse_shard(args[args.index('--shard') + 1])
+        deleter.dmf_file_system = self.deleter.dmf_file_system
+        with patch.object(deleter.fid_lookup, 'find_orphans', side_effect=self.fake_find_orphans):
+            deleter.delete_data()
+
+    def test_delete_data_sharded(self):
+        self.deleter.shards = 3
+        self.deleter.shard_engine = 'cluster'
+        shard_cmds = []
+
+        def fake_execute(*cmds, cluster_execution=False):
+            assert cluster_execution
+            shard_cmds.extend(cmds)
+            for cmd in cmds:
+                self._run_shard(cmd)
+
+        self.deleter._execute = fake_execute
+        self.deleter.delete_data()
+        assert [c.split(' ')[3:6] for c in shard_cmds] == [
+            ['--shard', '%s/3' % i, '--work_dir'] for i in range(1, 4)
+        ]
+        assert self.deleter.file_checked == 50
+        assert self.deleter.orphans_found == 10
+        assert self.deleter.bytes_reclaimed == 100
+        remaining = [f for path, dirs, files in os.walk(self.deleter.dmf_file_system) for f in files]
+        assert sorted(remaining) == sorted(set(self.fids) - set(self.orphans))
+        rmtree(self.deleter.shard_dir)
+
+    def test_merge_incomplete_shards(self):
+        self.deleter.shards = 2
+        self.deleter._execute = lambda *cmds, cluster_execution=False: self._run_shard(cmds[0])
+        with self.assertRaises(EGCGError) as e:
+            self.deleter.delete_data()
+        assert str(e.exception) == '1/2 shards did not complete: [2]'
+        rmtree(self.deleter.shard_dir)
+
@@ -0,0 +1,85 @@
+import sys
+from unittest.mock import patch
+from data_deletion.fid2path import FidLookup
+from tests import TestProjectManagement
+
+fid2path_stderr = (
+    b"lfs fid2path: cannot find '0x200000400:0x2:0x0': No such file or directory\n"
+    b"lfs fid2path: cannot find '[0x200000400:0x4:0x0]': No such file or directory\n"
+    b"lfs fid2path: cannot find '0x200000400:0x5:0x0': Invalid argument\n"
+)
+
+
+class TestFidLookup(TestProjectManagement):
+    def setUp(self):
+        self.fid_lookup = FidLookup('lustre', max_workers=2)
+        self.fids = ['0x200000400:0x%s:0x0' % i for i in range(1, 6)]
+
+    def test_get_cmd_output(self):
+        exit_status, stdout, stderr = self.fid_lookup._get_cmd_output(['ls', self.assets_path + '/dmf_filesystem'])
+        assert exit_status == 0
+        assert stdout == b'afid\n'
+        assert stderr == b''
+
+        # outputs bigger than a pipe's buffer are read as they come, so the process does not block
+        exit_status, stdout, stderr = self.fid_lookup._get_cmd_output(
+            [sys.executable, '-c', 'import sys; sys.stdout.write("a" * 1000000); sys.stderr.write("b" * 1000000)']
+        )
+        assert exit_status == 0
+        assert len(stdout) == len(stderr) == 1000000
+
+        exit_status, stdout, stderr = self.fid_lookup._get_cmd_output(['ls', 'non_existing_directory'])
+        assert exit_status != 0  # exit status seems to be os dependent
+        assert stdout == b''
+        assert b'No such file or directory' in stderr
+
+    @patch.object(FidLookup, '_get_cmd_output')
+    def test_find_orphans(self, mocked_cmd_output):
+        mocked_cmd_output.return_value = (
+            2,
+            b'0x200000400:0x1:0x0 /lustre/a_file\n0x200000400:0x3:0x0 /lustre/another_file\n',
+            fid2path_stderr
+        )
+        # FIDs that cannot be looked up for any other reason than not being found are not orphans
+        assert self.fid_lookup.find_orphans(reversed(self.fids)) == ['0x200000400:0x4:0x0', '0x200000400:0x2:0x0']
+        mocked_cmd_output.assert_called_once_with(['lfs', 'fid2path', '--print-fid', 'lustre'] + self.fids[::-1])
+        assert self.fid_lookup.metrics.counters == {'subprocesses': 1, 'fid2path_fids': 5}
+
+    @patch.object(FidLookup, '_get_cmd_output', return_value=(2, b'', fid2path_stderr))
+    def test_find_orphans_chunked(self, mocked_cmd_output):
+        self.fid_lookup.max_arg_length = 40
+        assert self.fid_lookup.find_orphans(self.fids) == ['0x200000400:0x2:0x0', '0x200000400:0x4:0x0']
+        assert mocked_cmd_output.call_count == 3
+        assert sorted(c[0][0][4:] for c in mocked_cmd_output.call_args_list) == [
+            self.fids[0:2], self.fids[2:4], self.fids[4:]
+        ]
+        assert self.fid_lookup.find_orphans([]) == []
+
+    @patch.object(FidLookup, 'warning')
+    @patch.object(FidLookup, '_get_cmd_output')
+    def test_find_orphans_bracketed(self, mocked_cmd_output, mocked_warning):
+        fids = ['[%s]' % f for f in self.fids]
+        mocked_cmd_output.return_value = (
+            2,
+            b'',
+            b"lfs fid2path: cannot find [0x200000400:0x2:0x0]: No such file or directory\n"
+            b"lfs fid2path: cannot find '0x200000400:0x4:0x0': No such file or directory\n"
+            b"lfs fid2path: cannot find '[0x200000400:0x9:0x0]': No such file or directory\n"
+        )
+        # orphans are returned as requested, whether lfs prints them with brackets or not
+        assert self.fid_lookup.find_orphans(fids) == ['[0x200000400:0x2:0x0]', '[0x200000400:0x4:0x0]']
+        # FIDs not found that were not requested are reported
+        mocked_warning.assert_called_once_with(
+            'lfs fid2path reported %s FIDs as not found that do not match the FIDs requested: %s',
+            1, ["lfs fid2path: cannot find '[0x200000400:0x9:0x0]': No such file or directory"]
+        )
+
+        mocked_warning.reset_mock()
+        mocked_cmd_output.return_value = (
+            2, b'', b"lfs fid2path: error on FID 0x200000400:0x2:0x0: No such file or directory\n"
+        )
+        assert self.fid_lookup.find_orphans(fids) == []
+        mocked_warning.assert_called_once_with(
+            'lfs fid2path reported %s FIDs as not found that do not match the FIDs requested: %s',
+            1, ['lfs fid2path: error on FID 0x200000400:0x2:0x0: No such file or directory']
+        )
@@ -0,0 +1,39 @@
+from unittest.mock import patch
+from data_deletion.fid_cache import FidCache, FOUND, ORPHAN
+from tests import TestProjectManagement
+
+
+class TestFidCache(TestProjectManagement):
+    def setUp(self):
+        self.cache = FidCache(':memory:', reverify_interval=100)
+        self.cache.max_variables = 2
+        with patch.object(FidCache, '_now', return_value=1000):
+            self.cache.record([('fid1', FOUND, 1.0), ('fid2', FOUND, 2.0), ('fid3', ORPHAN, 3.0)])
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_record(self):
+        assert self.cache.verdicts() == {
+            'fid1': (FOUND, 1.0, 1000), 'fid2': (FOUND, 2.0, 1000), 'fid3': (ORPHAN, 3.0, 1000)
+        }
+        with patch.object(FidCache, '_now', return_value=1050):
+            self.cache.record([('fid3', FOUND, 3.5)])
+        assert self.cache.verdicts()['fid3'] == (FOUND, 3.5, 1050)
+
+    def test_recently_found(self):
+        mtimes = {'fid1': 1.0, 'fid2': 2.5, 'fid3': 3.0, 'new_fid': 4.0}
+        with patch.object(FidCache, '_now', return_value=1100):
+            # fid2 has changed, fid3 is an orphan and new_fid has never been checked
+            assert self.cache.recently_found(mtimes) == {'fid1'}
+        with patch.object(FidCache, '_now', return_value=1101):
+            assert self.cache.recently_found(mtimes) == set()
+
+    def test_forget(self):
+        self.cache.forget(['fid1', 'fid3', 'fid4'])
+        assert list(self.cache.verdicts()) == ['fid2']
+
+    def test_lock_timeout(self):
+        with patch('sqlite3.connect') as mocked_connect:
+            FidCache('fid_cache.sqlite', reverify_interval=100)
+        mocked_connect.assert_called_with('fid_cache.sqlite', timeout=300, check_same_thread=False)
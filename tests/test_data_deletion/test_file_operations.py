@@ -0,0 +1,57 @@
+import os
+from shutil import rmtree
+from os.path import join
+from unittest.mock import patch
+from data_deletion.file_operations import delete_tree, find_files_matching
+from data_deletion.throttling import Throttle
+from tests import TestProjectManagement
+
+
+class TestFileOperations(TestProjectManagement):
+    top = join(TestProjectManagement.assets_deletion, 'tree_to_delete')
+
+    def setUp(self):
+        for d in ('a_dir/a_subdir/a_subsubdir', 'another_dir'):
+            os.makedirs(join(self.top, d), exist_ok=True)
+        for f in ('a_file', 'a_dir/a_file', 'a_dir/a_subdir/a_subsubdir/a_file', 'another_dir/a_file'):
+            with open(join(self.top, f), 'w') as open_file:
+                open_file.write('some data')
+        os.symlink(join(self.top, 'a_dir'), join(self.top, 'another_dir', 'a_link'))
+
+    def tearDown(self):
+        rmtree(self.top, ignore_errors=True)
+
+    def test_delete_tree(self):
+        stats = delete_tree(self.top, max_workers=2)
+        assert not os.path.exists(self.top)
+        assert stats.nb_files == 5  # including the symlink, which is unlinked rather than followed
+        assert stats.total_size == 36 + len(join(self.top, 'a_dir'))
+
+    @patch('data_deletion.throttling.time.sleep')
+    def test_delete_tree_rate_limited(self, mocked_sleep):
+        delete_tree(self.top, max_workers=1, throttle=Throttle(2))
+        assert not os.path.exists(self.top)
+        assert mocked_sleep.call_count >= 4
+
+    @patch('data_deletion.throttling.time.sleep')
+    def test_delete_tree_unlink_rate_limited(self, mocked_sleep):
+        # only the 5 unlinks are charged to unlink_throttle, not the scans, stats and rmdirs
+        unlink_throttle = Throttle(2)
+        with patch.object(unlink_throttle, 'operation', wraps=unlink_throttle.operation) as mocked_operation:
+            delete_tree(self.top, max_workers=1, throttle=Throttle(), unlink_throttle=unlink_throttle)
+        assert not os.path.exists(self.top)
+        assert mocked_operation.call_count == 5
+
+    def test_find_files_matching(self):
+        for f in ('a_dir/x.fastq.gz', 'a_dir/a_subdir/y.fastq_discarded.gz', 'x.fastq.gz.original'):
+            open(join(self.top, f), 'w').close()
+        patterns = ('.fastq.gz', 'fastq_discarded.gz', 'fastq.gz.original', 'a_*', 'nothing')
+        assert find_files_matching(self.top, patterns) == {
+            '.fastq.gz': [join(self.top, 'a_dir', 'x.fastq.gz')],
+            'fastq_discarded.gz': [join(self.top, 'a_dir', 'a_subdir', 'y.fastq_discarded.gz')],
+            'fastq.gz.original': [join(self.top, 'x.fastq.gz.original')],
+            # the symlink to a_dir is neither matched nor followed
+            'a_*': [join(self.top, f) for f in ('a_dir/a_file', 'a_dir/a_subdir/a_subsubdir/a_file', 'a_file',
+                                                'another_dir/a_file')],
+            'nothing': []
+        }
@@ -3,7 +3,9 @@ from unittest.mock import patch, Mock
 from shutil import rmtree
 from egcg_core.exceptions import ArchivingError
 from data_deletion import FinalSample
+from data_deletion.hsm import HSMStates
 from data_deletion.final_data import FinalDataDeleter
+from data_deletion.journal import DeletionJournal
 from tests import TestProjectManagement
 from tests.test_data_deletion import TestDeleter, patched_patch_entry
 
@@ -67,17 +69,19 @@ class TestFinalSample(TestProjectManagement):
 
     @patch.object(FinalSample, 'raw_data_files', new=['R1.fastq.gz', 'R2.fastq.gz'])
     @patch.object(FinalSample, 'processed_data_files', new=['sample.vcf.gz', 'sample.bam'])
-    @patch(ppath + 'is_released')
+    @patch.object(HSMStates, '_hsm_state')
     @patch(ppath + 'util.find_files', return_value=['a_deletion_dir/a_file'])
-    def test_files_to_purge(self, mocked_find_files, mocked_is_released):
+    def test_files_to_purge(self, mocked_find_files, mocked_hsm_state):
         self.sample.__dict__['released_data_folder'] = 'a_deletion_dir'
         exp = ['a_deletion_dir/a_file', 'R1.fastq.gz', 'R2.fastq.gz', 'sample.vcf.gz', 'sample.bam']
-        mocked_is_released.return_value = False
+        mocked_hsm_state.return_value = {f: ['exists', 'archived'] for f in exp}
         with self.assertRaises(ArchivingError) as e:
             _ = self.sample.files_to_purge
         assert str(e.exception) == 'Files not yet removed from Lustre cannot be removed from tape: ' + str(exp)
+        mocked_hsm_state.assert_called_once_with(sorted(exp))
 
-        mocked_is_released.return_value = True
+        self.sample.hsm_states.invalidate(exp)
+        mocked_hsm_state.return_value = {f: ['exists', 'archived', 'released'] for f in exp}
         assert self.sample.files_to_purge == exp
 
     def test_files_to_remove_from_lustre(self):
@@ -95,12 +99,13 @@ class TestFinalDataDeleter(TestDeleter):
         'R2.fastq.gz', 'R1_fastqc.html', 'R2_fastqc.html'
     )
     samples = (
-        Mock(sample_id='this', files_to_purge=['folder_this']),
-        Mock(sample_id='that', files_to_purge=['folder_that'])
+        Mock(sample_id='this', files_to_purge=['folder_this'], archived_files=[]),
+        Mock(sample_id='that', files_to_purge=['folder_that'], archived_files=[])
     )
 
     def setUp(self):
         self.deleter = FinalDataDeleter(self.cmd_args)
+        self.deleter.journal = DeletionJournal()
         os.makedirs(os.path.join(self.deleter.fastq_dir, 'a_run'), exist_ok=True)
         os.makedirs(os.path.join(self.deleter.projects_dir, 'a_project'), exist_ok=True)
         os.makedirs(os.path.join(self.deleter.project_archive_dir), exist_ok=True)
@@ -119,20 +124,34 @@ class TestFinalDataDeleter(TestDeleter):
 
     @patch.object(FinalSample, 'release_date', new='now')
     @patch.object(FinalDataDeleter, '_manually_deletable_samples')
-    def test_deletable_samples(self, mocked_get):
+    @patch('data_deletion.get_documents_in')
+    @patch('data_deletion.delivered_index.clarity.get_list_of_samples', return_value=[])
+    def test_deletable_samples(self, mocked_lims_samples, mocked_get_in, mocked_get):
         mocked_get.return_value = []
+        mocked_get_in.return_value = []
         assert self.deleter.deletable_samples() == []
         mocked_get.return_value = [{'sample_id': 'this'}, {'sample_id': 'that'}]
-        assert [s.sample_data for s in self.deleter.deletable_samples()] == list(reversed(mocked_get.return_value))
+        mocked_get_in.return_value = [
+            {'sample_id': 'this', 'run_id': 'a_run'}, {'sample_id': 'this', 'run_id': 'another_run'}
+        ]
+        samples = self.deleter.deletable_samples()
+        assert [s.sample_data for s in samples] == list(reversed(mocked_get.return_value))
+        mocked_get_in.assert_called_with(
+            'run_elements', 'sample_id', ['this', 'that'], chunk_size=100, max_workers=4, where=None
+        )
+        mocked_lims_samples.assert_called_once_with(['that', 'this'])
+        # run elements are cached on each sample
+        assert samples[0].run_elements == []
+        assert samples[1].run_elements == mocked_get_in.return_value
 
     @patch.object(FinalDataDeleter, 'deletion_dir', new='a_deletion_dir')
     @patch.object(FinalDataDeleter, '_execute')
-    @patch.object(FinalDataDeleter, '_move_to_unique_file_name')
+    @patch.object(FinalDataDeleter, '_move_to_unique_file_names')
     def test_setup_samples_for_deletion(self, mocked_move, mocked_execute):
         self.deleter.setup_samples_for_deletion(self.samples)
 
-        mocked_move.assert_any_call('folder_this', 'a_deletion_dir/this')
-        mocked_move.assert_any_call('folder_that', 'a_deletion_dir/that')
+        mocked_move.assert_any_call(['folder_this'], 'a_deletion_dir/this', journal_key='this')
+        mocked_move.assert_any_call(['folder_that'], 'a_deletion_dir/that', journal_key='that')
         mocked_execute.assert_any_call('mkdir -p a_deletion_dir/this')
         mocked_execute.assert_any_call('mkdir -p a_deletion_dir/that')
 
@@ -156,7 +175,9 @@ class TestFinalDataDeleter(TestDeleter):
     @patch.object(FinalDataDeleter, 'deletable_samples')
     @patch.object(FinalDataDeleter, '_try_archive_run')
     @patch.object(FinalDataDeleter, '_try_archive_project')
-    def test_delete(self, mocked_archive_project, mocked_archive_run, mocked_deletable_samples, mocked_setup):
+    @patch.object(FinalDataDeleter, '_report_archivability')
+    def test_delete(self, mocked_report, mocked_archive_project, mocked_archive_run, mocked_deletable_samples,
+                    mocked_setup):
         mocked_deletable_samples.return_value = [
             Mock(sample_id='this', project_id='project1', released_data_folder=None, release_date='2017-01-12', sample_data={'data_deleted': 'on lustre'}, run_elements=run_elements1),
             Mock(sample_id='that', project_id='project1', released_data_folder=None, release_date='2017-02-24', sample_data={'data_deleted': 'on lustre'}, run_elements=run_elements2)
@@ -169,32 +190,84 @@ class TestFinalDataDeleter(TestDeleter):
         self.deleter.dry_run = False
         self.deleter.delete_data()
         mocked_deletable_samples.return_value[0].mark_as_deleted.assert_called_with()
+        mocked_report.assert_called_with(mocked_deletable_samples.return_value[0:1])
         mocked_archive_project.assert_called_once_with('project1')
         mocked_archive_run.assert_any_call('a_run')
         mocked_archive_run.assert_any_call('another_run')
 
-    @patch('egcg_core.rest_communication.get_documents', return_value=full_run)
-    @patch('egcg_core.rest_communication.get_document', return_value=sample1)
-    def test_try_archive_run(self, mocked_get_doc, mocked_get_docs):
+    @patch('data_deletion.get_documents_in')
+    def test_try_archive_run(self, mocked_get_in):
+        mocked_get_in.side_effect = [
+            full_run,
+            [{'sample_id': 'a_sample%s' % i, 'data_deleted': 'all'} for i in range(1, 9)]
+        ]
+        run_dir = os.path.join(self.deleter.fastq_dir, 'a_run')
+        for f in ('Undetermined_R1.fastq.gz', 'a_project/a_sample1/a_sample1_R1.fastq_discarded.gz',
+                  'a_project/a_sample1/a_sample1_R1.fastq.gz.original', 'a_project/a_sample1/a_sample1_R1.md5'):
+            os.makedirs(os.path.dirname(os.path.join(run_dir, f)), exist_ok=True)
+            open(os.path.join(run_dir, f), 'w').close()
         assert os.path.exists(os.path.join(self.deleter.fastq_dir, 'a_run'))
         assert not os.path.exists(os.path.join(self.deleter.run_archive_dir, 'a_run'))
-        self.deleter._try_archive_run('a_run')
+        with patch.object(FinalDataDeleter, 'deletion_dir', new='a_deletion_dir'), \
+                patch.object(FinalDataDeleter, '_execute'), \
+                patch.object(FinalDataDeleter, '_move_to_unique_file_names') as mocked_move:
+            self.deleter._try_archive_run('a_run')
+        mocked_move.assert_called_once_with(
+            [os.path.join(run_dir, f) for f in ('Undetermined_R1.fastq.gz',
+                                                'a_project/a_sample1/a_sample1_R1.fastq_discarded.gz',
+                                                'a_project/a_sample1/a_sample1_R1.fastq.gz.original')],
+            'a_deletion_dir/a_run', journal_key='run a_run'
+        )
         assert not os.path.exists(os.path.join(self.deleter.fastq_dir, 'a_run'))
         assert os.path.exists(os.path.join(self.deleter.run_archive_dir, 'a_run'))
-        mocked_get_docs.assert_called_once_with('run_elements', all_pages=True, where={'run_id': 'a_run'})
-        mocked_get_doc.assert_any_call('samples', where={'sample_id': 'a_sample1'})
-        mocked_get_doc.assert_any_call('samples', where={'sample_id': 'a_sample2'})
-        mocked_get_doc.assert_any_call('samples', where={'sample_id': 'a_sample3'})
-        mocked_get_doc.assert_any_call('samples', where={'sample_id': 'a_sample4'})
-        mocked_get_doc.assert_any_call('samples', where={'sample_id': 'a_sample5'})
-        mocked_get_doc.assert_any_call('samples', where={'sample_id': 'a_sample6'})
-        mocked_get_doc.assert_any_call('samples', where={'sample_id': 'a_sample7'})
-        mocked_get_doc.assert_any_call('samples', where={'sample_id': 'a_sample8'})
-        assert mocked_get_doc.call_count == 8
+        assert self.deleter.journal.done('archived', 'run a_run')
+        mocked_get_in.assert_any_call(
+            'run_elements', 'run_id', ['a_run'], chunk_size=100, max_workers=4, where=None
+        )
         # Undetermined is ignored
+        mocked_get_in.assert_called_with(
+            'samples', 'sample_id', ['a_sample%s' % i for i in range(1, 9)], chunk_size=100, max_workers=4,
+            where=None
+        )
+        assert mocked_get_in.call_count == 2
+
+    @patch('data_deletion.get_documents_in')
+    def test_try_archive_run_not_all_deleted(self, mocked_get_in):
+        mocked_get_in.side_effect = [
+            full_run,
+            [{'sample_id': 'a_sample%s' % i, 'data_deleted': 'all'} for i in range(1, 8)]  # a_sample8 not found
+        ]
+        self.deleter._try_archive_run('a_run')
+        assert os.path.exists(os.path.join(self.deleter.fastq_dir, 'a_run'))
+        assert not self.deleter.journal.done('archived', 'run a_run')
+
+    @patch.object(FinalDataDeleter, 'info')
+    @patch('data_deletion.get_documents_in')
+    def test_report_archivability(self, mocked_get_in, mocked_log):
+        mocked_get_in.side_effect = [
+            run_elements1 + run_elements2,
+            [{'sample_id': 'a_sample', 'project_id': 'a_project', 'data_deleted': 'on lustre'}],
+            [{'sample_id': 'yet_another_sample', 'data_deleted': 'on lustre'}]
+        ]
+        self.deleter.journal.record('archived', 'run another_run')
+        samples = [Mock(sample_id='a_sample', project_id='a_project', run_elements=run_elements1)]
+        report = self.deleter._report_archivability(samples)
+        # archived runs are not indexed again
+        mocked_get_in.assert_any_call('run_elements', 'run_id', ['a_run'], chunk_size=100, max_workers=4, where=None)
+        assert report.archivable_runs == []
+        assert report.archivable_projects == ['a_project']
+        assert report.blocked_runs == {'a_run': ['yet_another_sample']}
+        assert report.blocked_projects == {}
+        mocked_log.assert_any_call(
+            'After this batch, %s runs and %s projects can be archived: %s', 0, 1, ['a_project']
+        )
+        mocked_log.assert_any_call(
+            '%s %s is blocked by %s samples: %s', 'Run', 'a_run', 1, 'yet_another_sample (on lustre)'
+        )
+        assert self.deleter.metrics.counters['archivable_projects'] == 1
 
-    @patch('egcg_core.rest_communication.get_documents', return_value=[sample1])
-    def test_try_archive_project(self, mocked_get_docs):
+    @patch('data_deletion.get_documents_in', return_value=[sample1])
+    def test_try_archive_project(self, mocked_get_in):
         assert os.path.exists(os.path.join(self.deleter.projects_dir, 'a_project'))
         assert not os.path.exists(os.path.join(self.deleter.project_archive_dir, 'a_project'))
         self.deleter._try_archive_project('a_project')
@@ -0,0 +1,91 @@
+from unittest.mock import patch, Mock
+from egcg_core.exceptions import ArchivingError
+from data_deletion.hsm import HSMStates, chunk_paths
+from tests import TestProjectManagement
+
+hsm_state_output = (
+    b'a_file: (0x0000000d) released exists archived, archive_id:1\n'
+    b'another_file: (0x00000009) exists archived, archive_id:1\n'
+    b'a_dirty_file: (0x0000000b) exists dirty archived, archive_id:1\n'
+    b'an_unarchived_file: (0x00000000)\n'
+)
+
+
+class TestHSMStates(TestProjectManagement):
+    def setUp(self):
+        self.hsm_states = HSMStates()
+
+    def test_chunk_paths(self):
+        assert list(chunk_paths([], 10)) == []
+        assert list(chunk_paths(['this', 'that', 'other'], 10)) == [['this', 'that'], ['other']]
+        assert list(chunk_paths(['a_very_long_path', 'this'], 10)) == [['a_very_long_path'], ['this']]
+
+    @patch.object(HSMStates, '_get_cmd_output', return_value=(0, hsm_state_output, b''))
+    def test_query(self, mocked_cmd_output):
+        files = ['a_file', 'another_file', 'a_dirty_file', 'an_unarchived_file']
+        assert self.hsm_states.query(files) == {
+            'a_file': ['released', 'exists', 'archived'],
+            'another_file': ['exists', 'archived'],
+            'a_dirty_file': ['exists', 'dirty', 'archived'],
+            'an_unarchived_file': []
+        }
+        mocked_cmd_output.assert_called_once_with(['lfs', 'hsm_state'] + sorted(files))
+
+        # all states are now cached
+        assert self.hsm_states.is_released('a_file')
+        assert self.hsm_states.is_archived('another_file')
+        assert not self.hsm_states.is_released('another_file')
+        assert self.hsm_states.is_dirty('a_dirty_file')
+        assert not self.hsm_states.is_archived('an_unarchived_file')
+        assert mocked_cmd_output.call_count == 1
+
+        self.hsm_states.invalidate(['a_file'])
+        self.hsm_states.query(files)
+        mocked_cmd_output.assert_called_with(['lfs', 'hsm_state', 'a_file'])
+
+    @patch.object(HSMStates, '_get_cmd_output', return_value=(0, hsm_state_output, b''))
+    def test_query_chunked(self, mocked_cmd_output):
+        self.hsm_states.max_arg_length = 20
+        self.hsm_states.query(['a_file', 'another_file', 'a_dirty_file', 'an_unarchived_file'])
+        assert mocked_cmd_output.call_count == 3
+
+    @patch.object(HSMStates, '_get_cmd_output', return_value=(2, b'', b'No such file or directory'))
+    def test_missing_file(self, mocked_cmd_output):
+        with self.assertRaises(ArchivingError) as e:
+            self.hsm_states.is_archived('a_missing_file')
+        assert str(e.exception) == "Could not hsm_state files: ['a_missing_file']"
+
+    @patch('os.stat', return_value=Mock(st_size=1000000000))
+    @patch.object(HSMStates, '_get_cmd_output')
+    def test_release(self, mocked_cmd_output, mocked_stat):
+        released_output = hsm_state_output.replace(
+            b'another_file: (0x00000009) exists archived', b'another_file: (0x0000000d) released exists archived'
+        )
+        mocked_cmd_output.side_effect = [
+            (0, hsm_state_output, b''),
+            (0, b'', b''),
+            (0, released_output, b'')
+        ]
+        failures = self.hsm_states.release(
+            ['a_file', 'another_file', 'a_dirty_file', 'an_unarchived_file'], max_workers=2
+        )
+        assert failures == {'a_dirty_file': 'dirty', 'an_unarchived_file': 'not archived'}
+        mocked_cmd_output.assert_any_call(['lfs', 'hsm_release', 'another_file'])
+        mocked_cmd_output.assert_called_with(['lfs', 'hsm_state', 'another_file'])
+
+    @patch('os.stat', return_value=Mock(st_size=1000000000))
+    @patch.object(HSMStates, '_get_cmd_output')
+    def test_release_failed(self, mocked_cmd_output, mocked_stat):
+        mocked_cmd_output.side_effect = [
+            (0, hsm_state_output, b''),
+            (1, b'', b'Operation not permitted'),
+            (0, hsm_state_output, b'')
+        ]
+        assert self.hsm_states.release(['another_file']) == {'another_file': 'not released after lfs hsm_release'}
+
+    def test_release_commands(self):
+        self.hsm_states.max_arg_length = 20
+        assert self.hsm_states.release_commands(['a_file', 'another_file', 'a_dirty_file']) == [
+            ['lfs', 'hsm_release', 'a_file', 'another_file'],
+            ['lfs', 'hsm_release', 'a_dirty_file']
+        ]
@@ -0,0 +1,51 @@
+import os
+from egcg_core.exceptions import EGCGError
+from data_deletion.journal import DeletionJournal
+from tests import TestProjectManagement
+
+
+class TestDeletionJournal(TestProjectManagement):
+    def setUp(self):
+        self.journal_file = os.path.join(self.assets_deletion, 'test.journal')
+
+    def tearDown(self):
+        if os.path.isfile(self.journal_file):
+            os.remove(self.journal_file)
+
+    def test_record(self):
+        j = DeletionJournal(self.journal_file)
+        with self.assertRaises(EGCGError):
+            _ = j.deletion_dir
+
+        j.start('delivered_data', 'a_deletion_dir')
+        j.record('discovered', 'a_sample', {'files_to_purge': ['a_file']})
+        for i in range(20):
+            j.record('discovered', 'sample%s' % i)
+        j.record('discovered', 'another_sample')
+        j.record('staged', 'a_sample')
+        with open(self.journal_file, 'a') as f:
+            f.write('{"phase": "marked", "key": "a_sa')  # interrupted while writing
+
+        j = DeletionJournal(self.journal_file)
+        assert j.deletion_dir == 'a_deletion_dir'
+        # keys come back in the order they were recorded
+        assert j.keys('discovered') == ['a_sample'] + ['sample%s' % i for i in range(20)] + ['another_sample']
+        assert j.data('discovered', 'a_sample') == {'files_to_purge': ['a_file']}
+        assert j.done('staged', 'a_sample')
+        assert not j.done('staged', 'another_sample')
+        assert not j.done('marked', 'a_sample')
+
+        j.start('delivered_data', 'another_deletion_dir')
+        assert j.deletion_dir == 'a_deletion_dir'
+        with self.assertRaises(EGCGError):
+            j.start('final_deletion', 'a_deletion_dir')
+
+        # new records are not appended to the incomplete line
+        j.record('marked', 'a_sample')
+        assert DeletionJournal(self.journal_file).done('marked', 'a_sample')
+
+    def test_read_only(self):
+        j = DeletionJournal(self.journal_file, read_only=True)
+        j.record('discovered', 'a_sample')
+        assert j.done('discovered', 'a_sample')
+        assert not os.path.isfile(self.journal_file)
@@ -0,0 +1,52 @@
+import os
+import json
+from unittest.mock import patch
+from data_deletion.metrics import Metrics
+from tests import TestProjectManagement
+
+
+class TestMetrics(TestProjectManagement):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    @patch('time.monotonic', side_effect=[0, 1.5, 2, 2.25, 3, 3.5])
+    def test_span(self, mocked_time):
+        with self.metrics.span('move'):
+            pass
+        with self.metrics.span('move'):
+            pass
+        with self.assertRaises(ValueError):
+            with self.metrics.span('rest_queries'):
+                raise ValueError('Something broke')
+
+        assert self.metrics.to_dict()['spans'] == {
+            'move': {'calls': 2, 'seconds': 1.75},
+            'rest_queries': {'calls': 1, 'seconds': 0.5}
+        }
+
+    def test_count(self):
+        self.metrics.count('subprocesses')
+        self.metrics.count('subprocesses', 3)
+        assert self.metrics.to_dict()['counters'] == {'subprocesses': 4}
+
+    @patch('time.monotonic', side_effect=[0, 1.5, 2, 2.25])
+    def test_summary(self, mocked_time):
+        with self.metrics.span('setup'):
+            self.metrics.count('files_moved', 12)
+        with self.metrics.span('move'):
+            pass
+        assert self.metrics.summary().splitlines() == [
+            'span                              calls      seconds',
+            'setup                                 1        1.500',
+            'move                                  1        0.250',
+            'counter                                        value',
+            'files_moved                                       12'
+        ]
+
+    def test_save(self):
+        metrics_file = os.path.join(self.assets_deletion, 'metrics.json')
+        self.metrics.count('files_moved', 12)
+        self.metrics.save(metrics_file)
+        with open(metrics_file) as f:
+            assert json.load(f) == {'spans': {}, 'counters': {'files_moved': 12}}
+        os.remove(metrics_file)
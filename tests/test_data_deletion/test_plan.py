@@ -0,0 +1,62 @@
+import os
+from unittest.mock import Mock
+from egcg_core.exceptions import EGCGError
+from data_deletion.plan import DeletionPlan, stat_entry
+from tests import TestProjectManagement
+
+
+class TestDeletionPlan(TestProjectManagement):
+    def setUp(self):
+        self.plan_file = os.path.join(self.assets_deletion, 'a_plan.json')
+        self.files = [os.path.join(self.assets_deletion, f) for f in ('a_planned_file', 'another_planned_file')]
+        for f in self.files:
+            with open(f, 'w') as open_file:
+                open_file.write('some data')
+        os.link(self.files[0], self.files[0] + '.link')
+
+    def tearDown(self):
+        for f in self.files + [self.files[0] + '.link', self.plan_file]:
+            if os.path.exists(f):
+                os.remove(f)
+
+    def test_stat_entry(self):
+        hsm_states = Mock(states={self.files[0]: ['exists', 'archived']})
+        entry = stat_entry(self.files[0], hsm_states=hsm_states)
+        st = os.stat(self.files[0])
+        assert entry == {
+            'path': self.files[0], 'inode': st.st_ino, 'size': 9, 'mtime': st.st_mtime,
+            'hsm_state': ['exists', 'archived']
+        }
+        assert 'hsm_state' not in stat_entry(self.files[1], hsm_states=hsm_states)
+
+    def test_save_load(self):
+        plan = DeletionPlan('delivered_data', 'now')
+        plan.add('a_sample', [stat_entry(f) for f in self.files + [self.files[0] + '.link']],
+                 [('samples', {'data_deleted': 'on lustre'}, 'sample_id', 'a_sample')], {'some': 'data'})
+        assert plan.total_size == 18  # hard links are only counted once
+        plan.save(self.plan_file)
+
+        loaded_plan = DeletionPlan.load(self.plan_file, 'delivered_data')
+        assert loaded_plan.created == 'now'
+        assert loaded_plan.items[0]['key'] == 'a_sample'
+        assert loaded_plan.items[0]['data'] == {'some': 'data'}
+        assert loaded_plan.items[0]['rest_patches'] == [['samples', {'data_deleted': 'on lustre'}, 'sample_id',
+                                                         'a_sample']]
+
+        with self.assertRaises(EGCGError) as e:
+            DeletionPlan.load(self.plan_file, 'final_deletion')
+        assert str(e.exception) == 'Cannot apply a delivered_data plan with a final_deletion deleter'
+
+    def test_validate(self):
+        plan = DeletionPlan('delivered_data')
+        plan.add('a_sample', [stat_entry(f) for f in self.files])
+        assert plan.changed_files() == {}
+        plan.validate()
+
+        os.remove(self.files[0])
+        with open(self.files[1], 'a') as f:
+            f.write('more data')
+        assert plan.changed_files() == {self.files[0]: 'missing', self.files[1]: 'size changed from 9 to 18'}
+        with self.assertRaises(EGCGError) as e:
+            plan.validate()
+        assert str(e.exception) == '2 files have changed since the deletion plan was written'
@@ -2,14 +2,16 @@ import os
 from shutil import rmtree
 from os.path import join
 from datetime import datetime
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 from egcg_core.executor import local_execute
+from egcg_core.exceptions import EGCGError
+from data_deletion.plan import DeletionPlan
 from data_deletion.raw_data import RawDataDeleter
 from tests.test_data_deletion import TestDeleter, patched_patch_entry
 
 
-def fake_execute(cmd, cluster_execution=False):
-    local_execute(cmd).join()
+def fake_execute(*cmds, cluster_execution=False):
+    local_execute(*cmds).join()
 
 
 patched_deletable_runs = patch(
@@ -37,61 +39,153 @@ class TestRawDataDeleter(TestDeleter):
         for d in os.listdir(join(self.assets_deletion, 'archive')):
             rmtree(join(self.assets_deletion, 'archive', d))
 
-    def test_run_element_old_enough_for_deletion(self):
-        old_run_element = {'useable_date': '30_05_2018_12:00:00'}
-        new_run_element = {'useable_date': '12_06_2018_12:00:00'}
-        none_run_element = {'useable_date': None}
-        empty_run_element = {}
-        assert self.deleter._run_element_old_enough_for_deletion(old_run_element) is True
-        assert self.deleter._run_element_old_enough_for_deletion(new_run_element) is False
-        assert self.deleter._run_element_old_enough_for_deletion(none_run_element) is False
-        assert self.deleter._run_element_old_enough_for_deletion(empty_run_element) is False
+    def test_newest_useable_dates(self):
+        run_elements = [
+            {'run_id': 'old_run', 'useable_date': '30_05_2018_12:00:00'},
+            {'run_id': 'old_run', 'useable_date': '30_05_2018_11:00:00'},
+            {'run_id': 'new_run', 'useable_date': '30_05_2018_12:00:00'},
+            {'run_id': 'new_run', 'useable_date': '12_06_2018_12:00:00'},
+            {'run_id': 'undated_run', 'useable_date': '30_05_2018_12:00:00'},
+            {'run_id': 'undated_run', 'useable_date': None},
+            {'run_id': 'undated_run', 'useable_date': '12_06_2018_12:00:00'},
+            {'run_id': 'unuseable_run'}
+        ]
+        assert self.deleter._newest_useable_dates(run_elements) == {
+            'old_run': datetime(2018, 5, 30, 12),
+            'new_run': datetime(2018, 6, 12, 12),
+            'undated_run': None,
+            'unuseable_run': None
+        }
 
-    @patch('egcg_core.rest_communication.get_documents')
-    def test_run_old_enough_for_deletion(self, mocked_get_docs):
-        mocked_get_docs.return_value = [{'useable_date': '30_05_2018_12:00:00'}, {'useable_date': '30_05_2018_11:00:00'}]
-        assert self.deleter._run_old_enough_for_deletion('a_run') is True
-        mocked_get_docs.return_value = [{'useable_date': '12_06_2018_12:00:00'},  {'useable_date': None}]
-        assert self.deleter._run_old_enough_for_deletion('a_run') is False
-        mocked_get_docs.return_value = []
-        assert self.deleter._run_old_enough_for_deletion('a_run') is False
+    @patch('data_deletion.get_documents_in')
+    def test_old_enough_runs(self, mocked_get_docs):
+        runs = [{'run_id': 'run%s' % i} for i in range(5)]
+        run_elements = {
+            'run0': '31_05_2018_12:00:00', 'run1': '12_06_2018_12:00:00', 'run2': None, 'run3': '31_05_2018_12:00:00',
+            'run4': '31_05_2018_12:00:00'
+        }
+        mocked_get_docs.side_effect = lambda endpoint, field, values, **kwargs: [
+            {'run_id': r, 'useable_date': run_elements[r]} for r in values
+        ]
+        self.deleter.rest_query_size = 1
+        self.deleter.rest_workers = 2
+
+        assert self.deleter._old_enough_runs(runs) == [runs[0], runs[3], runs[4]]
+        mocked_get_docs.assert_called_with(
+            'run_elements', 'run_id', ['run4'], chunk_size=1, max_workers=2, where={'barcode': {'$ne': 'unknown'}}
+        )
+        assert mocked_get_docs.call_count == 3
+
+        # the second batch of runs has what we need, so the third is not queried
+        mocked_get_docs.reset_mock()
+        assert self.deleter._old_enough_runs(runs, limit=2) == [runs[0], runs[3]]
+        assert mocked_get_docs.call_count == 2
+        assert self.deleter._old_enough_runs(runs, limit=0) == []
 
+    @patch('data_deletion.get_documents_in')
     @patch('egcg_core.rest_communication.get_documents')
     @patch('egcg_core.rest_communication.get_document')
-    def test_deletable_runs(self, mocked_get_doc, mocked_get_docs):
+    def test_deletable_runs(self, mocked_get_doc, mocked_get_docs, mocked_get_docs_in):
         mocked_get_doc.return_value = {
             'run_id': 'a_manually_deletable_recent_run',
             # 'aggregated': {'most_recent_proc': {'status': 'stuck in processing because something broke'}}
         }
-        mocked_get_docs.side_effect = [
-            [
-                {'run_id': 'a_finished_reviewed_recent_run', 'aggregated': {'review_statuses': ['pass']}},
-                {'run_id': 'a_finished_reviewed_old_run', 'aggregated': {'review_statuses': ['pass']}},
-                {'run_id': 'a_finished_unreviewed_old_run', 'aggregated': {'review_statuses': ['pass']}},
-                {'run_id': 'an_extra_run', 'aggregated': {'review_statuses': ['pass']}},
-                {'run_id': 'an_incomplete_extra_run', 'aggregated': {'review_statuses': []}}  # This will be filtered
-            ],
-            [{'useable_date': '12_06_2018_12:00:00'}],
-            [{'useable_date': '31_05_2018_12:00:00'}],
-            [{'useable_date': '31_05_2018_12:00:00'}, {'useable_date': None}],
-            [{'useable_date': '31_05_2018_12:00:00'}]
+        mocked_get_docs.return_value = [
+            {'run_id': 'a_finished_reviewed_recent_run', 'aggregated': {'review_statuses': ['pass']}},
+            {'run_id': 'a_finished_reviewed_old_run', 'aggregated': {'review_statuses': ['pass']}},
+            {'run_id': 'a_finished_unreviewed_old_run', 'aggregated': {'review_statuses': ['pass']}},
+            {'run_id': 'an_extra_run', 'aggregated': {'review_statuses': ['pass']}},
+            {'run_id': 'an_incomplete_extra_run', 'aggregated': {'review_statuses': []}}  # This will be filtered
+        ]
+        mocked_get_docs_in.return_value = [
+            {'run_id': 'a_finished_reviewed_recent_run', 'useable_date': '12_06_2018_12:00:00'},
+            {'run_id': 'a_finished_reviewed_old_run', 'useable_date': '31_05_2018_12:00:00'},
+            {'run_id': 'a_finished_unreviewed_old_run', 'useable_date': '31_05_2018_12:00:00'},
+            {'run_id': 'a_finished_unreviewed_old_run', 'useable_date': None},
+            {'run_id': 'an_extra_run', 'useable_date': '31_05_2018_12:00:00'}
         ]
 
         self.deleter.manual_delete = ['a_manually_deletable_recent_run']
         self.deleter.deletion_limit = 2
         runs = self.deleter.deletable_runs()
         mocked_get_doc.assert_called_with('runs', where={'run_id': 'a_manually_deletable_recent_run'})
+        assert mocked_get_docs_in.call_count == 1
+        assert sorted(mocked_get_docs_in.call_args[0][2]) == [
+            'a_finished_reviewed_old_run', 'a_finished_reviewed_recent_run', 'a_finished_unreviewed_old_run',
+            'an_extra_run'
+        ]
 
         obs = [r['run_id'] for r in runs]
         assert obs == ['a_manually_deletable_recent_run', 'a_finished_reviewed_old_run']
 
+        self.deleter.deletion_limit = None
+        obs = [r['run_id'] for r in self.deleter.deletable_runs()]
+        assert obs == ['a_manually_deletable_recent_run', 'a_finished_reviewed_old_run', 'an_extra_run']
+
+    @patch('data_deletion.raw_data.disk_usage')
+    def test_bytes_to_free(self, mocked_disk_usage):
+        mocked_disk_usage.return_value = Mock(total=1000, free=150)
+        assert self.deleter._bytes_to_free() is None
+        self.deleter.target_free_fraction = 0.4
+        assert self.deleter._bytes_to_free() == 250
+        self.deleter.target_free_fraction = 0.1
+        assert self.deleter._bytes_to_free() == 0
+        self.deleter.target_bytes = 300
+        assert self.deleter._bytes_to_free() == 300
+
+    def test_runs_within_budget(self):
+        runs = [{'run_id': 'run%s' % i} for i in range(4)]
+        self.deleter.run_sizes = {'run0': 100, 'run1': 300, 'run2': 200, 'run3': 50}
+        self.deleter.newest_useable_dates = {
+            'run1': datetime(2018, 5, 3), 'run2': datetime(2018, 5, 1), 'run3': datetime(2018, 5, 2)
+        }
+        manual_runs, auto_runs = runs[:1], runs[1:]
+
+        obs = self.deleter._runs_within_budget(manual_runs, auto_runs, 300)
+        assert [r['run_id'] for r in obs] == ['run0', 'run2']
+        assert self.deleter.metrics.counters['bytes_to_delete'] == 300
+
+        self.deleter.selection_order = 'largest'
+        obs = self.deleter._runs_within_budget(manual_runs, auto_runs, 300)
+        assert [r['run_id'] for r in obs] == ['run0', 'run1']
+
+        obs = self.deleter._runs_within_budget(manual_runs, auto_runs, 10000)
+        assert [r['run_id'] for r in obs] == ['run0', 'run1', 'run2', 'run3']
+
+        self.deleter.deletion_limit = 2
+        obs = self.deleter._runs_within_budget(manual_runs, auto_runs, 10000)
+        assert [r['run_id'] for r in obs] == ['run0', 'run1']
+
+        # manually deleted runs are kept even when the target is already met
+        obs = self.deleter._runs_within_budget(runs[:3], runs[3:], 50)
+        assert [r['run_id'] for r in obs] == ['run0', 'run1', 'run2']
+        obs = self.deleter._runs_within_budget(manual_runs, auto_runs, 0)
+        assert [r['run_id'] for r in obs] == ['run0']
+
+    def test_run_size(self):
+        with patch('data_deletion.raw_data.get_disk_usage', return_value=Mock(total_size=1000)) as mocked_usage:
+            assert self.deleter._run_size('deletable_run') == 1000
+            assert self.deleter._run_size('deletable_run') == 1000
+        assert mocked_usage.call_count == 1
+        self.compare_lists(
+            mocked_usage.call_args[0][0],
+            [join(self.deleter.raw_data_dir, 'deletable_run', d) for d in self.deleter.deletable_sub_dirs]
+        )
+
     def test_setup_run_for_deletion(self):
         subdirs_to_delete = self.deleter._setup_run_for_deletion('deletable_run')
         self.compare_lists(subdirs_to_delete, self.deleter.deletable_sub_dirs)
         rmtree(self.deleter.deletion_dir)
 
     def test_setup_runs_for_deletion(self):
-        with patched_deletable_runs:
+        stage_run = self.deleter._stage_run
+
+        def fake_stage_run(run):
+            # all workers share the deletion dir resolved beforehand
+            assert 'deletion_dir' in self.deleter.__dict__
+            stage_run(run)
+
+        with patched_deletable_runs, patch.object(self.deleter, '_stage_run', side_effect=fake_stage_run):
             self.deleter.setup_runs_for_deletion(self.deleter.deletable_runs())
             assert os.listdir(self.deleter.deletion_dir) == ['deletable_run']
         rmtree(self.deleter.deletion_dir)
@@ -146,7 +240,17 @@ class TestRawDataDeleter(TestDeleter):
                 os.listdir(d),
                 list(self.deleter.deletable_sub_dirs) + ['Stats', 'InterOp', 'RTAComplete.txt']
             )
-        self.deleter.delete_data()
+        staged = []
+
+        def fake_disk_usage(d):
+            staged.append(not os.path.isdir(join(del_dir, self.deleter.deletable_sub_dirs[0])))
+            return Mock(free=100 + 1000 * (len(staged) - 1))
+
+        with patch('data_deletion.raw_data.disk_usage', side_effect=fake_disk_usage):
+            self.deleter.delete_data()
+        # free space is first measured before the run is staged, then after it is deleted
+        assert staged == [False, True]
+        assert self.deleter.metrics.counters['bytes_freed'] == 1000
         assert os.path.isdir(non_del_dir)
         self.compare_lists(
             os.listdir(non_del_dir),
@@ -163,3 +267,94 @@ class TestRawDataDeleter(TestDeleter):
             'most_recent_proc'
         )
         assert mocked_deletable_runs.call_count == 1
+
+    @patched_patch_entry
+    def test_run_deletion_with_failures(self, mocked_patch):
+        self._setup_run('failing_run', self.deleter.deletable_sub_dirs)
+        runs = [
+            {'run_id': r, 'aggregated': {'most_recent_proc': {'proc_id': r + '_proc'}}}
+            for r in ('deletable_run', 'failing_run')
+        ]
+        archive_run = self.deleter.archive_run
+
+        def fake_archive_run(run_id):
+            if run_id == 'failing_run':
+                raise OSError('Something broke')
+            archive_run(run_id)
+
+        self.deleter.archive_run = fake_archive_run
+        self.deleter.run_workers = 2
+        with patch.object(self.deleter, 'deletable_runs', return_value=runs), self.assertRaises(EGCGError) as e:
+            self.deleter.delete_data()
+
+        assert str(e.exception) == 'Could not delete 1 runs: failing_run (_archive_and_mark_run: Something broke)'
+        # only the run that was archived is marked as deleted
+        mocked_patch.assert_called_once_with('analysis_driver_procs', {'status': 'deleted'}, 'proc_id',
+                                             'deletable_run_proc')
+        self.compare_lists(os.listdir(join(self.assets_deletion, 'archive')), ['deletable_run'])
+        # the failing run is left as it was, and the deletion dir is removed
+        self.compare_lists(
+            os.listdir(join(self.assets_deletion, 'raw', 'failing_run')),
+            list(self.deleter.deletable_sub_dirs) + ['Stats', 'InterOp', 'RTAComplete.txt']
+        )
+        assert not os.path.isdir(self.deleter.deletion_dir)
+        rmtree(join(self.assets_deletion, 'raw', 'failing_run'))
+
+    @patched_patch_entry
+    def test_run_deletion_with_unmarked_run(self, mocked_patch):
+        self._setup_run('unmarked_run', self.deleter.deletable_sub_dirs)
+        runs = [
+            {'run_id': r, 'aggregated': {'most_recent_proc': {'proc_id': r + '_proc'}}}
+            for r in ('deletable_run', 'unmarked_run')
+        ]
+
+        def fake_patch(endpoint, payload, key, value):
+            if value == 'unmarked_run_proc':
+                raise EGCGError('Rest API unavailable')
+
+        mocked_patch.side_effect = fake_patch
+        with patch.object(self.deleter, 'deletable_runs', return_value=runs), self.assertRaises(EGCGError) as e:
+            self.deleter.delete_data()
+
+        assert str(e.exception) == (
+            'Could not delete 1 runs: unmarked_run (_archive_and_mark_run: Rest API unavailable - archived and '
+            'deleted, but not marked as deleted)'
+        )
+        # the run was archived, so its staged dirs are deleted rather than moved back to the archive
+        self.compare_lists(os.listdir(join(self.assets_deletion, 'archive')), ['deletable_run', 'unmarked_run'])
+        self.compare_lists(
+            os.listdir(join(self.assets_deletion, 'archive', 'unmarked_run')),
+            ['Stats', 'InterOp', 'RTAComplete.txt']
+        )
+        assert not os.path.isdir(self.deleter.deletion_dir)
+
+    @patched_patch_entry
+    @patched_deletable_runs
+    def test_plan_and_apply(self, mocked_deletable_runs, mocked_patch):
+        plan_file = join(self.assets_deletion, 'raw_plan.json')
+        self.deleter.write_plan = plan_file
+        assert self.deleter.delete_data() == 0
+        self.deleter.write_plan = None
+        mocked_patch.assert_not_called()
+
+        plan = DeletionPlan.load(plan_file, 'raw')
+        assert [i['key'] for i in plan.items] == ['deletable_run']
+        self.compare_lists(
+            [f['path'] for f in plan.items[0]['files']],
+            [join(self.deleter.raw_data_dir, 'deletable_run', d) for d in self.deleter.deletable_sub_dirs]
+        )
+        assert plan.items[0]['rest_patches'] == [['analysis_driver_procs', {'status': 'deleted'}, 'proc_id',
+                                                  'most_recent_proc']]
+
+        # the plan is applied without looking for deletable runs again
+        self.deleter.apply_plan = plan_file
+        self.deleter.delete_data()
+        assert mocked_deletable_runs.call_count == 1
+        assert os.path.isdir(join(self.assets_deletion, 'archive', 'deletable_run'))
+        mocked_patch.assert_called_once_with('analysis_driver_procs', {'status': 'deleted'}, 'proc_id',
+                                             'most_recent_proc')
+
+        # a plan whose files have changed is not applied
+        with self.assertRaises(EGCGError):
+            self.deleter.delete_data()
+        os.remove(plan_file)
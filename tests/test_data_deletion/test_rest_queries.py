@@ -0,0 +1,27 @@
+from unittest.mock import patch
+from data_deletion.rest_queries import get_documents_in, chunks
+from tests import TestProjectManagement
+
+
+class TestRestQueries(TestProjectManagement):
+    def test_chunks(self):
+        assert chunks([], 2) == []
+        assert chunks(range(5), 2) == [[0, 1], [2, 3], [4]]
+
+    @patch('data_deletion.rest_queries.Communicator.get_documents')
+    def test_get_documents_in(self, mocked_get_docs):
+        def fake_get_docs(endpoint, where, **kwargs):
+            return [{'sample_id': s} for s in where['sample_id']['$in']]
+
+        mocked_get_docs.side_effect = fake_get_docs
+        assert get_documents_in('samples', 'sample_id', []) == []
+        mocked_get_docs.assert_not_called()
+
+        docs = get_documents_in(
+            'samples', 'sample_id', ['s%s' % i for i in range(5)] + ['s0'], chunk_size=2, where={'useable': 'yes'}
+        )
+        assert docs == [{'sample_id': 's%s' % i} for i in range(5)]
+        assert mocked_get_docs.call_count == 3
+        mocked_get_docs.assert_any_call(
+            'samples', quiet=True, all_pages=True, where={'useable': 'yes', 'sample_id': {'$in': ['s0', 's1']}}
+        )
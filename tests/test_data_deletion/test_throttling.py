@@ -0,0 +1,73 @@
+import threading
+from time import sleep
+from datetime import time
+from unittest.mock import patch
+from data_deletion.throttling import Throttle
+from tests import TestProjectManagement
+
+
+class TestThrottle(TestProjectManagement):
+    windows = [
+        {'start': '08:00', 'end': '20:00', 'max_ops_per_second': 10, 'max_concurrent_ops': 2},
+        {'start': '23:00', 'end': '02:00', 'max_ops_per_second': None}
+    ]
+
+    def test_from_config(self):
+        throttle = Throttle.from_config({'max_ops_per_second': 100, 'max_concurrent_ops': 8, 'windows': self.windows})
+        assert throttle.max_ops_per_second == 100
+        assert throttle.max_concurrent_ops == 8
+        assert throttle.windows == [(time(8), time(20), 10, 2), (time(23), time(2), None, 8)]
+        assert Throttle.from_config(None).limits() == (None, None)
+
+    def test_limits(self):
+        throttle = Throttle(100, 8, self.windows)
+        for now, exp in ((time(7, 59), (100, 8)), (time(8), (10, 2)), (time(19, 59), (10, 2)), (time(20), (100, 8)),
+                         (time(23, 30), (None, 8)), (time(1), (None, 8)), (time(2), (100, 8))):
+            with patch.object(Throttle, '_now', return_value=now):
+                assert throttle.limits() == exp
+
+    @patch('data_deletion.throttling.time.sleep')
+    def test_rate(self, mocked_sleep):
+        with Throttle().operation():
+            pass
+        mocked_sleep.assert_not_called()
+
+        throttle = Throttle(10)
+        for _ in range(5):
+            with throttle.operation():
+                pass
+        assert 0 < mocked_sleep.call_args[0][0] <= 0.4
+
+        # a batched operation reserves as many slots as it counts operations
+        with throttle.operation(20):
+            pass
+        with throttle.operation():
+            pass
+        assert 1.9 < mocked_sleep.call_args[0][0] <= 2.5
+
+    def test_concurrency(self):
+        throttle = Throttle(max_concurrent_ops=2)
+        running = []
+        max_running = []
+
+        def op():
+            with throttle.operation():
+                running.append(1)
+                max_running.append(len(running))
+                sleep(0.01)
+                running.pop()
+
+        threads = [threading.Thread(target=op) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert max(max_running) == 2
+
+    @patch('data_deletion.throttling.time.sleep')
+    def test_parent(self, mocked_sleep):
+        parent = Throttle(max_concurrent_ops=1)
+        child = Throttle(10, parent=parent)
+        with child.operation():
+            assert parent.active_ops == 1
+        assert parent.active_ops == 0
@@ -22,21 +22,28 @@ class TestRecall(TestProjectManagement):
     }
 
     @patch(ppath + 'rest_communication.get_document')
-    @patch(ppath + 'am.archive_states', return_value=['exists', 'archived'])
+    @patch(ppath + 'HSMStates._get_cmd_output')
     @patch(ppath + 'ProcessedSample')
-    def test_file_states(self, mocked_sample, mocked_archive_states, mocked_get_doc):
+    def test_file_states(self, mocked_sample, mocked_cmd_output, mocked_get_doc):
         fastqs = ['sample_1_r1.fastq.gz', 'sample_1_r2.fastq.gz']
         processed_files = ['sample_1.bam', 'sample_1.bam.bai', 'sample_1.vcf.gz', 'sample_1.vcf.gz.tbi']
-        mocked_sample.return_value = Mock(raw_data_files=fastqs, processed_data_files=processed_files)
+        mocked_sample.return_value = Mock(archived_files=fastqs + processed_files)
+        mocked_cmd_output.return_value = (
+            0,
+            ''.join('%s: (0x00000009) exists archived, archive_id:1\n' % f for f in fastqs + processed_files).encode(),
+            b''
+        )
 
         assert recall_sample.file_states('sample_1') == {f: ['archived', 'exists'] for f in fastqs + processed_files}
         mocked_get_doc.assert_called_with('samples', where={'sample_id': 'sample_1'}, quiet=True)
+        mocked_cmd_output.assert_called_once_with(['lfs', 'hsm_state'] + sorted(fastqs + processed_files))
 
     @patch(ppath + 'file_states', return_value=fake_file_states)
-    @patch(ppath + 'get_file_list_size', return_value=1000000000)
-    @patch('egcg_core.archive_management.archive_states', return_value=[])
-    def test_check(self, mocked_archive_states, mocked_file_size, mocked_file_states):
+    @patch(ppath + 'get_reclaimable_space', return_value=Mock(freed=3000000000, unlinked=1000000000))
+    @patch(ppath + 'get_disk_usage', return_value=Mock(total_size=1000000000))
+    def test_check(self, mocked_file_size, mocked_reclaimable_space, mocked_file_states):
         obs = recall_sample.check('a_sample_id')
+        mocked_reclaimable_space.assert_called_once_with(sorted(self.fake_file_states))
         assert obs == (
             ['this.vcf.gz'],
             ['this_r2.fastq.gz'],